@@ -14,7 +14,8 @@ from werkzeug.utils import secure_filename  # type: ignore
 from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, flash, redirect, url_for  # type: ignore
 import shutil
 
-from main import EmailConverter, LoggingConfig  # type: ignore
+from main import EmailConverter, LoggingConfig, RenderCostModel, ResourceFetcher  # type: ignore
+from config import theme_style  # type: ignore
 
 from typing import Dict, Any, Optional, Union, List
 
@@ -153,8 +154,8 @@ def inject_config():
         
     return dict(config=config, text=languages)
 
-# Initialize converter
-converter = EmailConverter()
+# Initialize converter; renders run in worker processes, off the request thread
+converter = EmailConverter({'isolate_render': True})
 
 
 # ============================================================================
@@ -268,8 +269,11 @@ def upload_files():
         options = {
             'extract_attachments': request.form.get('extract_attachments') == 'true',
             'page_size': request.form.get('page_size', 'A4'),
-            'orientation': request.form.get('orientation', 'portrait')
+            'orientation': request.form.get('orientation', 'portrait'),
+            'style': theme_style(load_dynamic_config().get('colors'))
         }
+        if request.form.get('use_cache') is not None:
+            options['use_cache'] = request.form.get('use_cache') == 'true'
         
         for file in files:
             if not allowed_file(file.filename):
@@ -292,6 +296,25 @@ def upload_files():
             session_output_dir.mkdir(exist_ok=True)
             
             try:
+                if converter.detector.detect_format(file_path) == 'mbox':
+                    # One PDF per message, reported individually
+                    for result in converter.convert_mbox(str(file_path), str(session_output_dir), options):
+                        entry = {
+                            'input': filename,
+                            'message': result['index'] + 1,
+                            'subject': result.get('subject'),
+                            'status': result['status']
+                        }
+                        if result['output']:
+                            entry['output'] = Path(result['output']).name
+                        if result.get('degraded'):
+                            entry['degraded'] = result['degraded']
+                        if result.get('error'):
+                            entry['error'] = result['error']
+                        conversion_results.append(entry)
+                    logger.info(f"Session {session_id}: Converted mailbox {filename}")
+                    continue
+                
                 pdf_path = converter.convert_email(str(file_path), str(session_output_dir), options)
                 
                 if pdf_path:
@@ -322,8 +345,11 @@ def upload_files():
             'timestamp': datetime.now().isoformat(),
             'files_processed': len(conversion_results),
             'files_success': sum(1 for r in conversion_results if r['status'] == 'success'),
-            'files_failed': sum(1 for r in conversion_results if r['status'] == 'error'),
-            'results': conversion_results
+            'files_failed': sum(1 for r in conversion_results if r['status'] != 'success'),
+            'results': conversion_results,
+            'cache': converter.cache.stats(),
+            'render': RenderCostModel.get_stats(),
+            'resources': ResourceFetcher.get_stats()
         }
         
         save_session_status(session_id, status)
@@ -364,7 +390,8 @@ def preview_email():
         file.save(str(file_path))
         
         # Generate preview
-        html_content = converter.get_preview_html(str(file_path))
+        html_content = converter.get_preview_html(
+            str(file_path), options={'style': theme_style(load_dynamic_config().get('colors'))})
         
         # Cleanup (optional, or rely on periodic cleanup)
         # Cleanup
@@ -385,6 +412,51 @@ def preview_email():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/metadata', methods=['POST'])
+def email_metadata():
+    """
+    Describe an uploaded email from its headers only.
+    Returns:
+        JSON with subject, sender, date and attachment listing or error
+    """
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+            
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+            
+        if not allowed_file(file.filename): # type: ignore
+            return jsonify({'error': 'File type not allowed'}), 400
+            
+        import uuid
+        metadata_id = str(uuid.uuid4())[:8]  # type: ignore
+        metadata_dir = app.config['UPLOAD_FOLDER'] / 'metadata' / metadata_id
+        metadata_dir.mkdir(parents=True, exist_ok=True)
+        
+        filename = secure_filename(file.filename) # type: ignore
+        file_path = metadata_dir / filename
+        file.save(str(file_path))
+        
+        metadata = converter.get_metadata(str(file_path), skeleton=True)
+        
+        try:
+            import shutil
+            shutil.rmtree(metadata_dir)
+        except Exception as e:
+            logger.warning(f"Metadata cleanup failed: {e}")
+            
+        if metadata:
+            return jsonify(metadata)
+        else:
+            return jsonify({'error': 'Failed to read email headers'}), 500
+            
+    except Exception as e:
+        logger.error(f"Metadata error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/download/<session_id>')
 def download_pdfs(session_id: str):
     """
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Mail2PDF NextGen - Rendering Benchmark
+Ville de Fontaine 38600, France
+
+Measures per-message render time. Run with --help for the options.
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from main import EmailMessage, PDFGenerator, TextPDFRenderer, HTML
+
+
+def sample_messages(count):
+    """Build synthetic messages of a typical newsletter size."""
+    paragraph = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 12 + "</p>"
+    return [
+        EmailMessage(
+            subject=f"Bulletin municipal n°{i}",
+            sender="mairie@ville-fontaine.fr",
+            recipients=["habitants@ville-fontaine.fr"],
+            cc=[],
+            bcc=[],
+            date="Mon, 05 Oct 2026 09:00:00 +0200",
+            content_type="text/html",
+            body="",
+            html_body=paragraph * 8,
+        )
+        for i in range(count)
+    ]
+
+
+def plain_messages(count):
+    """Build synthetic plain-text messages, the bulk of a typical archive."""
+    body = "Bonjour,\n\n" + ("Le conseil municipal se réunira jeudi à 18h en salle des fêtes. " * 6 + "\n\n") * 10
+    return [
+        EmailMessage(
+            subject=f"Compte rendu n°{i}",
+            sender="secretariat@ville-fontaine.fr",
+            recipients=["elus@ville-fontaine.fr"],
+            cc=[],
+            bcc=[],
+            date="Mon, 05 Oct 2026 09:00:00 +0200",
+            content_type="text/plain",
+            body=body,
+        )
+        for i in range(count)
+    ]
+
+
+def render_embedded(email_msg, output_path):
+    """Render the way generate() did before: inline CSS, nothing shared."""
+    html = PDFGenerator._create_html(email_msg, embed_css=True)
+    HTML(string=html).write_pdf(str(output_path))
+
+
+def render_shared(email_msg, output_path):
+    """Render with the compiled stylesheet and font configuration."""
+    # Forced: the cost model would send these simple messages to the text engine
+    PDFGenerator.generate(email_msg, output_path, {'engine': 'html'})
+
+
+def time_renders(render, messages, output_dir):
+    """Return the per-message render times in milliseconds."""
+    timings = []
+    for i, email_msg in enumerate(messages):
+        started = time.perf_counter()
+        render(email_msg, output_dir / f"{i:05d}.pdf")
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(label, timings):
+    """Print summary statistics for one run."""
+    print(f"{label:<28} first {timings[0]:8.1f} ms | "
+          f"median {statistics.median(timings[1:] or timings):8.1f} ms | "
+          f"mean {statistics.mean(timings):8.1f} ms")
+
+
+def bench_stylesheet(count):
+    """Compare per-message render time with and without shared stylesheets."""
+    if HTML is None:
+        print("✗ WeasyPrint is required for the stylesheet benchmark")
+        return 1
+
+    messages = sample_messages(count)
+    print(f"Rendering {count} messages per variant\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        before = time_renders(render_embedded, messages, Path(tmp))
+        PDFGenerator.clear_stylesheets()
+        after = time_renders(render_shared, messages, Path(tmp))
+
+    report("before (inline CSS)", before)
+    report("after (shared stylesheet)", after)
+    speedup = statistics.median(before) / statistics.median(after)
+    print(f"\nMedian speedup: {speedup:.2f}x")
+    return 0
+
+
+def bench_text_engine(count):
+    """Compare per-message render time of plain-text messages per engine."""
+    messages = plain_messages(count)
+    print(f"Rendering {count} plain-text messages per engine\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        text = time_renders(TextPDFRenderer.render, messages, Path(tmp))
+        report("native text engine", text)
+        if HTML is None:
+            print("WeasyPrint not installed: HTML engine skipped")
+            return 0
+        html = time_renders(lambda m, p: PDFGenerator.render(m, p, {'engine': 'html'}),
+                            messages, Path(tmp))
+        report("WeasyPrint", html)
+
+    speedup = statistics.median(html) / statistics.median(text)
+    print(f"\nMedian speedup: {speedup:.1f}x")
+    return 0
+
+
+BENCHMARKS = {
+    'stylesheet': bench_stylesheet,
+    'text': bench_text_engine
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mail2PDF rendering benchmark')
+    parser.add_argument('benchmarks', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('-n', '--messages', type=int, default=50,
+                        help='Messages rendered per variant (default: 50)')
+    args = parser.parse_args()
+
+    status = 0
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"=== {name} ===")
+        status |= BENCHMARKS[name](max(2, args.messages))
+        print()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,8 +21,66 @@ PDF_CONFIG = {
     'font_family': 'Arial, sans-serif',
     'font_size': '11pt',
     'line_height': '1.6',
-    'quality': 300,  # DPI
-    'compression': True
+    'quality': 300,  # DPI images are downsampled to
+    'jpeg_quality': 85,  # recompressed photos
+    'compression': True,
+    # (DPI, JPEG quality) tried in turn while a PDF exceeds max_pdf_size
+    'size_fallbacks': [(150, 75), (96, 60), (72, 45)],
+    'embed_attachments': False,  # carry the original attachments inside the PDF
+    'embed_max_bytes': 25 * 1024 * 1024,  # 25MB of attachments embedded per message
+    'append_attachments': False  # add image and PDF attachments as pages after the message
+}
+
+# Native plain-text engine (messages without an HTML body)
+TEXT_PDF_CONFIG = {
+    'font_size': 10,  # pt, body text
+    'header_font_size': 9,  # pt, From/To/Date block
+    'subject_font_size': 14,  # pt
+    'line_height': 1.3,
+    'margin': 20,  # mm
+    'tab_size': 8,
+    # First existing TrueType font is embedded; base-14 Courier otherwise
+    'font_paths': [
+        '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+        '/usr/share/fonts/TTF/DejaVuSansMono.ttf',
+        '/usr/share/fonts/dejavu/DejaVuSansMono.ttf',
+        '/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf',
+        'C:/Windows/Fonts/consola.ttf',
+        'C:/Windows/Fonts/cour.ttf',
+        '/Library/Fonts/Courier New.ttf'
+    ],
+    # Tried in order for characters the text font lacks (TrueType outlines only)
+    'fallback_font_paths': [
+        '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+        '/usr/share/fonts/TTF/DejaVuSans.ttf',
+        '/usr/share/fonts/truetype/noto/NotoSansArabic-Regular.ttf',
+        '/usr/share/fonts/truetype/noto/NotoNaskhArabic-Regular.ttf',
+        '/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf',
+        'C:/Windows/Fonts/arial.ttf',
+        '/Library/Fonts/Arial Unicode.ttf'
+    ],
+    # Glyphs a shared subset may grow to before documents get exact subsets
+    'subset_cache_glyphs': 512
+}
+
+# Engine selection for messages with an HTML body. Coefficients are the
+# starting point only: each process rescales them from its measured renders.
+RENDER_COST_CONFIG = {
+    'html': {  # seconds
+        'base': 0.15,
+        'per_kb': 0.004,
+        'per_image': 0.02,
+        'per_css_kb': 0.01,
+        'per_table_level': 0.05  # multiplied by nesting depth squared
+    },
+    'text': {
+        'base': 0.01,
+        'per_kb': 0.0008
+    },
+    'html_budget': 10.0,  # predicted seconds beyond which HTML is laid out as text
+    'simple_html_to_text': True,  # HTML without images, tables or styling uses the text engine
+    'calibration_weight': 0.1,  # weight of each new measurement in the rescaling
+    'history_size': 1000  # decisions kept for get_stats()
 }
 
 # ============================================================================
@@ -44,7 +102,7 @@ HTML_STYLE = {
     'success_color': '#51cf66'
 }
 
-CSS_INLINE = """
+CSS_TEMPLATE = """
 body {
     font-family: 'Segoe UI', Arial, sans-serif;
     color: %COLOR%;
@@ -179,7 +237,86 @@ blockquote {
     color: #999;
     margin-top: 5px;
 }
-""" % HTML_STYLE
+"""
+
+# Placeholders in CSS_TEMPLATE and the HTML_STYLE key that fills each one
+CSS_PLACEHOLDERS = {
+    '%COLOR%': 'text_color',
+    '%TEXT%': 'text_color',
+    '%PRIMARY%': 'primary_color',
+    '%SECONDARY%': 'secondary_color',
+    '%ACCENT%': 'accent_color',
+    '%BORDER%': 'border_color',
+    '%CODE%': 'code_background',
+    '%FOOTER%': 'footer_background',
+    '%LINK%': 'link_color'
+}
+
+
+def render_css(style: dict = None) -> str:
+    """Fill the CSS_TEMPLATE placeholders from a style mapping (HTML_STYLE by default)."""
+    style = {**HTML_STYLE, **(style or {})}
+    css = CSS_TEMPLATE
+    for placeholder, key in CSS_PLACEHOLDERS.items():
+        css = css.replace(placeholder, style[key])
+    return css
+
+
+CSS_INLINE = render_css()
+
+# Message document. $style, $subject, ... are string.Template fields: main.py
+# compiles this once per theme and HTML-escapes every field except $style
+# and $body.
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    $style
+</head>
+<body>
+    <div class="email-container">
+        <div class="header">
+            <div class="header-title">$subject</div>
+            <div class="header-meta">
+                <div class="meta-label">From:</div>
+                <div>$sender</div>
+                <div class="meta-label">To:</div>
+                <div>$recipients</div>
+                <div class="meta-label">CC:</div>
+                <div>$cc</div>
+                <div class="meta-label">Date:</div>
+                <div>$date</div>
+                <div class="meta-label">Attachments:</div>
+                <div>$attachments file(s)</div>
+            </div>
+        </div>
+        <div class="body">
+            $body
+        </div>
+        <div class="footer">
+            Generated by Mail2PDF NextGen | Ville de Fontaine 38600
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Colour names of data/config_dynamic.json and the HTML_STYLE key each one sets
+THEME_COLORS = {
+    'primary': 'primary_color',
+    'secondary': 'secondary_color',
+    'accent': 'accent_color',
+    'background': 'background_color',
+    'text': 'text_color'
+}
+
+
+def theme_style(colors: dict = None) -> dict:
+    """HTML_STYLE overrides from a config_dynamic.json ``colors`` mapping."""
+    style = {key: colors[name] for name, key in THEME_COLORS.items() if (colors or {}).get(name)}
+    if 'primary_color' in style:
+        style['link_color'] = style['primary_color']
+    return style
 
 # ============================================================================
 # EMAIL CONFIGURATION
@@ -236,6 +373,8 @@ ENCODING_CONFIG = {
     'replacement_char': '?',
     'use_chardet': True,
     'chardet_confidence_threshold': 0.7,
+    'chardet_sample_size': 64 * 1024,  # Bytes handed to chardet
+    'decision_cache_size': 1024,  # Remembered (charset, domain, mailer) fixes
     'detect_from_content': True,
     'detect_from_headers': True
 }
@@ -246,6 +385,9 @@ ENCODING_CONFIG = {
 
 PERFORMANCE_CONFIG = {
     'weasyprint_timeout': 30,  # seconds
+    'render_isolation': False,  # render in RenderPool worker processes
+    'render_workers': 2,
+    'render_memory_limit': 1024 * 1024 * 1024,  # 1GB address space per render worker
     'max_file_size': 100 * 1024 * 1024,  # 100MB
     'batch_size': 10,
     'thread_count': 4,
@@ -254,7 +396,22 @@ PERFORMANCE_CONFIG = {
     'cleanup_interval': 86400,  # 24 hours
     'max_pdf_size': 50 * 1024 * 1024,  # 50MB
     'use_cache': False,
-    'cache_size': 1000
+    'cache_size': 1000,  # PDFs kept in the conversion cache
+    'cache_max_bytes': 2 * 1024 * 1024 * 1024,  # 2GB
+    'cache_dir': './data/cache'
+}
+
+# Remote images, fonts and stylesheets referenced by HTML bodies
+REMOTE_RESOURCE_CONFIG = {
+    'policy': 'fetch',  # 'block' nothing remote, 'allow' allow_hosts only, 'fetch' any host
+    'allow_hosts': [],  # host names, subdomains included
+    'timeout': 5,  # seconds per request
+    'deadline': 15,  # seconds of fetching per message
+    'max_size': 5 * 1024 * 1024,  # 5MB per resource
+    'strip_tracking_pixels': True,  # drop 1x1 and hidden remote images
+    'cache_dir': './data/cache/resources',
+    'cache_ttl': 7 * 86400,  # seconds before a cached resource is fetched again
+    'cache_max_bytes': 256 * 1024 * 1024  # least recently used resources evicted beyond this
 }
 
 # ============================================================================
@@ -396,9 +553,11 @@ def get_config() -> dict:
         'pdf': PDF_CONFIG,
         'html': HTML_STYLE,
         'css': CSS_INLINE,
+        'html_template': HTML_TEMPLATE,
         'email': EMAIL_CONFIG,
         'encoding': ENCODING_CONFIG,
         'performance': PERFORMANCE_CONFIG,
+        'remote_resources': REMOTE_RESOURCE_CONFIG,
         'validation': VALIDATION_CONFIG,
         'logging': LOGGING_CONFIG,
         'flask': FLASK_CONFIG,
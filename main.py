@@ -12,13 +12,42 @@ import logging
 import zipfile
 import mimetypes
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple, Any, Union
-from dataclasses import dataclass
+from typing import List, Dict, Optional, Tuple, Any, Union, Iterator, Iterable
+from dataclasses import dataclass, field
 from datetime import datetime
 import email
 import email.message
-from email.parser import Parser, BytesParser
+from email.parser import BytesParser, BytesHeaderParser
+from email.feedparser import FeedParser
 import json
+import re
+import shutil
+import mmap
+import hashlib
+import queue
+import collections
+import concurrent.futures
+import threading
+import time
+import multiprocessing
+import atexit
+import signal
+import contextlib
+import zlib
+import io
+import html
+import tempfile
+import string
+import unicodedata
+import binascii
+import urllib.error
+import urllib.parse
+import urllib.request
+
+try:
+    import resource  # POSIX only: per-worker memory ceiling
+except ImportError:
+    resource = None
 
 # Third-party optional imports
 try:
@@ -33,12 +62,15 @@ except ImportError:
     HTML = None
     CSS = None
 
-try:
-    from reportlab.pdfgen import canvas  # type: ignore
-    from reportlab.lib.pagesizes import letter, A4  # type: ignore
-    from reportlab.lib.units import inch  # type: ignore
-except ImportError:
-    canvas = None
+FontConfiguration = None
+if HTML is not None:
+    try:
+        from weasyprint.text.fonts import FontConfiguration  # type: ignore
+    except ImportError:
+        try:
+            from weasyprint.fonts import FontConfiguration  # type: ignore
+        except ImportError:
+            pass
 
 # Optional chardet
 try:
@@ -46,6 +78,31 @@ try:
 except ImportError:
     chardet = None
 
+# Optional fontTools (a WeasyPrint dependency): TrueType embedding in text PDFs
+try:
+    from fontTools.ttLib import TTFont  # type: ignore
+    from fontTools import subset as font_subset  # type: ignore
+except ImportError:
+    TTFont = None
+    font_subset = None
+
+# Optional Pillow: downsampling and recompressing images before layout
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Optional pypdf: copying rendered pages into merged documents
+try:
+    import pypdf  # type: ignore
+except ImportError:
+    pypdf = None
+
+from config import (PERFORMANCE_CONFIG, ENCODING_CONFIG, CSS_TEMPLATE, TEXT_PDF_CONFIG, HTML_STYLE, PDF_CONFIG,
+                    RENDER_COST_CONFIG, HTML_TEMPLATE, REMOTE_RESOURCE_CONFIG, render_css)
+from utils import get_file_hash
+
 
 # ============================================================================
 # LOGGING CONFIGURATION
@@ -96,6 +153,10 @@ class EmailMessage:
     html_body: Optional[str] = None
     attachments: Optional[List[Dict[str, Any]]] = None
     headers: Optional[Dict[str, str]] = None
+    # MIME parts behind ``attachments`` (same order), decoded only on demand
+    attachment_parts: List[email.message.Message] = field(default_factory=list, repr=False, compare=False)
+    # Parts referenced from the HTML body as ``cid:`` URLs, by bare Content-ID
+    related_parts: Dict[str, email.message.Message] = field(default_factory=dict, repr=False, compare=False)
     
     def __post_init__(self):
         """Initialize default values."""
@@ -103,6 +164,21 @@ class EmailMessage:
             self.attachments = []
         if self.headers is None:
             self.headers = {}
+    
+    def get_attachment_payload(self, index: int) -> bytes:
+        """Decode and return the content of attachment ``index``."""
+        if index >= len(self.attachment_parts):
+            return b''
+        payload = self.attachment_parts[index].get_payload(decode=True)
+        return payload if isinstance(payload, bytes) else b''
+    
+    def get_related(self, content_id: str) -> Optional[Tuple[bytes, str]]:
+        """Decoded content and MIME type of the part behind a ``cid:`` reference."""
+        part = self.related_parts.get(content_id.strip().strip('<>'))
+        if part is None:
+            return None
+        payload = part.get_payload(decode=True)
+        return (payload if isinstance(payload, bytes) else b''), part.get_content_type()
 
 
 # ============================================================================
@@ -123,14 +199,33 @@ class EncodingManager:
     
     logger = logging.getLogger('mail2pdf.encoding')
     
+    # Per-process counters; see get_stats()
+    _stats_lock = threading.Lock()
+    stats: Dict[str, Any] = {
+        'calls': 0,
+        'fast_path': 0,
+        'detections': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'decode_seconds': 0.0,
+        'detect_seconds': 0.0
+    }
+    
+    # LRU of (declared charset, sender domain, mailer) -> codec that actually worked
+    _decisions: 'collections.OrderedDict[Tuple[str, str, str], str]' = collections.OrderedDict()
+    
     @classmethod
-    def detect_and_decode(cls, data: Union[bytes, str, None], hint_encoding: Optional[str] = None) -> str:
+    def detect_and_decode(cls, data: Union[bytes, str, None], hint_encoding: Optional[str] = None,
+                          context: Optional[Tuple[str, str]] = None) -> str:
         """
         Detect encoding and decode bytes to string with fallback chain.
         
         Args:
             data: Raw bytes to decode
             hint_encoding: Optional encoding hint from email headers
+            context: Optional (sender domain, mailer) from sender_context();
+                when the hint fails, the codec that fixed the same mislabel
+                for this sender is tried before any detection
             
         Returns:
             Decoded string
@@ -142,48 +237,169 @@ class EncodingManager:
         if not isinstance(data, bytes):
             return str(data)
         
-        # Try hint encoding first
-        if hint_encoding:
-            try:
-                return data.decode(hint_encoding)
-            except (UnicodeDecodeError, LookupError):
-                cls.logger.debug(f"Hint encoding {hint_encoding} failed")
+        started = time.perf_counter()
+        try:
+            # Try hint encoding first
+            if hint_encoding:
+                try:
+                    return data.decode(hint_encoding)
+                except (UnicodeDecodeError, LookupError):
+                    cls.logger.debug(f"Hint encoding {hint_encoding} failed")
+            
+            if context is None:
+                return cls._decode(data)[0]
+            
+            # Bytes that validate as UTF-8 never go through the sender's
+            # cached codec: a single-byte codec would decode them wrongly
+            text = cls._fast(data)
+            if text is not None:
+                return text
+            
+            key = (str(hint_encoding or '').lower(),) + tuple(context)
+            text = cls._decode_cached(data, key)
+            if text is not None:
+                return text
+            
+            text, codec = cls._decode(data)
+            if codec:
+                cls._remember(key, codec)
+            return text
+        finally:
+            cls._count(calls=1, decode_seconds=time.perf_counter() - started)
+    
+    @classmethod
+    def _fast(cls, data: bytes) -> Optional[str]:
+        """Fast path: plain ASCII, or bytes that validate as UTF-8 (None otherwise)."""
+        try:
+            text = data.decode('ascii' if data.isascii() else 'utf-8')
+        except UnicodeDecodeError:
+            return None
+        cls._count(fast_path=1)
+        return text
+    
+    @classmethod
+    def _decode(cls, data: bytes) -> Tuple[str, Optional[str]]:
+        """
+        Decode without a usable hint: ASCII/UTF-8 fast path, sampled
+        detection, then the fallback chain.
+        
+        Returns:
+            Decoded string and the codec used (None for lossy replacement)
+        """
+        text = cls._fast(data)
+        if text is not None:
+            return text, 'ascii' if data.isascii() else 'utf-8'
         
-        # Try chardet detection when available
-        if chardet is not None:
+        # Detection on a bounded sample
+        encoding = cls._detect(data)
+        if encoding:
             try:
-                detected = chardet.detect(data)
-                if detected and detected.get('encoding'):
-                    try:
-                        return data.decode(detected['encoding'])
-                    except (UnicodeDecodeError, LookupError):
-                        pass
-            except Exception as e:
-                cls.logger.debug(f"Chardet detection failed: {e}")
-        else:
-            cls.logger.debug("chardet not available, skipping detection")
+                return data.decode(encoding), encoding
+            except (UnicodeDecodeError, LookupError):
+                pass
         
         # Fallback chain
         for encoding in cls.FALLBACK_ENCODINGS[:-1]:
             try:
-                return data.decode(encoding)
+                return data.decode(encoding), encoding
             except (UnicodeDecodeError, LookupError):
                 cls.logger.debug(f"Encoding {encoding} failed, trying next")
         
         # Final fallback with replacement
-        return data.decode('utf-8', errors='replace')
+        return data.decode('utf-8', errors='replace'), None
+    
+    @classmethod
+    def _decode_cached(cls, data: bytes, key: Tuple[str, ...]) -> Optional[str]:
+        """Decode with the remembered codec for ``key``; None on a miss."""
+        with cls._stats_lock:
+            codec = cls._decisions.get(key)
+            if codec is not None:
+                cls._decisions.move_to_end(key)
+        
+        if codec is not None:
+            try:
+                text = data.decode(codec)
+                cls._count(cache_hits=1)
+                return text
+            except (UnicodeDecodeError, LookupError):
+                with cls._stats_lock:
+                    cls._decisions.pop(key, None)
+        
+        cls._count(cache_misses=1)
+        return None
+    
+    @classmethod
+    def _remember(cls, key: Tuple[str, ...], codec: str) -> None:
+        with cls._stats_lock:
+            cls._decisions[key] = codec
+            cls._decisions.move_to_end(key)
+            while len(cls._decisions) > ENCODING_CONFIG['decision_cache_size']:
+                cls._decisions.popitem(last=False)
+    
+    @staticmethod
+    def sender_context(msg: email.message.Message) -> Tuple[str, str]:
+        """Build the (sender domain, mailer) part of a charset decision key."""
+        match = re.search(r'@([\w.-]+)', str(msg.get('From', '')))
+        domain = match.group(1).lower() if match else ''
+        mailer = str(msg.get('X-Mailer') or msg.get('User-Agent') or '').strip().lower()[:64]
+        return domain, mailer
+    
+    @classmethod
+    def _detect(cls, data: bytes) -> Optional[str]:
+        """Run chardet over a bounded prefix; return a confident guess or None."""
+        if chardet is None or not ENCODING_CONFIG['use_chardet']:
+            cls.logger.debug("chardet not available, skipping detection")
+            return None
+        
+        started = time.perf_counter()
+        try:
+            detected = chardet.detect(data[:ENCODING_CONFIG['chardet_sample_size']])
+        except Exception as e:
+            cls.logger.debug(f"Chardet detection failed: {e}")
+            return None
+        finally:
+            cls._count(detections=1, detect_seconds=time.perf_counter() - started)
+        
+        if detected and detected.get('encoding') and \
+                (detected.get('confidence') or 0) >= ENCODING_CONFIG['chardet_confidence_threshold']:
+            return detected['encoding']
+        return None
+    
+    @classmethod
+    def _count(cls, **increments: float) -> None:
+        with cls._stats_lock:
+            for key, value in increments.items():
+                cls.stats[key] += value
+    
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Return a snapshot of the decoding counters and timings."""
+        with cls._stats_lock:
+            return dict(cls.stats)
+    
+    @classmethod
+    def reset_stats(cls) -> None:
+        """Zero the decoding counters and timings."""
+        with cls._stats_lock:
+            for key in cls.stats:
+                cls.stats[key] = 0.0 if isinstance(cls.stats[key], float) else 0
+    
+    @classmethod
+    def clear_decisions(cls) -> None:
+        """Forget every cached charset decision."""
+        with cls._stats_lock:
+            cls._decisions.clear()
     
     @classmethod
     def get_best_encoding(cls, data: bytes) -> str:
         """Get the best encoding for given bytes."""
+        if data.isascii():
+            return 'ascii'
         try:
-            if chardet is not None:
-                detected = chardet.detect(data)
-                if detected and detected.get('encoding'):
-                    return detected['encoding']
-        except Exception:
-            pass
-        return 'utf-8'
+            data.decode('utf-8')
+            return 'utf-8'
+        except UnicodeDecodeError:
+            return cls._detect(data) or 'utf-8'
 
 
 # ============================================================================
@@ -228,7 +444,11 @@ class EmailTypeDetector:
             if header.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
                 return 'msg'
             
-            # EML/MBOX check (should have From: or Return-Path:)
+            # MBOX starts with a From_ envelope line (no colon)
+            if header.startswith(b'From ') and not header.startswith(b'From:'):
+                return 'mbox'
+            
+            # EML check (should have From: or Return-Path:)
             try:
                 text = header.decode('utf-8', errors='ignore')
                 if 'From:' in text or 'Return-Path:' in text:
@@ -266,82 +486,162 @@ class EMLParser:
             raise
     
     @staticmethod
-    def _extract_message(msg: email.message.Message) -> EmailMessage:
-        """Extract EmailMessage from email.Message object."""
+    def parse_headers(file_path: Path, skeleton: bool = False) -> EmailMessage:
+        """
+        Parse only the headers of an EML file, without touching payloads.
         
-        # Extract headers
+        By default only the header block is read from disk. With
+        ``skeleton`` the MIME structure is parsed as well so attachment
+        metadata is filled in, but no part is ever decoded. The returned
+        EmailMessage has an empty body.
+        """
+        try:
+            if skeleton:
+                with open(file_path, 'rb') as f:
+                    msg = BytesParser().parse(f)
+            else:
+                msg = BytesHeaderParser().parsebytes(EMLParser._read_header_block(file_path))
+        except Exception as e:
+            EMLParser.logger.error(f"Error parsing EML headers {file_path}: {e}")
+            raise
+        
+        attachments = []
+        if skeleton and msg.is_multipart():
+            for part in msg.walk():
+                filename = part.get_filename()
+                if part.get_content_disposition() is not None and filename:
+                    attachments.append({
+                        'filename': filename,
+                        'content_type': part.get_content_type(),
+                        'size': EMLParser._estimate_payload_size(part)
+                    })
+        
+        return EmailMessage(
+            body='',
+            content_type=msg.get_content_type(),
+            attachments=attachments,
+            headers={k: v for k, v in msg.items()},
+            **EMLParser._header_fields(msg)
+        )
+    
+    @staticmethod
+    def _read_header_block(file_path: Path, limit: int = 1024 * 1024) -> bytes:
+        """Read a file up to the blank line that ends its headers."""
+        data = b''
+        with open(file_path, 'rb') as f:
+            while len(data) < limit:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                data += chunk
+                end = _HEADER_END.search(data)
+                if end:
+                    return data[:end.start() + 1]
+        return data[:limit]
+    
+    @staticmethod
+    def _header_fields(msg: email.message.Message) -> Dict[str, Any]:
+        """Extract the EmailMessage header fields of a parsed message."""
         subject = msg.get('Subject', '(No Subject)')
         subject = EncodingManager.detect_and_decode(
             subject.encode('utf-8') if isinstance(subject, str) else subject
         )
         
-        sender = msg.get('From', '(Unknown)')
-        recipients = [a.strip() for a in msg.get('To', '').split(',') if a.strip()]
-        cc = [a.strip() for a in msg.get('Cc', '').split(',') if a.strip()]
-        bcc = [a.strip() for a in msg.get('Bcc', '').split(',') if a.strip()]
-        date = msg.get('Date', datetime.now().isoformat())
+        return {
+            'subject': subject,
+            'sender': msg.get('From', '(Unknown)'),
+            'recipients': [a.strip() for a in msg.get('To', '').split(',') if a.strip()],
+            'cc': [a.strip() for a in msg.get('Cc', '').split(',') if a.strip()],
+            'bcc': [a.strip() for a in msg.get('Bcc', '').split(',') if a.strip()],
+            'date': msg.get('Date', datetime.now().isoformat())
+        }
+    
+    @staticmethod
+    def _extract_message(msg: email.message.Message) -> EmailMessage:
+        """Extract EmailMessage from email.Message object."""
         
-        # Extract body
+        # Extract body and attachment metadata in a single walk; attachment
+        # payloads stay encoded until someone asks for them
         body = ''
         html_body = None
+        attachments = []
+        attachment_parts = []
+        related_parts = {}
+        context = EncodingManager.sender_context(msg)
         
         if msg.is_multipart():
             for part in msg.walk():
+                if part.get_content_maintype() == 'multipart':
+                    continue
+                
                 content_type = part.get_content_type()
+                disposition = part.get_content_disposition()
                 
-                if content_type == 'text/plain':
+                if disposition != 'attachment' and content_type in ('text/plain', 'text/html'):
                     payload = part.get_payload(decode=True)
                     charset = part.get_content_charset() or 'utf-8'
                     if isinstance(payload, (bytes, str)) or payload is None:
-                        body = EncodingManager.detect_and_decode(payload, charset)  # type: ignore
+                        text = EncodingManager.detect_and_decode(payload, charset, context)  # type: ignore
+                        if content_type == 'text/plain':
+                            body = text
+                        else:
+                            html_body = text
                 
-                elif content_type == 'text/html':
-                    payload = part.get_payload(decode=True)
-                    charset = part.get_content_charset() or 'utf-8'
-                    if isinstance(payload, (bytes, str)) or payload is None:
-                        html_body = EncodingManager.detect_and_decode(payload, charset)  # type: ignore
-        else:
-            payload = msg.get_payload(decode=True)
-            if isinstance(payload, bytes):
-                charset = msg.get_content_charset() or 'utf-8'
-                body = EncodingManager.detect_and_decode(payload, charset)
-            else:
-                body = str(payload)
-        
-        # Extract attachments
-        attachments = []
-        if msg.is_multipart():
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                if part.get_content_disposition() is None:
+                content_id = part.get('Content-ID')
+                if content_id and part.get_content_maintype() != 'text':
+                    related_parts.setdefault(str(content_id).strip().strip('<>'), part)
+                
+                if disposition is None:
                     continue
                 filename = part.get_filename()
                 if filename:
-                    payload_bytes = part.get_payload(decode=True) or b''
-                    try:
-                        size = len(payload_bytes)
-                    except Exception:
-                        size = 0
                     attachments.append({
                         'filename': filename,
-                        'content_type': part.get_content_type(),
-                        'size': size
+                        'content_type': content_type,
+                        'size': EMLParser._estimate_payload_size(part)
                     })
+                    attachment_parts.append(part)
+        else:
+            payload = msg.get_payload(decode=True)
+            if isinstance(payload, bytes):
+                charset = msg.get_content_charset() or 'utf-8'
+                body = EncodingManager.detect_and_decode(payload, charset, context)
+            else:
+                body = str(payload)
+            if msg.get_content_type() == 'text/html':
+                # Single-part HTML: the renderer picks its engine from html_body
+                html_body = body
         
         return EmailMessage(
-            subject=subject,
-            sender=sender,
-            recipients=recipients,
-            cc=cc,
-            bcc=bcc,
-            date=date,
             content_type='text/html' if html_body else 'text/plain',
             body=html_body or body,
             html_body=html_body,
             attachments=attachments,
-            headers={k: v for k, v in msg.items()}
+            headers={k: v for k, v in msg.items()},
+            attachment_parts=attachment_parts,
+            related_parts=related_parts,
+            **EMLParser._header_fields(msg)
         )
+    
+    @staticmethod
+    def _estimate_payload_size(part: email.message.Message) -> int:
+        """Estimate the decoded size of a part from its encoded payload."""
+        payload = part.get_payload()
+        if not isinstance(payload, str):
+            return 0
+        
+        encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+        if encoding == 'base64':
+            # 4 characters carry 3 bytes; line breaks and padding carry nothing
+            chars = len(payload) - payload.count('\n') - payload.count('\r')
+            padding = payload[-8:].rstrip().count('=')
+            return max(0, chars * 3 // 4 - padding)
+        if encoding == 'quoted-printable':
+            # "=XX" is one byte and "=\n" soft breaks vanish
+            soft_breaks = payload.count('=\n')
+            escapes = payload.count('=') - soft_breaks
+            return max(0, len(payload) - 2 * escapes - 2 * soft_breaks)
+        return len(payload)
 
 
 class MSGParser:
@@ -398,311 +698,3365 @@ class MSGParser:
             raise
 
 
+# mboxrd escapes body lines starting with "From " as ">From "; one ">" is removed on read
+_ESCAPED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
+_NON_BLANK = re.compile(rb'\S')
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+
 class MBOXParser:
     """Parse MBOX format emails (Thunderbird/Unix)."""
     
     logger = logging.getLogger('mail2pdf.mbox')
     
+    # Bytes handed to the email parser per feed() call
+    FEED_CHUNK = 64 * 1024
+    
     @staticmethod
     def parse(file_path: Path) -> List[EmailMessage]:
         """Parse MBOX file and return list of EmailMessages."""
-        messages = []
+        return list(MBOXParser.iter_messages(file_path))
+    
+    @staticmethod
+    def iter_messages(file_path: Path) -> Iterator[EmailMessage]:
+        """
+        Stream EmailMessages out of an MBOX file one at a time.
         
+        Each message is parsed from its own slice of the memory-mapped
+        file, so charsets are resolved per MIME part and peak memory
+        follows the largest single message rather than the mailbox.
+        """
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            # Split by "From " line (MBOX format)
-            text = EncodingManager.detect_and_decode(content)
-            entries = text.split('\nFrom ')
-            
-            for entry in entries:
-                if not entry.strip():
-                    continue
-                
-                # Reconstruct RFC 2822 message
-                if not entry.startswith('From '):
-                    entry = 'From ' + entry
-                
+            for _offset, view in MBOXParser.iter_entry_views(file_path):
                 try:
-                    msg = Parser().parsestr(entry)
-                    messages.append(EMLParser._extract_message(msg))
+                    yield EMLParser._extract_message(MBOXParser.parse_raw(view))
                 except Exception as e:
                     MBOXParser.logger.warning(f"Failed to parse MBOX entry: {e}")
         
-        except Exception as e:
+        except OSError as e:
             MBOXParser.logger.error(f"Error parsing MBOX {file_path}: {e}")
             raise
+    
+    @staticmethod
+    def iter_raw_messages(file_path: Path) -> Iterator[bytes]:
+        """
+        Yield the raw bytes of each message, split on From_ lines.
         
-        return messages
-
-
-# ============================================================================
-# PDF GENERATION
-# ============================================================================
-
-class PDFGenerator:
-    """Generate PDF from email content with WeasyPrint and fallback."""
+        The From_ envelope line is kept so the parser can record it as the
+        unixfrom; the blank separator line before the next message is dropped.
+        """
+        for _offset, raw in MBOXParser.iter_raw_entries(file_path):
+            yield raw
     
-    logger = logging.getLogger('mail2pdf.pdf')
+    @staticmethod
+    def iter_raw_entries(file_path: Path, start: int = 0,
+                         end: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        """Yield (byte offset, raw bytes) for each message in [start, end)."""
+        for offset, view in MBOXParser.iter_entry_views(file_path, start, end):
+            yield offset, bytes(view)
     
     @staticmethod
-    def generate(email_msg: EmailMessage, output_path: Path, options: Dict = None) -> bool:
+    def iter_entry_views(file_path: Path, start: int = 0,
+                         end: Optional[int] = None) -> Iterator[Tuple[int, memoryview]]:
         """
-        Generate PDF from email message.
+        Yield (byte offset, memoryview) for each message in [start, end).
         
-        Returns:
-            True if successful, False otherwise
+        Boundaries are found by searching the memory-mapped file for
+        ``\\nFrom `` so scanning never copies the mailbox into the Python
+        heap; each view is a zero-copy slice of the mapping.
         """
-        options = options or {}
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        
+        view = memoryview(mm)
         try:
-            html_content = PDFGenerator._create_html(email_msg, options)
+            for offset, length in MBOXParser._iter_spans(mm, start, end):
+                yield offset, view[offset:offset + length]
+        finally:
+            view.release()
+            try:
+                mm.close()
+            except BufferError:
+                pass  # a caller still holds a slice; the mapping goes with it
+    
+    @staticmethod
+    def count_messages(file_path: Path, start: int = 0, end: Optional[int] = None) -> int:
+        """Count messages in [start, end) without materialising any of them."""
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return sum(1 for _ in MBOXParser._iter_spans(mm, start, end))
+    
+    @staticmethod
+    def _iter_spans(mm: mmap.mmap, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        """Yield (offset, length) of each non-blank message in mm[start:end]."""
+        offset = start
+        while offset < end:
+            separator = mm.find(b'\nFrom ', offset, end)
+            stop = end if separator < 0 else separator + 1
             
-            # Try WeasyPrint first
-            if HTML is not None:
-                try:
-                    HTML(string=html_content).write_pdf(str(output_path))
-                    PDFGenerator.logger.info(f"PDF generated: {output_path}")
-                    return True
-                except Exception as e:
-                    PDFGenerator.logger.warning(f"WeasyPrint failed: {e}, trying fallback")
+            # Drop the blank line that separates this message from the next
+            length = stop - offset
+            if length >= 2 and mm[stop - 2:stop] == b'\n\n':
+                length -= 1
+            elif length >= 3 and mm[stop - 3:stop] == b'\n\r\n':
+                length -= 2
             
-            # Fallback: basic PDF generation (simplified)
-            PDFGenerator.logger.warning("WeasyPrint not available, using text-based fallback")
-            PDFGenerator._generate_text_pdf(html_content, output_path)
-            return True
+            if _NON_BLANK.search(mm, offset, offset + length):
+                yield offset, length
+            offset = stop
+    
+    @staticmethod
+    def parse_raw(raw: Union[bytes, memoryview]) -> email.message.Message:
+        """
+        Parse one raw MBOX entry, undoing mboxrd ``>From`` escaping.
         
-        except Exception as e:
-            PDFGenerator.logger.error(f"PDF generation failed for {output_path}: {e}")
-            return False
+        Unescaped entries are fed to the parser straight from the buffer in
+        chunks, so a memoryview over the mapping is never copied whole.
+        """
+        parser = FeedParser()
+        
+        if _ESCAPED_FROM.search(raw) is None:
+            for pos in range(0, len(raw), MBOXParser.FEED_CHUNK):
+                parser.feed(str(raw[pos:pos + MBOXParser.FEED_CHUNK], 'ascii', 'surrogateescape'))
+            return parser.close()
+        
+        # Escaped lines exist: unescape line-aligned chunks so a ">From" is never split
+        remainder = b''
+        for pos in range(0, len(raw), MBOXParser.FEED_CHUNK):
+            chunk = remainder + bytes(raw[pos:pos + MBOXParser.FEED_CHUNK])
+            cut = chunk.rfind(b'\n') + 1
+            chunk, remainder = chunk[:cut], chunk[cut:]
+            parser.feed(str(_ESCAPED_FROM.sub(rb'\1', chunk), 'ascii', 'surrogateescape'))
+        parser.feed(str(_ESCAPED_FROM.sub(rb'\1', remainder), 'ascii', 'surrogateescape'))
+        return parser.close()
     
     @staticmethod
-    def _create_html(email_msg: EmailMessage, options: Dict = None) -> str:
-        """Create HTML representation of email for PDF."""
-        options = options or {}
-        page_size = options.get('page_size', 'A4')
-        orientation = options.get('orientation', 'portrait')
-        
-        recipients_html = ', '.join(email_msg.recipients) if email_msg.recipients else 'No recipients'
-        cc_html = ', '.join(email_msg.cc) if email_msg.cc else 'None'
-        
-        body_html = email_msg.html_body or f"<pre>{email_msg.body}</pre>"
-        
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                @page {{
-                    size: {page_size} {orientation};
-                    margin: 2cm;
-                }}
-                body {{
-                    font-family: 'Segoe UI', Arial, sans-serif;
-                    max-width: 900px;
-                    margin: 0 auto;
-                    padding: 20px;
-                    background-color: #f5f5f5;
-                    color: #333;
-                }}
-                .email-container {{
-                    background-color: white;
-                    border: 1px solid #ddd;
-                    border-radius: 5px;
-                    padding: 20px;
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                }}
-                .header {{
-                    border-bottom: 2px solid #0088CC;
-                    padding-bottom: 15px;
-                    margin-bottom: 15px;
-                }}
-                .header-title {{
-                    color: #0088CC;
-                    font-size: 18px;
-                    font-weight: bold;
-                    margin: 0 0 10px 0;
-                }}
-                .header-meta {{
-                    display: grid;
-                    grid-template-columns: 100px 1fr;
-                    gap: 10px;
-                    font-size: 13px;
-                    color: #666;
-                }}
-                .meta-label {{
-                    font-weight: bold;
-                    color: #0088CC;
-                }}
-                .body {{
-                    margin-top: 15px;
-                    line-height: 1.6;
-                }}
-                .footer {{
-                    margin-top: 20px;
-                    border-top: 1px solid #ddd;
-                    padding-top: 10px;
-                    font-size: 11px;
-                    color: #999;
-                }}
-                pre {{
-                    background-color: #f9f9f9;
-                    padding: 10px;
-                    border-radius: 3px;
-                    overflow-x: auto;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="header">
-                    <div class="header-title">{email_msg.subject}</div>
-                    <div class="header-meta">
-                        <div class="meta-label">From:</div>
-                        <div>{email_msg.sender}</div>
-                        <div class="meta-label">To:</div>
-                        <div>{recipients_html}</div>
-                        <div class="meta-label">CC:</div>
-                        <div>{cc_html}</div>
-                        <div class="meta-label">Date:</div>
-                        <div>{email_msg.date}</div>
-                        <div class="meta-label">Attachments:</div>
-                        <div>{len(email_msg.attachments or [])} file(s)</div>
-                    </div>
-                </div>
-                <div class="body">
-                    {body_html}
-                </div>
-                <div class="footer">
-                    Generated by Mail2PDF NextGen | Ville de Fontaine 38600
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return html
-    
-    @staticmethod
-    def _generate_text_pdf(html_content: str, output_path: Path) -> None:
-        """Fallback: simple text-to-PDF conversion."""
-        try:
-            from reportlab.pdfgen import canvas
-            from reportlab.lib.pagesizes import letter
-            from reportlab.lib.units import inch
-            
-            # Create simple text content from HTML
-            import re
-            text_content = re.sub('<[^<]+?>', '', html_content)
-            
-            c = canvas.Canvas(str(output_path), pagesize=letter)
-            width, height = letter
-            
-            x = inch
-            y = height - inch
-            
-            for line in text_content.split('\n')[:100]:  # Limit to first 100 lines
-                if y < inch:
-                    c.showPage()
-                    y = height - inch
-                c.drawString(x, y, line[:100])  # Limit line length
-                y -= 12
-            
-            c.save()
+    def shard_ranges(file_path: Path, shards: int) -> List[Tuple[int, int]]:
+        """
+        Split a mailbox into about ``shards`` byte ranges aligned on From_ lines.
         
-        except ImportError:
-            # No fallback available
-            raise Exception("WeasyPrint and ReportLab not available")
-
-
-# ============================================================================
-# EMAIL CONVERTER - MAIN CLASS
-# ============================================================================
-
-class EmailConverter:
-    """Main email to PDF converter with multi-format support."""
+        Only the bytes around each cut point are read, so sharding costs
+        a few seeks regardless of the mailbox size.
+        """
+        size = Path(file_path).stat().st_size
+        cuts = [0]
+        
+        with open(file_path, 'rb') as f:
+            for n in range(1, max(shards, 1)):
+                target = size * n // shards
+                if target <= cuts[-1]:
+                    continue
+                boundary = MBOXParser._next_boundary(f, target)
+                if boundary is None:
+                    break
+                if boundary > cuts[-1]:
+                    cuts.append(boundary)
+        
+        cuts.append(size)
+        return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
     
-    def __init__(self, config: Dict = None):
+    @staticmethod
+    def _next_boundary(f, position: int) -> Optional[int]:
+        """Offset of the first From_ line starting at or after ``position``."""
+        f.seek(position - 1)
+        f.readline()  # finish the line that straddles the cut
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                return None
+            if line.startswith(b'From '):
+                return offset
+    
+    @staticmethod
+    def load_index(file_path: Path) -> 'MBOXIndex':
+        """Load the sidecar index of a mailbox, updating it if needed."""
+        index = MBOXIndex(file_path)
+        index.refresh()
+        return index
+    
+    @staticmethod
+    def read_message(file_path: Path, position: int) -> EmailMessage:
+        """Parse message number ``position`` by seeking through the index."""
+        return MBOXParser.load_index(file_path).message(position)
+    
+    @staticmethod
+    def iter_spans(file_path: Path, spans: Iterable[Tuple[int, int, int]]) -> Iterator[Tuple[int, Union[EmailMessage, Exception]]]:
         """
-        Initialize converter with optional configuration.
+        Parse the messages at the given (index, offset, length) spans.
         
-        Args:
-            config: Optional configuration dictionary
+        Yields:
+            (index, EmailMessage) or (index, Exception) when parsing fails
         """
-        self.config = config or {}
-        self.logger = logging.getLogger('mail2pdf.converter')
-        self.detector = EmailTypeDetector()
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for index, offset, length in spans:
+                        try:
+                            yield index, EMLParser._extract_message(
+                                MBOXParser.parse_raw(view[offset:offset + length]))
+                        except Exception as e:
+                            yield index, e
+                finally:
+                    view.release()
     
-    def convert_email(self, input_path: str, output_dir: str = './output', options: Optional[Dict] = None) -> Optional[str]:
+    @staticmethod
+    def thread_groups(file_path: Path) -> List[List[Tuple[int, int, int]]]:
         """
-        Convert single email file to PDF.
+        Group the messages of a mailbox by conversation, from headers only.
+        
+        A message joins the thread of the first References entry, or else
+        In-Reply-To, found in the mailbox; messages without either are
+        grouped by normalized subject only when they carry no Message-ID.
         
-        Args:
-            input_path: Path to email file
-            output_dir: Output directory for PDF
-            options: Optional conversion options
-            
         Returns:
-            Path to generated PDF or None on failure
+            Threads in order of first message, each a list of (index,
+            offset, length) spans in mailbox order
         """
-        options = options or {}
-        input_file = Path(input_path)
-        output_dir_path = Path(output_dir)
-        output_dir_path.mkdir(parents=True, exist_ok=True)
+        spans = []
+        parents: Dict[str, str] = {}
+        keys = []
+        for index, (offset, view) in enumerate(MBOXParser.iter_entry_views(file_path)):
+            end = _HEADER_END.search(view)
+            headers = BytesHeaderParser().parsebytes(bytes(view if end is None else view[:end.start() + 1]))
+            message_id = str(headers.get('Message-ID', '') or '').strip()
+            references = str(headers.get('References', '') or '').split()
+            parent = references[0] if references else str(headers.get('In-Reply-To', '') or '').strip()
+            if message_id and parent and parent != message_id:
+                parents.setdefault(message_id, parent)
+            if message_id:
+                keys.append(message_id)
+            else:
+                subject = re.sub(r'^\s*((re|fwd?|tr|aw)\s*:\s*)+', '', str(headers.get('Subject', '')),
+                                 flags=re.IGNORECASE)
+                keys.append(parent or f"subject:{subject.strip().lower()}")
+            spans.append((index, offset, len(view)))
         
-        if not input_file.exists():
-            self.logger.error(f"Input file not found: {input_path}")
-            return None
+        def root(key: str) -> str:
+            seen = set()
+            while key in parents and key not in seen:
+                seen.add(key)
+                key = parents[key]
+            return key
         
-        # Detect format
-        format_type = self.detector.detect_format(input_file)
-        self.logger.info(f"Detected format: {format_type}")
+        threads: Dict[str, List[Tuple[int, int, int]]] = {}
+        for key, span in zip(keys, spans):
+            threads.setdefault(root(key), []).append(span)
+        return list(threads.values())
+
+
+class MBOXIndex:
+    """
+    Persistent byte-offset index stored next to an MBOX file.
+    
+    The sidecar records offset, length, Message-ID, Date and a subject
+    hash per message. On refresh, a mailbox that only grew is scanned
+    from its last indexed message; any other change (truncation, rewritten
+    head or tail) discards the index and rebuilds it from scratch.
+    """
+    
+    VERSION = 1
+    SUFFIX = '.m2pidx'
+    FINGERPRINT_SIZE = 4096
+    
+    logger = logging.getLogger('mail2pdf.mbox.index')
+    
+    def __init__(self, mbox_path: Path):
+        self.mbox_path = Path(mbox_path)
+        self.index_path = Path(str(self.mbox_path) + self.SUFFIX)
+        self.entries: List[Dict[str, Any]] = []
+        self.size = 0
+        self.converted = 0
+        self.head_hash = ''
+        self.tail_hash = ''
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def refresh(self) -> int:
+        """
+        Bring the index in line with the mailbox on disk.
         
-        try:
-            # Parse email
-            if format_type == 'msg':
+        Returns:
+            Number of messages added since the index was last saved
+        """
+        known = self._load()
+        current_size = self.mbox_path.stat().st_size
+        
+        if known and current_size == self.size:
+            return 0
+        
+        if known:
+            # Re-read the last message: it may have grown with the append
+            start = self.entries.pop()['offset']
+        else:
+            self.entries = []
+            self.converted = 0
+            start = 0
+        
+        for offset, view in MBOXParser.iter_entry_views(self.mbox_path, start):
+            self.entries.append(self._describe(offset, view))
+        
+        self.size = current_size
+        self.head_hash, self.tail_hash = self._fingerprint(current_size)
+        self.converted = min(self.converted, len(self.entries))
+        self.save()
+        return len(self.entries) - known
+    
+    def read_raw(self, position: int) -> bytes:
+        """Read the raw bytes of message ``position`` without scanning."""
+        entry = self.entries[position]
+        with open(self.mbox_path, 'rb') as f:
+            f.seek(entry['offset'])
+            return f.read(entry['length'])
+    
+    def message(self, position: int) -> EmailMessage:
+        """Parse message ``position`` into an EmailMessage."""
+        return EMLParser._extract_message(MBOXParser.parse_raw(self.read_raw(position)))
+    
+    def mark_converted(self, count: int) -> None:
+        """Record that the first ``count`` messages have been converted."""
+        self.converted = max(self.converted, min(count, len(self.entries)))
+        self.save()
+    
+    def save(self) -> None:
+        """Write the sidecar atomically; failures only cost a rescan."""
+        data = {
+            'version': self.VERSION,
+            'size': self.size,
+            'head_hash': self.head_hash,
+            'tail_hash': self.tail_hash,
+            'converted': self.converted,
+            'messages': self.entries
+        }
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            self.logger.warning(f"Could not write MBOX index {self.index_path}: {e}")
+    
+    def _load(self) -> int:
+        """Load a still-valid sidecar and return its message count (0 if none)."""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        
+        if data.get('version') != self.VERSION or not data.get('messages'):
+            return 0
+        
+        size = data.get('size', 0)
+        try:
+            current_size = self.mbox_path.stat().st_size
+        except OSError:
+            return 0
+        
+        # A shrunken file or changed fingerprint means the mailbox was rewritten
+        if current_size < size or self._fingerprint(size) != (data.get('head_hash'), data.get('tail_hash')):
+            self.logger.info(f"MBOX {self.mbox_path.name} was rewritten, rebuilding index")
+            return 0
+        
+        self.entries = data['messages']
+        self.size = size
+        self.converted = data.get('converted', 0)
+        self.head_hash = data['head_hash']
+        self.tail_hash = data['tail_hash']
+        return len(self.entries)
+    
+    def _fingerprint(self, size: int) -> Tuple[str, str]:
+        """Hash the first and last bytes of the indexed region."""
+        with open(self.mbox_path, 'rb') as f:
+            head = f.read(min(size, self.FINGERPRINT_SIZE))
+            f.seek(max(0, size - self.FINGERPRINT_SIZE))
+            tail = f.read(min(size, self.FINGERPRINT_SIZE))
+        return hashlib.sha256(head).hexdigest(), hashlib.sha256(tail).hexdigest()
+    
+    @staticmethod
+    def _describe(offset: int, raw: Union[bytes, memoryview]) -> Dict[str, Any]:
+        """Build the index entry of one message from its header block."""
+        end = _HEADER_END.search(raw)
+        headers = BytesHeaderParser().parsebytes(bytes(raw if end is None else raw[:end.start() + 1]))
+        subject = str(headers.get('Subject', ''))
+        return {
+            'offset': offset,
+            'length': len(raw),
+            'message_id': str(headers.get('Message-ID', '') or '').strip() or None,
+            'date': str(headers.get('Date', '') or '') or None,
+            'subject_hash': hashlib.sha1(subject.encode('utf-8', 'replace')).hexdigest()[:16]
+        }
+
+
+# ============================================================================
+# PDF ASSEMBLY
+# ============================================================================
+
+class PDFStreamWriter:
+    """
+    Write a PDF object by object, straight to disk.
+    
+    Only object offsets, page references and outline entries stay in
+    memory, so a document of any number of messages can be assembled.
+    Pages come from the text engine (add_page) or are copied out of other
+    PDFs (import_pdf, which needs pypdf); file attachments are streamed
+    in (embed_file).
+    """
+    
+    # Fixed object numbers
+    CATALOG, PAGES, INFO = 1, 2, 3
+    
+    def __init__(self, output_path: Union[str, Path], compress: Optional[bool] = None):
+        self.path = Path(output_path)
+        self.compress = bool(PDF_CONFIG.get('compression', True) if compress is None else compress)
+        self.pages: List[int] = []
+        # Per-document state of page producers (e.g. the text engine's fonts)
+        self.resources: Dict[str, Any] = {}
+        self._offsets: Dict[int, int] = {}
+        self._count = self.INFO
+        # Bookmarks as (title, destination, children), destinations serialised
+        self.outline: List[Tuple[str, str, list]] = []
+        self._embedded: Dict[str, int] = {}
+        # Named destinations of imported documents: (sort key, name, destination)
+        self._dests: List[Tuple[bytes, bytes, bytes]] = []
+        self._finalizers: List[Any] = []
+        self._file = open(self.path, 'wb')
+        self._file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    
+    def reserve(self) -> int:
+        """Allocate an object number to be written later."""
+        self._count += 1
+        return self._count
+    
+    def write(self, number: int, body: bytes) -> None:
+        """Write object ``number`` at the current position."""
+        self._offsets[number] = self._file.tell()
+        self._file.write(f"{number} 0 obj\n".encode('ascii') + body + b"\nendobj\n")
+    
+    def add(self, body: bytes) -> int:
+        """Write a new object and return its number."""
+        number = self.reserve()
+        self.write(number, body)
+        return number
+    
+    def stream(self, data: bytes, extra: str = '') -> bytes:
+        """Stream object body, deflated when compression is on."""
+        if self.compress:
+            data = zlib.compress(data)
+            extra += ' /Filter /FlateDecode'
+        return f"<< /Length {len(data)}{extra} >>\nstream\n".encode('ascii') + data + b"\nendstream"
+    
+    def add_page(self, content: bytes, resources: str, width: float, height: float) -> int:
+        """Append a page drawn by ``content`` and return its object number."""
+        content_ref = self.add(self.stream(content))
+        page = self.add((
+            f"<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {width:.2f} {height:.2f}] "
+            f"/Resources {resources} /Contents {content_ref} 0 R >>").encode('ascii'))
+        self.pages.append(page)
+        return page
+    
+    def add_image_page(self, data: bytes, pixel_size: Tuple[int, int], color_space: str, filter_name: str,
+                       page_size: Tuple[float, float], margin: float, decode: str = '',
+                       smask: Optional[bytes] = None) -> int:
+        """
+        Append a page showing one encoded image, centred at the top.
+        
+        The image is scaled down to fit inside ``margin``, and never shown
+        larger than at 96 DPI. ``smask`` is an optional deflated 8-bit alpha
+        channel.
+        """
+        pixel_width, pixel_height = pixel_size
+        header = (f"<< /Type /XObject /Subtype /Image /Width {pixel_width} /Height {pixel_height} "
+                  f"/BitsPerComponent 8")
+        mask = ''
+        if smask is not None:
+            mask_ref = self.add((f"{header} /ColorSpace /DeviceGray /Filter /FlateDecode /Length {len(smask)} >>"
+                                 f"\nstream\n").encode('ascii') + smask + b"\nendstream")
+            mask = f" /SMask {mask_ref} 0 R"
+        image = self.add((f"{header} /ColorSpace /{color_space} /Filter /{filter_name}{decode}{mask} "
+                          f"/Length {len(data)} >>\nstream\n").encode('ascii') + data + b"\nendstream")
+        
+        width, height = page_size
+        scale = min((width - 2 * margin) / pixel_width, (height - 2 * margin) / pixel_height, 72 / 96)
+        shown_width, shown_height = pixel_width * scale, pixel_height * scale
+        x, y = (width - shown_width) / 2, height - margin - shown_height
+        content = f"q {shown_width:.2f} 0 0 {shown_height:.2f} {x:.2f} {y:.2f} cm /Im1 Do Q".encode('ascii')
+        return self.add_page(content, f"<< /XObject << /Im1 {image} 0 R >> >>", width, height)
+    
+    def add_outline(self, title: str, page: int) -> None:
+        """Add a top-level bookmark pointing at ``page``."""
+        self.outline.append((title, f"[{page} 0 R /XYZ null null null]", []))
+    
+    def embed_file(self, name: str, chunks: Iterable[bytes], mime_type: str = 'application/octet-stream',
+                   description: Optional[str] = None) -> str:
+        """
+        Stream ``chunks`` into a file attachment of the document.
+        
+        The content is deflated as it is written; its length and checksum
+        follow as separate objects once known.
+        
+        Returns:
+            The attachment name, made unique within the document
+        """
+        unique, copy = name, 1
+        while unique in self._embedded:
+            copy += 1
+            stem, suffix = os.path.splitext(name)
+            unique = f"{stem} ({copy}){suffix}"
+        
+        number, length_ref, params_ref = self.reserve(), self.reserve(), self.reserve()
+        subtype = re.sub(r'[^A-Za-z0-9.+-]', lambda m: f"#{ord(m.group(0)):02X}", mime_type)
+        filters = ' /Filter /FlateDecode' if self.compress else ''
+        self._offsets[number] = self._file.tell()
+        self._file.write((f"{number} 0 obj\n<< /Type /EmbeddedFile /Subtype /{subtype} /Length {length_ref} 0 R "
+                          f"/Params {params_ref} 0 R{filters} >>\nstream\n").encode('ascii'))
+        start = self._file.tell()
+        compressor = zlib.compressobj() if self.compress else None
+        checksum = hashlib.md5()
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            checksum.update(chunk)
+            self._file.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            self._file.write(compressor.flush())
+        length = self._file.tell() - start
+        self._file.write(b"\nendstream\nendobj\n")
+        self.write(length_ref, str(length).encode('ascii'))
+        self.write(params_ref, f"<< /Size {size} /CheckSum <{checksum.hexdigest().upper()}> >>".encode('ascii'))
+        
+        spec = f"<< /Type /Filespec /F {self.pdf_string(unique)} /UF {self.pdf_string(unique)} /EF << /F {number} 0 R >>"
+        if description:
+            spec += f" /Desc {self.pdf_string(description)}"
+        self._embedded[unique] = self.add((spec + " >>").encode('ascii'))
+        return unique
+    
+    def on_close(self, finalizer: Any) -> None:
+        """Run ``finalizer()`` before the page tree is written (e.g. to embed fonts)."""
+        self._finalizers.append(finalizer)
+    
+    def import_pdf(self, source: Union[str, Path], navigation: bool = False) -> List[int]:
+        """
+        Copy every page of ``source``, with what it references, into this PDF.
+        
+        Args:
+            source: PDF file to import
+            navigation: Also carry over its outline, appended to this
+                document's, and its named destinations (what internal
+                links point at)
+        
+        Returns:
+            Object numbers of the imported pages
+        """
+        if pypdf is None:
+            raise ImportError("pypdf module required to merge rendered PDFs")
+        
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+        reader = pypdf.PdfReader(str(source))
+        if reader.is_encrypted and not reader.decrypt(''):
+            raise ValueError(f"{source} is encrypted")
+        numbers: Dict[Tuple[int, int], int] = {}
+        pending: List[Any] = []
+        
+        def remap(obj: Any, skip: Tuple[str, ...] = ()) -> Any:
+            if isinstance(obj, IndirectObject):
+                key = (obj.idnum, obj.generation)
+                if key not in numbers:
+                    numbers[key] = self.reserve()
+                    pending.append(key)
+                return IndirectObject(numbers[key], 0, None)  # type: ignore
+            if isinstance(obj, DictionaryObject):
+                # Same class and stream data, references renumbered
+                copied = obj.__class__.__new__(obj.__class__)
+                copied.__dict__.update(obj.__dict__)
+                for key, value in dict.items(obj):
+                    if key not in skip:
+                        dict.__setitem__(copied, key, remap(value))
+                return copied
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(remap(value) for value in list.__iter__(obj))
+            return obj
+        
+        # Pages come flattened (inherited resources and boxes resolved) and
+        # are re-parented; the source page tree itself is never copied
+        pages = {}
+        imported = []
+        for page in reader.pages:
+            reference = page.indirect_reference
+            pages[(reference.idnum, reference.generation)] = page
+            imported.append(remap(reference).idnum)
+        
+        def serialise(obj: Any) -> bytes:
+            buffer = io.BytesIO()
+            remap(obj).write_to_stream(buffer)
+            return buffer.getvalue()
+        
+        if navigation:
+            catalog = reader.trailer['/Root']
+            self.outline.extend(self._imported_outline(catalog.get('/Outlines'), serialise))
+            names = catalog.get('/Names')
+            for name, dest in self._imported_dests(names.get_object().get('/Dests') if names else None):
+                key = getattr(name, 'original_bytes', None) or str(name).encode('utf-8')
+                buffer = io.BytesIO()
+                name.write_to_stream(buffer)
+                self._dests.append((key, buffer.getvalue(), serialise(dest)))
+        
+        while pending:
+            key = pending.pop()
+            if key in pages:
+                copied = remap(pages[key], skip=('/Parent',))
+                dict.__setitem__(copied, NameObject('/Parent'), IndirectObject(self.PAGES, 0, None))
+            else:
+                copied = remap(reader.get_object(IndirectObject(key[0], key[1], reader)))
+            buffer = io.BytesIO()
+            copied.write_to_stream(buffer)
+            self.write(numbers[key], buffer.getvalue())
+        
+        self.pages.extend(imported)
+        return imported
+    
+    @classmethod
+    def _imported_outline(cls, node: Any, serialise: Any) -> List[Tuple[str, str, list]]:
+        """Outline items under ``node`` of a pypdf document, destinations serialised."""
+        items: List[Tuple[str, str, list]] = []
+        item = node.get_object().get('/First') if node is not None else None
+        seen = set()
+        while item is not None and id(item.get_object()) not in seen:
+            item = item.get_object()
+            seen.add(id(item))
+            dest = item.get('/Dest')
+            action = item.get('/A')
+            if dest is None and action is not None and action.get_object().get('/S') == '/GoTo':
+                dest = action.get_object().get('/D')
+            if dest is not None:
+                title = item.get('/Title')
+                items.append((str(title.get_object()) if title is not None else '',
+                              serialise(dest).decode('latin-1'), cls._imported_outline(item, serialise)))
+            item = item.get('/Next')
+        return items
+    
+    @classmethod
+    def _imported_dests(cls, node: Any) -> Iterator[Tuple[Any, Any]]:
+        """(name, destination) pairs of a pypdf name tree."""
+        if node is None:
+            return
+        node = node.get_object()
+        names = node.get('/Names')
+        names = names.get_object() if names is not None else []
+        for i in range(0, len(names) - 1, 2):
+            yield names[i].get_object(), names[i + 1]
+        kids = node.get('/Kids')
+        for kid in (kids.get_object() if kids is not None else []):
+            yield from cls._imported_dests(kid)
+    
+    def _write_outline(self, items: List[Tuple[str, str, list]], parent: int) -> Tuple[int, int, int]:
+        """Write ``items`` under ``parent``; return first, last and descendant count."""
+        numbers = [self.reserve() for _ in items]
+        count = len(items)
+        for i, (title, dest, children) in enumerate(items):
+            links = f" /Prev {numbers[i - 1]} 0 R" if i else ''
+            links += f" /Next {numbers[i + 1]} 0 R" if i + 1 < len(items) else ''
+            if children:
+                first, last, descendants = self._write_outline(children, numbers[i])
+                links += f" /First {first} 0 R /Last {last} 0 R /Count {descendants}"
+                count += descendants
+            self.write(numbers[i], (f"<< /Title {self.pdf_string(title)} /Parent {parent} 0 R{links} "
+                                    f"/Dest {dest} >>").encode('latin-1'))
+        return numbers[0], numbers[-1], count
+    
+    def close(self, info: Optional[Dict[str, str]] = None) -> None:
+        """Write the page tree, outline, info and cross-reference table."""
+        for finalizer in self._finalizers:
+            finalizer()
+        
+        catalog = f"<< /Type /Catalog /Pages {self.PAGES} 0 R"
+        if self.outline:
+            root = self.reserve()
+            first, last, count = self._write_outline(self.outline, root)
+            self.write(root, f"<< /Type /Outlines /First {first} 0 R /Last {last} 0 R /Count {count} >>".encode('ascii'))
+            catalog += f" /Outlines {root} 0 R /PageMode /UseOutlines"
+        trees = []
+        if self._dests:
+            # Name tree keys sort by their bytes; the first of duplicate names wins
+            dests: Dict[bytes, Tuple[bytes, bytes]] = {}
+            for key, name, dest in self._dests:
+                dests.setdefault(key, (name, dest))
+            tree = self.add(b"<< /Names [" + b' '.join(name + b' ' + dest for _, (name, dest) in sorted(dests.items()))
+                            + b"] >>")
+            trees.append(f"/Dests {tree} 0 R")
+        if self._embedded:
+            names = sorted(self._embedded.items(), key=lambda item: item[0].encode('utf-16-be'))
+            tree = self.add(("<< /Names [" + ' '.join(f"{self.pdf_string(name)} {spec} 0 R" for name, spec in names)
+                             + "] >>").encode('ascii'))
+            trees.append(f"/EmbeddedFiles {tree} 0 R")
+        if trees:
+            catalog += f" /Names << {' '.join(trees)} >>"
+        
+        self.write(self.PAGES, (f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in self.pages)}] "
+                                f"/Count {len(self.pages)} >>").encode('ascii'))
+        self.write(self.CATALOG, (catalog + " >>").encode('ascii'))
+        info = dict(info or {}, Producer='Mail2PDF NextGen')
+        self.write(self.INFO, ("<< " + ' '.join(f"/{k} {self.pdf_string(str(v))}" for k, v in info.items())
+                               + " >>").encode('ascii'))
+        
+        xref = self._file.tell()
+        entries = ["0000000000 65535 f \n"]
+        for number in range(1, self._count + 1):
+            offset = self._offsets.get(number)
+            entries.append(f"{offset:010d} 00000 n \n" if offset is not None else "0000000000 65535 f \n")
+        self._file.write(f"xref\n0 {self._count + 1}\n{''.join(entries)}".encode('ascii'))
+        self._file.write((f"trailer\n<< /Size {self._count + 1} /Root {self.CATALOG} 0 R "
+                          f"/Info {self.INFO} 0 R >>\nstartxref\n{xref}\n%%EOF\n").encode('ascii'))
+        self._file.close()
+    
+    def abort(self) -> None:
+        """Give up on the document and remove the partial file."""
+        self._file.close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+    
+    @staticmethod
+    def pdf_string(value: str) -> str:
+        """PDF text string (UTF-16BE hex) for titles and document info."""
+        return '<FEFF' + value.encode('utf-16-be').hex().upper() + '>'
+
+
+# ============================================================================
+# TEXT PDF ENGINE
+# ============================================================================
+
+class TextFont:
+    """
+    Metrics and encoding of the font used by the text engine.
+    
+    Wraps an embeddable TrueType font (glyph ids through Identity-H) or,
+    when none is available, the base-14 Courier fonts in WinAnsiEncoding.
+    """
+    
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.embedded = path is not None
+        self._char_widths: Dict[str, float] = {}
+        # Last subset program and its glyphs, reused by every document it covers
+        self._subset_cache: Tuple[frozenset, bytes] = (frozenset(), b'')
+        self._subset_lock = threading.Lock()
+        self.subset_stats = {'hits': 0, 'misses': 0}
+        self.common_gids: frozenset = frozenset()
+        if not self.embedded:
+            self.name = 'Courier'
+            self.fixed_pitch = True
+            return
+        
+        self.data = Path(path).read_bytes()
+        font = TTFont(io.BytesIO(self.data), lazy=True)
+        if 'glyf' not in font:
+            raise ValueError(f"{path} has no TrueType outlines")
+        scale = 1000.0 / font['head'].unitsPerEm
+        order = font.getGlyphOrder()
+        metrics = font['hmtx'].metrics
+        gids = {name: gid for gid, name in enumerate(order)}
+        self.cmap = {cp: gids.get(name, 0) for cp, name in font.getBestCmap().items()}
+        self.widths = [metrics[name][0] * scale if name in metrics else 0.0 for name in order]
+        head, hhea = font['head'], font['hhea']
+        self.bbox = [round(v * scale) for v in (head.xMin, head.yMin, head.xMax, head.yMax)]
+        self.ascent = round(hhea.ascent * scale)
+        self.descent = round(hhea.descent * scale)
+        os2 = font['OS/2'] if 'OS/2' in font else None
+        cap_height = getattr(os2, 'sCapHeight', 0) if os2 is not None else 0
+        self.cap_height = round(cap_height * scale) if cap_height else self.ascent
+        self.italic_angle = float(font['post'].italicAngle)
+        self.fixed_pitch = bool(font['post'].isFixedPitch)
+        name = font['name'].getDebugName(6) or Path(path).stem
+        self.name = re.sub(r'[^A-Za-z0-9_-]', '', name) or 'Font'
+        # Latin-1 and common typography: included up front in shared subsets
+        common = ''.join(map(chr, range(0x20, 0x7f))) + ''.join(map(chr, range(0xa0, 0x100))) + '€–—‘’‚“”„…•«»œŒ'
+        self.common_gids = frozenset(self.cmap[ord(c)] for c in common if ord(c) in self.cmap)
+    
+    def char_width(self, char: str) -> float:
+        """Advance width of ``char`` in 1/1000 em."""
+        width = self._char_widths.get(char)
+        if width is None:
+            width = self.widths[self.cmap.get(ord(char), 0)] if self.embedded else 600.0
+            self._char_widths[char] = width
+        return width
+    
+    def text_width(self, text: str, size: float) -> float:
+        return sum(self.char_width(c) for c in text) * size / 1000.0
+    
+    def covers(self, char: str) -> bool:
+        """Whether the font has a glyph for ``char``."""
+        if self.embedded:
+            return ord(char) in self.cmap
+        try:
+            char.encode('cp1252')
+            return True
+        except UnicodeEncodeError:
+            return False
+    
+    def encode(self, text: str, used: Dict[int, str]) -> str:
+        """Hex string operand for ``text``, recording the glyphs used."""
+        if not self.embedded:
+            return text.encode('cp1252', 'replace').hex()
+        codes = []
+        for char in text:
+            gid = self.cmap.get(ord(char), 0)
+            used.setdefault(gid, char)
+            codes.append(f"{gid:04x}")
+        return ''.join(codes)
+    
+    def subset(self, gids: List[int]) -> bytes:
+        """
+        Font program covering ``gids`` (ids unchanged); whole font on failure.
+        
+        Programs are shared across documents: while the glyphs seen so far
+        stay under TEXT_PDF_CONFIG['subset_cache_glyphs'], each subset is
+        built for all of them, so later documents of a batch, set in the
+        same alphabet, reuse it without subsetting again.
+        """
+        if font_subset is None:
+            return self.data
+        wanted = frozenset(gids) | {0}
+        cached_gids, cached_program = self._subset_cache
+        if wanted <= cached_gids:
+            self.subset_stats['hits'] += 1
+            return cached_program
+        self.subset_stats['misses'] += 1
+        
+        union = cached_gids | wanted
+        if wanted & self.common_gids:
+            union |= self.common_gids
+        target = union if len(union) <= TEXT_PDF_CONFIG['subset_cache_glyphs'] else wanted
+        try:
+            program = self._subset(target)
+        except Exception as e:
+            TextPDFRenderer.logger.debug(f"Font subsetting failed, embedding {self.path} whole: {e}")
+            return self.data
+        with self._subset_lock:
+            if target is union or not self._subset_cache[0]:
+                self._subset_cache = (target, program)
+        return program
+    
+    def _subset(self, gids: Iterable[int]) -> bytes:
+        font = TTFont(io.BytesIO(self.data))
+        options = font_subset.Options()
+        options.retain_gids = True
+        options.notdef_outline = True
+        options.layout_features = []
+        options.hinting = False
+        # Text is placed glyph by glyph: shaping tables are dead weight
+        options.drop_tables = options.drop_tables + ['GSUB', 'GPOS', 'GDEF', 'BASE', 'JSTF', 'kern', 'FFTM']
+        subsetter = font_subset.Subsetter(options)
+        subsetter.populate(gids=sorted(gids))
+        subsetter.subset(font)
+        buffer = io.BytesIO()
+        font.save(buffer)
+        return buffer.getvalue()
+
+
+class FontChain:
+    """
+    A text font and its fallbacks, with the choice of font per character.
+    
+    Characters are resolved by script: the font that covered the first
+    character of a script is tried first for the later ones, keeping runs
+    in one face. Each resolution is remembered for the life of the process.
+    Measures like a single TextFont, so layout code takes either.
+    """
+    
+    def __init__(self, fonts: List[TextFont]):
+        self.fonts = fonts
+        self.primary = fonts[0]
+        self._chars: Dict[str, int] = {}
+        self._scripts: Dict[str, int] = {}
+    
+    @staticmethod
+    def script(char: str) -> str:
+        """Coarse script of ``char``: first word of its Unicode name (LATIN, ARABIC, CJK...)."""
+        name = unicodedata.name(char, '')
+        return name.split(' ', 1)[0] if name else 'UNKNOWN'
+    
+    def index(self, char: str) -> int:
+        """Position in ``fonts`` of the font that sets ``char``."""
+        index = self._chars.get(char)
+        if index is None:
+            script = self.script(char)
+            preferred = self._scripts.get(script)
+            if preferred is not None and self.fonts[preferred].covers(char):
+                index = preferred
+            else:
+                index = next((n for n, font in enumerate(self.fonts) if font.covers(char)), 0)
+                self._scripts.setdefault(script, index)
+            self._chars[char] = index
+        return index
+    
+    def char_width(self, char: str) -> float:
+        return self.fonts[self.index(char)].char_width(char)
+    
+    def text_width(self, text: str, size: float) -> float:
+        return sum(self.char_width(c) for c in text) * size / 1000.0
+    
+    def runs(self, text: str) -> List[Tuple[TextFont, str]]:
+        """Split ``text`` into maximal runs set in the same font."""
+        runs: List[Tuple[TextFont, str]] = []
+        start = 0
+        for i in range(1, len(text) + 1):
+            if i == len(text) or self.index(text[i]) != self.index(text[start]):
+                runs.append((self.fonts[self.index(text[start])], text[start:i]))
+                start = i
+        return runs
+
+
+class TextPDFRenderer:
+    """
+    Lay out plain-text emails straight to PDF, without an HTML engine.
+    
+    The header block and the whole body are wrapped and paginated; nothing
+    is truncated. Text is set in the first TrueType font of
+    TEXT_PDF_CONFIG['font_paths'] (subset and embedded, so any Unicode the
+    font covers renders), falling back to Courier. Characters it lacks are
+    set in the first of TEXT_PDF_CONFIG['fallback_font_paths'] covering
+    them; glyphs are placed one by one, without shaping.
+    """
+    
+    logger = logging.getLogger('mail2pdf.textpdf')
+    
+    # Page sizes in points (portrait)
+    PAGE_SIZES = {
+        'A3': (841.89, 1190.55),
+        'A4': (595.28, 841.89),
+        'A5': (419.53, 595.28),
+        'LETTER': (612.0, 792.0),
+        'LEGAL': (612.0, 1008.0)
+    }
+    
+    _CONTROL_CHARS = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+    
+    # Loaded fonts by path ('' is the Courier fallback), shared by all renders
+    _fonts: Dict[str, TextFont] = {}
+    _chains: Dict[str, FontChain] = {}
+    _fonts_lock = threading.Lock()
+    
+    @classmethod
+    def render(cls, email_msg: EmailMessage, output_path: Path, options: Dict = None) -> int:
+        """
+        Write ``email_msg`` to ``output_path`` as a text PDF.
+        
+        Returns:
+            Number of pages written
+        """
+        writer = PDFStreamWriter(output_path)
+        try:
+            pages = cls.add_message(writer, email_msg, options)
+            writer.close({'Title': str(email_msg.subject), 'Author': str(email_msg.sender)})
+        except BaseException:
+            writer.abort()
+            raise
+        return len(pages)
+    
+    @classmethod
+    def add_message(cls, writer: PDFStreamWriter, email_msg: EmailMessage, options: Dict = None) -> List[int]:
+        """
+        Lay out ``email_msg`` on new pages of ``writer``.
+        
+        HTML-only messages are reduced to their text first. The font is
+        embedded once per document, when the writer is closed.
+        
+        Returns:
+            Object numbers of the pages added
+        """
+        options = options or {}
+        font = cls.font_chain(options.get('text_font'))
+        width, height = cls.page_size(options)
+        
+        body = email_msg.body if not email_msg.html_body else cls.html_to_text(email_msg.html_body)
+        pages = cls._layout(email_msg, body, font, width, height)
+        primary = PDFGenerator.theme(options)['primary_color']
+        refs = []
+        for number, operations in enumerate(pages, 1):
+            content, resources = cls._content(writer, operations, number, len(pages), font, width, primary)
+            refs.append(writer.add_page(content, resources, width, height))
+        return refs
+    
+    @classmethod
+    def font(cls, path: Optional[str] = None) -> TextFont:
+        """Load (once per process) the configured font, or the Courier fallback."""
+        candidates = [path] if path else TEXT_PDF_CONFIG['font_paths']
+        key = path or '|'.join(candidates)
+        font = cls._fonts.get(key)
+        if font is not None:
+            return font
+        
+        with cls._fonts_lock:
+            font = cls._fonts.get(key)
+            if font is None:
+                for candidate in candidates if TTFont is not None else []:
+                    if not Path(candidate).is_file():
+                        continue
+                    try:
+                        font = TextFont(Path(candidate))
+                        break
+                    except Exception as e:
+                        cls.logger.warning(f"Unusable text font {candidate}: {e}")
+                if font is None:
+                    cls.logger.info("No TrueType font available, text PDFs use Courier")
+                    font = TextFont()
+                cls._fonts[key] = font
+        return font
+    
+    @classmethod
+    def page_size(cls, options: Dict = None) -> Tuple[float, float]:
+        """Page width and height in points for the page options."""
+        options = options or {}
+        width, height = cls.PAGE_SIZES.get(str(options.get('page_size', 'A4')).upper(), cls.PAGE_SIZES['A4'])
+        if options.get('orientation') == 'landscape':
+            width, height = height, width
+        return width, height
+    
+    @classmethod
+    def font_chain(cls, path: Optional[str] = None) -> FontChain:
+        """
+        The text font with the loadable fallback fonts, once per process.
+        
+        The Courier fallback gets no fallbacks: its glyphs are not embedded.
+        """
+        key = path or ''
+        chain = cls._chains.get(key)
+        if chain is None:
+            fonts = [cls.font(path)]
+            if fonts[0].embedded:
+                for candidate in TEXT_PDF_CONFIG['fallback_font_paths']:
+                    if not Path(candidate).is_file() or candidate == str(fonts[0].path):
+                        continue
+                    fallback = cls.font(candidate)
+                    if fallback.embedded:
+                        fonts.append(fallback)
+            with cls._fonts_lock:
+                chain = cls._chains.setdefault(key, FontChain(fonts))
+        return chain
+    
+    @staticmethod
+    def html_to_text(html_body: str) -> str:
+        """Reduce HTML to readable text: blocks become lines, tags are dropped."""
+        text = re.sub(r'(?is)<(script|style|head)\b.*?</\1\s*>', '', html_body)
+        text = re.sub(r'(?i)<br\s*/?>', '\n', text)
+        text = re.sub(r'(?i)</(p|div|tr|li|h[1-6]|blockquote|table)\s*>|<hr\b[^>]*>', '\n', text)
+        text = re.sub(r'(?s)<[^>]*>', '', text)
+        text = html.unescape(text)
+        text = re.sub(r'[ \t\r\f\v]+\n', '\n', text)
+        return re.sub(r'\n{3,}', '\n\n', text).strip()
+    
+    @staticmethod
+    def wrap(line: str, max_width: float, font: Union[TextFont, FontChain], size: float) -> List[str]:
+        """Break ``line`` at spaces (or anywhere, for long words) to fit ``max_width``."""
+        limit = max_width * 1000.0 / size
+        lines = []
+        start = 0
+        width = 0.0
+        last_space = -1
+        i = 0
+        while i < len(line):
+            char_width = font.char_width(line[i])
+            if width + char_width > limit and i > start:
+                if last_space > start:
+                    lines.append(line[start:last_space])
+                    start = last_space + 1
+                else:
+                    lines.append(line[start:i])
+                    start = i
+                width = sum(font.char_width(c) for c in line[start:i])
+                last_space = line.rfind(' ', start, i)
+                continue
+            if line[i] == ' ':
+                last_space = i
+            width += char_width
+            i += 1
+        lines.append(line[start:])
+        return lines
+    
+    @classmethod
+    def _layout(cls, email_msg: EmailMessage, body: str, font: Union[TextFont, FontChain],
+                width: float, height: float) -> List[List[Tuple]]:
+        """
+        Place the header block and body on pages.
+        
+        Returns:
+            Per page, the drawing operations ('text', x, y, size, bold, text)
+            and ('rule', x1, x2, y)
+        """
+        config = TEXT_PDF_CONFIG
+        margin = float(config['margin']) * 72 / 25.4
+        usable = width - 2 * margin
+        body_size = float(config['font_size'])
+        meta_size = float(config['header_font_size'])
+        subject_size = float(config['subject_font_size'])
+        leading = float(config['line_height'])
+        
+        pages: List[List[Tuple]] = [[]]
+        y = height - margin
+        
+        def place(text: str, x: float, size: float, bold: bool = False) -> None:
+            nonlocal y
+            if y - size * leading < margin:
+                pages.append([])
+                y = height - margin
+            y -= size * leading
+            if text:
+                pages[-1].append(('text', x, y, size, bold, text))
+        
+        def clean(value: Any) -> str:
+            return cls._CONTROL_CHARS.sub('', str(value))
+        
+        for line in cls.wrap(clean(email_msg.subject).replace('\n', ' '), usable, font, subject_size):
+            place(line, margin, subject_size, bold=True)
+        y -= meta_size * 0.5
+        
+        attachments = ', '.join(str(a.get('filename')) for a in (email_msg.attachments or []))
+        rows = [('From:', email_msg.sender), ('To:', ', '.join(email_msg.recipients or []))]
+        if email_msg.cc:
+            rows.append(('CC:', ', '.join(email_msg.cc)))
+        rows.append(('Date:', email_msg.date))
+        if attachments:
+            rows.append(('Attachments:', attachments))
+        label_width = max(font.text_width(label, meta_size) for label, _ in rows) + meta_size
+        for label, value in rows:
+            value_lines = cls.wrap(clean(value).replace('\n', ' '), usable - label_width, font, meta_size)
+            for n, value_line in enumerate(value_lines):
+                place(label if n == 0 else '', margin, meta_size, bold=True)
+                pages[-1].append(('text', margin + label_width, y, meta_size, False, value_line))
+        
+        y -= meta_size * 0.6
+        pages[-1].append(('rule', margin, width - margin, y))
+        y -= body_size * 0.6
+        
+        tab_size = int(config['tab_size'])
+        for paragraph in clean(body.replace('\r\n', '\n').replace('\r', '\n')).split('\n'):
+            for line in cls.wrap(paragraph.expandtabs(tab_size).rstrip(), usable, font, body_size):
+                place(line, margin, body_size)
+        
+        return pages
+    
+    @classmethod
+    def _content(cls, writer: PDFStreamWriter, operations: List[Tuple], number: int, total: int,
+                 chain: FontChain, width: float, primary: str = HTML_STYLE['primary_color']) -> Tuple[bytes, str]:
+        """
+        Content stream of one laid-out page, footer included.
+        
+        Returns:
+            The content and the page /Resources entry naming its fonts
+        """
+        primary = primary.lstrip('#')
+        color = ' '.join(f"{int(primary[i:i + 2], 16) / 255:.3f}" for i in (0, 2, 4))
+        margin = float(TEXT_PDF_CONFIG['margin']) * 72 / 25.4
+        fonts: Dict[str, int] = {}
+        
+        def show(text: str, size: float, bold: bool, fill: str) -> str:
+            """Text operators for ``text``, switching font per run."""
+            ops = []
+            for font, run in chain.runs(text):
+                regular, bold_name, regular_ref, bold_ref, used = cls._document_font(writer, font)
+                hex_text = font.encode(run, used)
+                if bold and font.embedded:
+                    # Synthetic bold: fill and stroke the outlines
+                    fonts[regular] = regular_ref
+                    ops.append(f"{fill} rg {fill} RG 2 Tr {size * 0.04:.2f} w /{regular} {size:g} Tf <{hex_text}> Tj")
+                else:
+                    name, ref = (bold_name, bold_ref) if bold else (regular, regular_ref)
+                    fonts[name] = ref
+                    ops.append(f"{fill} rg 0 Tr /{name} {size:g} Tf <{hex_text}> Tj")
+            return ' '.join(ops)
+        
+        ops = []
+        for op in operations:
+            if op[0] == 'rule':
+                _, x1, x2, y = op
+                ops.append(f"{color} RG 0.8 w {x1:.2f} {y:.2f} m {x2:.2f} {y:.2f} l S")
+                continue
+            _, x, y, size, bold, text = op
+            fill = color if bold else '0.2 0.2 0.2'
+            ops.append(f"BT {x:.2f} {y:.2f} Td {show(text, size, bold, fill)} ET")
+        footer = f"Mail2PDF NextGen | {number}/{total}"
+        footer_x = width - margin - chain.text_width(footer, 7)
+        ops.append(f"BT {footer_x:.2f} {margin / 2:.2f} Td {show(footer, 7, False, '0.6 0.6 0.6')} ET")
+        
+        font_refs = ' '.join(f"/{name} {ref} 0 R" for name, ref in sorted(fonts.items()))
+        return '\n'.join(ops).encode('ascii'), f"<< /Font << {font_refs} >> >>"
+    
+    @classmethod
+    def _document_font(cls, writer: PDFStreamWriter, font: TextFont) -> Tuple[str, str, int, int, Dict[int, str]]:
+        """
+        Resources of ``font`` in ``writer``, reserved on first use.
+        
+        Returns:
+            The regular and bold resource names and object numbers, and the
+            glyph map collecting the glyphs used, embedded when the writer
+            closes
+        """
+        key = f"text-font:{font.path}"
+        if key not in writer.resources:
+            count = sum(1 for name in writer.resources if name.startswith('text-font:'))
+            regular = writer.reserve()
+            bold = regular if font.embedded else writer.reserve()
+            used: Dict[int, str] = {}
+            writer.on_close(lambda: cls._write_fonts(writer, font, regular, bold, used))
+            writer.resources[key] = (f"F{2 * count + 1}", f"F{2 * count + 2}", regular, bold, used)
+        return writer.resources[key]
+    
+    @classmethod
+    def _write_fonts(cls, writer: PDFStreamWriter, font: TextFont, regular: int, bold: int,
+                     used: Dict[int, str]) -> None:
+        """Embed ``font`` (subset to the glyphs used) or declare the Courier faces."""
+        if not font.embedded:
+            writer.write(regular, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>")
+            writer.write(bold, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier-Bold "
+                               b"/Encoding /WinAnsiEncoding >>")
+            return
+        
+        gids = sorted(used)
+        tag = ''.join(chr(65 + int(c, 16) % 26) for c in hashlib.sha1(repr(gids).encode()).hexdigest()[:6])
+        base_font = f"{tag}+{font.name}"
+        program = font.subset(gids)
+        font_file = writer.add(writer.stream(program, f" /Length1 {len(program)}"))
+        flags = 32 | (1 if font.fixed_pitch else 0)
+        descriptor = writer.add((
+            f"<< /Type /FontDescriptor /FontName /{base_font} /Flags {flags} "
+            f"/FontBBox [{' '.join(map(str, font.bbox))}] /ItalicAngle {font.italic_angle:g} "
+            f"/Ascent {font.ascent} /Descent {font.descent} /CapHeight {font.cap_height} "
+            f"/StemV 80 /FontFile2 {font_file} 0 R >>").encode('ascii'))
+        widths = ' '.join(f"{gid} [{font.widths[gid]:.0f}]" for gid in gids)
+        cid_font = writer.add((
+            f"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /{base_font} "
+            f"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+            f"/FontDescriptor {descriptor} 0 R /W [{widths}] /CIDToGIDMap /Identity >>").encode('ascii'))
+        to_unicode = writer.add(writer.stream(cls._to_unicode_cmap(used)))
+        writer.write(regular, (f"<< /Type /Font /Subtype /Type0 /BaseFont /{base_font} /Encoding /Identity-H "
+                               f"/DescendantFonts [{cid_font} 0 R] /ToUnicode {to_unicode} 0 R >>").encode('ascii'))
+    
+    @staticmethod
+    def _to_unicode_cmap(used: Dict[int, str]) -> bytes:
+        """CMap mapping the glyph ids used back to their characters."""
+        entries = [f"<{gid:04x}> <{char.encode('utf-16-be').hex()}>" for gid, char in sorted(used.items())]
+        lines = [
+            "/CIDInit /ProcSet findresource begin", "12 dict begin", "begincmap",
+            "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+            "/CMapName /Adobe-Identity-UCS def", "/CMapType 2 def",
+            "1 begincodespacerange", "<0000> <ffff>", "endcodespacerange"
+        ]
+        for i in range(0, len(entries), 100):
+            chunk = entries[i:i + 100]
+            lines += [f"{len(chunk)} beginbfchar", *chunk, "endbfchar"]
+        lines += ["endcmap", "CMapName currentdict /CMap defineresource pop", "end", "end"]
+        return '\n'.join(lines).encode('ascii')
+
+
+# ============================================================================
+# IMAGE PROCESSING
+# ============================================================================
+
+class ImageOptimizer:
+    """
+    Downsample and recompress images before they reach the layout engine.
+    
+    Images are scaled to fit the page content box at the target DPI (phone
+    photos carry several times the pixels a printed page can show), turned
+    upright from their EXIF orientation, and re-encoded: JPEG stays JPEG at
+    the given quality, other formats become optimised PNG. The original is
+    kept whenever the result would not be smaller.
+    """
+    
+    logger = logging.getLogger('mail2pdf.images')
+    
+    FORMATS = {'image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff'}
+    
+    # Page margin of PDFGenerator.PAGE_CSS, in points
+    PAGE_MARGIN = 2 / 2.54 * 72
+    
+    # Images below this size are left alone unless they exceed the pixel box
+    MIN_RECOMPRESS = 256 * 1024
+    
+    @classmethod
+    def pixel_box(cls, options: Dict = None) -> Tuple[int, int]:
+        """Largest useful image size in pixels for the page setup and DPI of ``options``."""
+        options = options or {}
+        width, height = TextPDFRenderer.page_size(options)
+        dpi = float(options.get('image_dpi', PDF_CONFIG['quality']))
+        return (max(1, round((width - 2 * cls.PAGE_MARGIN) / 72 * dpi)),
+                max(1, round((height - 2 * cls.PAGE_MARGIN) / 72 * dpi)))
+    
+    @classmethod
+    def optimize(cls, content: bytes, mime_type: str, options: Dict = None) -> Tuple[bytes, str]:
+        """
+        Downsampled, recompressed ``content`` for the options' page setup.
+        
+        Returns:
+            The new content and MIME type, or the originals when the image
+            is not a still raster Pillow can read, or would not shrink
+        """
+        if Image is None or mime_type not in cls.FORMATS:
+            return content, mime_type
+        options = options or {}
+        quality = int(options.get('jpeg_quality', PDF_CONFIG['jpeg_quality']))
+        max_width, max_height = cls.pixel_box(options)
+        try:
+            with Image.open(io.BytesIO(content)) as image:
+                if getattr(image, 'n_frames', 1) > 1:
+                    return content, mime_type
+                source_format = image.format
+                oriented = image.getexif().get(0x0112, 1) not in (1, None)
+                if image.width <= max_width and image.height <= max_height and not oriented \
+                        and len(content) < cls.MIN_RECOMPRESS:
+                    return content, mime_type
+                # JPEG decodes straight at a reduced scale
+                image.draft('RGB', (max_width, max_height))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((max_width, max_height), Image.LANCZOS)
+                
+                buffer = io.BytesIO()
+                if source_format == 'JPEG':
+                    image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+                    optimized = (buffer.getvalue(), 'image/jpeg')
+                else:
+                    image.save(buffer, 'PNG', optimize=True)
+                    optimized = (buffer.getvalue(), 'image/png')
+        except Exception as e:
+            cls.logger.debug(f"Image left as is ({mime_type}, {len(content)} bytes): {e}")
+            return content, mime_type
+        
+        if len(optimized[0]) >= len(content) and not oriented:
+            return content, mime_type
+        return optimized
+
+
+# ============================================================================
+# REMOTE RESOURCES
+# ============================================================================
+
+class ResourceFetcher:
+    """
+    WeasyPrint URL fetcher applying the remote-resource policy of one render.
+    
+    Images are passed through ImageOptimizer on the way to WeasyPrint; the
+    disk cache keeps them as fetched.
+    
+    ``cid:`` references are decoded from the message's MIME parts and
+    ``data:`` URLs inline; neither touches the network. http(s) URLs are
+    refused ('block'), limited to allow-listed hosts ('allow') or fetched
+    ('fetch'), every fetch of a message sharing one deadline. Fetched
+    responses go to an on-disk cache shared by all processes. Any other
+    scheme, ``file:`` in particular, is refused.
+    """
+    
+    logger = logging.getLogger('mail2pdf.resources')
+    
+    POLICIES = ('block', 'allow', 'fetch')
+    
+    _IMG = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+    _SRC = re.compile(r'\bsrc\s*=\s*["\']?\s*https?:', re.IGNORECASE)
+    _DIMENSION = re.compile(r'(?<![-\w])(width|height)\s*[=:]\s*["\']?\s*(\d+)(?:px)?\b', re.IGNORECASE)
+    _HIDDEN = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden', re.IGNORECASE)
+    
+    _stats = {'cached': 0, 'fetched': 0, 'blocked': 0, 'failed': 0}
+    _stats_lock = threading.Lock()
+    
+    # Bytes held by each disk cache directory, scanned on first store
+    _cache_bytes: Dict[str, int] = {}
+    _cache_lock = threading.Lock()
+    
+    class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+        """Re-apply the fetcher's policy to every redirect hop."""
+        
+        def __init__(self, fetcher: 'ResourceFetcher'):
+            self.fetcher = fetcher
+        
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            newurl = urllib.parse.urljoin(req.full_url, newurl)
+            scheme = urllib.parse.urlsplit(newurl).scheme.lower()
+            if scheme not in ('http', 'https') or not self.fetcher.allowed(newurl):
+                self.fetcher._count(blocked=1)
+                raise urllib.error.HTTPError(newurl, code, f"Redirect blocked by policy "
+                                             f"'{self.fetcher.policy}': {newurl}", headers, fp)
+            return super().redirect_request(req, fp, code, msg, headers, newurl)
+    
+    def __init__(self, email_msg: Optional[EmailMessage] = None, options: Dict = None):
+        options = options or {}
+        self.email_msg = email_msg
+        self.policy = options.get('remote_policy', REMOTE_RESOURCE_CONFIG['policy'])
+        if self.policy not in self.POLICIES:
+            raise ValueError(f"Unknown remote resource policy: {self.policy}")
+        self.allow_hosts = [host.lower().strip('.') for host in
+                            options.get('remote_allow_hosts', REMOTE_RESOURCE_CONFIG['allow_hosts'])]
+        self.timeout = float(options.get('remote_timeout', REMOTE_RESOURCE_CONFIG['timeout']))
+        self.deadline = time.monotonic() + float(options.get('remote_deadline', REMOTE_RESOURCE_CONFIG['deadline']))
+        self.cache_dir = Path(REMOTE_RESOURCE_CONFIG['cache_dir'])
+        self.options = options
+        # Counters of this fetcher alone, reported on the RenderResult
+        self.stats: Dict[str, int] = {}
+    
+    def __call__(self, url: str, timeout: float = 10, ssl_context: Any = None) -> Dict[str, Any]:
+        resource = self.fetch(url, ssl_context)
+        resource['string'], resource['mime_type'] = ImageOptimizer.optimize(
+            resource['string'], resource['mime_type'], self.options)
+        return resource
+    
+    def fetch(self, url: str, ssl_context: Any = None) -> Dict[str, Any]:
+        """Resource behind ``url`` as fetched, before image processing."""
+        scheme = url.split(':', 1)[0].lower()
+        if scheme == 'cid':
+            related = self.email_msg.get_related(urllib.parse.unquote(url[4:])) if self.email_msg else None
+            if related is None:
+                raise ValueError(f"No MIME part with Content-ID {url[4:]!r}")
+            content, mime_type = related
+            return {'string': content, 'mime_type': mime_type, 'redirected_url': url}
+        if scheme == 'data':
+            with urllib.request.urlopen(url) as response:
+                return {'string': response.read(), 'mime_type': response.headers.get_content_type(),
+                        'redirected_url': url}
+        if scheme not in ('http', 'https') or not self.allowed(url):
+            self._count(blocked=1)
+            raise ValueError(f"Remote resource blocked by policy '{self.policy}': {url}")
+        
+        cached = self._cached(url)
+        if cached is not None:
+            self._count(cached=1)
+            return cached
+        try:
+            fetched = self._fetch(url, ssl_context)
+        except Exception:
+            self._count(failed=1)
+            raise
+        self._count(fetched=1)
+        self._store(url, fetched)
+        return fetched
+    
+    def allowed(self, url: str) -> bool:
+        """Whether the policy lets ``url`` be fetched."""
+        if self.policy == 'block':
+            return False
+        if self.policy == 'fetch':
+            return True
+        host = (urllib.parse.urlsplit(url).hostname or '').lower()
+        return any(host == allowed or host.endswith('.' + allowed) for allowed in self.allow_hosts)
+    
+    @classmethod
+    def strip_tracking_pixels(cls, html_body: str) -> str:
+        """Remove remote images that are hidden or at most 1x1 pixel."""
+        def replace(match: 're.Match') -> str:
+            tag = match.group(0)
+            if not cls._SRC.search(tag):
+                return tag
+            sizes = {name.lower(): int(value) for name, value in cls._DIMENSION.findall(tag)}
+            if cls._HIDDEN.search(tag) or (sizes and len(sizes) == 2 and max(sizes.values()) <= 1):
+                return ''
+            return tag
+        
+        return cls._IMG.sub(replace, html_body)
+    
+    @classmethod
+    def get_stats(cls) -> Dict[str, int]:
+        """Resource counters of this process, including renders reported by workers."""
+        with cls._stats_lock:
+            return dict(cls._stats)
+    
+    @classmethod
+    def add_stats(cls, counts: Dict[str, int]) -> None:
+        """Fold in the counters of renders done in another process."""
+        with cls._stats_lock:
+            for key, amount in counts.items():
+                cls._stats[key] = cls._stats.get(key, 0) + amount
+    
+    def _count(self, **amounts: int) -> None:
+        for key, amount in amounts.items():
+            self.stats[key] = self.stats.get(key, 0) + amount
+        self.add_stats(amounts)
+    
+    def _fetch(self, url: str, ssl_context: Any) -> Dict[str, Any]:
+        """GET ``url`` within the per-request timeout and the message deadline."""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Remote resource deadline exhausted before {url}")
+        max_size = REMOTE_RESOURCE_CONFIG['max_size']
+        request = urllib.request.Request(url, headers={'User-Agent': 'Mail2PDF NextGen'})
+        chunks = []
+        size = 0
+        opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl_context),
+                                             self._RedirectHandler(self))
+        with opener.open(request, timeout=min(self.timeout, remaining)) as response:
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise ValueError(f"Remote resource larger than {max_size} bytes: {url}")
+                if time.monotonic() > self.deadline:
+                    raise TimeoutError(f"Remote resource deadline exhausted while reading {url}")
+                chunks.append(chunk)
+            return {'string': b''.join(chunks), 'mime_type': response.headers.get_content_type(),
+                    'redirected_url': response.geturl()}
+    
+    def _paths(self, url: str) -> Tuple[Path, Path]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        entry = self.cache_dir / key[:2] / key
+        return entry, entry.with_suffix('.json')
+    
+    def _cached(self, url: str) -> Optional[Dict[str, Any]]:
+        content_path, meta_path = self._paths(url)
+        try:
+            if time.time() - meta_path.stat().st_mtime > REMOTE_RESOURCE_CONFIG['cache_ttl']:
+                return None
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            content = content_path.read_bytes()
+            os.utime(content_path)  # mark as recently used; the metadata keeps the fetch time
+            return {'string': content, 'mime_type': meta['mime_type'],
+                    'redirected_url': meta.get('redirected_url', url)}
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def _store(self, url: str, fetched: Dict[str, Any]) -> None:
+        """Write content first, then its metadata, each atomically."""
+        content_path, meta_path = self._paths(url)
+        meta = json.dumps({'url': url, 'mime_type': fetched['mime_type'],
+                           'redirected_url': fetched['redirected_url']})
+        try:
+            content_path.parent.mkdir(parents=True, exist_ok=True)
+            for path, data in ((content_path, fetched['string']), (meta_path, meta.encode('utf-8'))):
+                tmp_path = path.with_name(path.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            self.logger.warning(f"Could not cache {url}: {e}")
+            return
+        
+        cache_key = str(self.cache_dir)
+        with self._cache_lock:
+            if cache_key not in self._cache_bytes:
+                self._cache_bytes[cache_key] = sum(size for _, size, _ in self._scan())
+            else:
+                self._cache_bytes[cache_key] += len(fetched['string'])
+            if self._cache_bytes[cache_key] > REMOTE_RESOURCE_CONFIG['cache_max_bytes']:
+                self._evict()
+    
+    def _scan(self) -> List[Tuple[float, int, Path]]:
+        """(last use, size, content path) of every cached resource."""
+        entries = []
+        for path in self.cache_dir.glob('*/*'):
+            if path.suffix:
+                continue  # metadata and temporary files
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+    
+    def _evict(self) -> None:
+        """Drop expired, then least recently used resources down to 90% of cache_max_bytes."""
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        target = int(REMOTE_RESOURCE_CONFIG['cache_max_bytes'] * 0.9)
+        expired_before = time.time() - REMOTE_RESOURCE_CONFIG['cache_ttl']
+        
+        def expired(path: Path) -> bool:
+            try:
+                return path.with_suffix('.json').stat().st_mtime < expired_before
+            except OSError:
+                return True
+        
+        for _mtime, size, path in sorted(entries, key=lambda entry: (not expired(entry[2]), entry[0])):
+            if total <= target and not expired(path):
+                break
+            try:
+                path.with_suffix('.json').unlink(missing_ok=True)
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+        self._cache_bytes[str(self.cache_dir)] = total
+
+
+# ============================================================================
+# PDF GENERATION
+# ============================================================================
+
+@dataclass
+class RenderResult:
+    """Outcome of rendering one email to PDF."""
+    
+    # 'success', 'error', 'timeout' (wall clock exceeded), 'memory'
+    # (memory ceiling hit) or 'crashed' (render worker died)
+    status: str
+    output: Optional[str] = None
+    engine: Optional[str] = None
+    elapsed: float = 0.0
+    error: Optional[str] = None
+    # Why the HTML engine was abandoned for the text layout, None if it wasn't
+    degraded: Optional[str] = None
+    # Cost model choice ('plain', 'simple_html', 'over_budget', 'layout')
+    # and its predicted seconds, when the engine was picked automatically
+    decision: Optional[str] = None
+    predicted: Optional[float] = None
+    # Cost model features of the message, so a parent process can calibrate
+    features: Optional[Dict[str, float]] = field(default=None, repr=False)
+    # Image DPI the PDF had to be re-rendered at to fit max_pdf_size, and
+    # whether it still exceeds it at the lowest setting
+    image_dpi: Optional[int] = None
+    oversize: bool = False
+    # Attachments extracted next to the PDF (extract_attachments option)
+    attachments: List[str] = field(default_factory=list)
+    # Attachments carried inside the PDF (embed_attachments option)
+    embedded: List[str] = field(default_factory=list)
+    # Image and PDF attachments appended as pages (append_attachments option)
+    appended: List[str] = field(default_factory=list)
+    # ResourceFetcher counters of this render, summed by a pool's parent
+    resources: Dict[str, int] = field(default_factory=dict)
+    
+    @property
+    def ok(self) -> bool:
+        return self.status == 'success'
+
+
+class RenderTimeout(BaseException):
+    """
+    The HTML engine exceeded its wall-clock budget.
+    
+    A BaseException, so WeasyPrint's loaders, which log and skip any
+    Exception, cannot swallow it.
+    """
+
+
+class RenderError(Exception):
+    """A render failed; ``status`` is the RenderResult status."""
+    
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class HTMLTemplate:
+    """
+    A ``string.Template`` source compiled once into literal text and fields.
+    
+    Fields given in ``constants`` are substituted at compile time. Rendering
+    then only joins the literals with the per-message values, HTML-escaping
+    every value except those of the ``raw`` fields.
+    """
+    
+    def __init__(self, source: str, constants: Dict[str, str] = None, raw: Iterable[str] = ()):
+        constants = constants or {}
+        self.raw = frozenset(raw)
+        fields: List[str] = []
+        literals: List[str] = []
+        current: List[str] = []
+        position = 0
+        for match in string.Template.pattern.finditer(source):
+            current.append(source[position:match.start()])
+            position = match.end()
+            if match.group('escaped') is not None:
+                current.append('$')
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError(f"Invalid template placeholder at offset {match.start()}")
+            if name in constants:
+                current.append(constants[name])
+                continue
+            literals.append(''.join(current))
+            current = []
+            fields.append(name)
+        current.append(source[position:])
+        literals.append(''.join(current))
+        self.fields = tuple(fields)
+        self._literals = literals
+    
+    def render(self, values: Dict[str, Any]) -> str:
+        """Fill the template; every field must be present in ``values``."""
+        parts = [self._literals[0]]
+        for name, literal in zip(self.fields, self._literals[1:]):
+            value = values[name]
+            value = '' if value is None else str(value)
+            parts.append(value if name in self.raw else html.escape(value))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+class PDFGenerator:
+    """Generate PDF from email content with WeasyPrint and fallback."""
+    
+    logger = logging.getLogger('mail2pdf.pdf')
+    
+    # Bump when the generated document changes in a way the templates do not show
+    TEMPLATE_VERSION = '4'
+    
+    # Page box and document-level rules rendered ahead of the themed CSS_TEMPLATE
+    PAGE_CSS = """
+@page {{
+    size: {page_size} {orientation};
+    margin: 2cm;
+}}
+body {{
+    background-color: {background};
+}}
+.email-container {{
+    box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+}}
+"""
+    
+    # Compiled stylesheets and font configuration, built once per process
+    _stylesheets: Dict[Tuple[str, str, str], Any] = {}
+    _templates: Dict[Tuple[str, str, str, bool], HTMLTemplate] = {}
+    _font_config: Any = None
+    _render_pid: Optional[int] = None
+    _render_lock = threading.Lock()
+    
+    _stats = {'renders': 0, 'degraded': 0}
+    _stats_lock = threading.Lock()
+    
+    @staticmethod
+    def theme(options: Dict = None) -> Dict[str, str]:
+        """HTML_STYLE with the ``style`` overrides of ``options`` applied."""
+        return {**HTML_STYLE, **((options or {}).get('style') or {})}
+    
+    @staticmethod
+    def stylesheet_version(options: Dict = None) -> str:
+        """Fingerprint of the templates, stylesheet and theme used for rendering."""
+        theme = json.dumps(PDFGenerator.theme(options), sort_keys=True)
+        source = '\n'.join([PDFGenerator.TEMPLATE_VERSION, PDFGenerator.PAGE_CSS, CSS_TEMPLATE,
+                            HTML_TEMPLATE, theme])
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    
+    @staticmethod
+    def stylesheet_source(options: Dict = None) -> str:
+        """Full stylesheet text for the given page options and theme."""
+        options = options or {}
+        theme = PDFGenerator.theme(options)
+        page_css = PDFGenerator.PAGE_CSS.format(
+            page_size=options.get('page_size', 'A4'),
+            orientation=options.get('orientation', 'portrait'),
+            background=theme['background_color']
+        )
+        return page_css + render_css(theme)
+    
+    @classmethod
+    def font_configuration(cls) -> Any:
+        """Shared WeasyPrint FontConfiguration, or None when unavailable."""
+        if cls._render_pid != os.getpid():
+            # Forked workers must not share the parent's font handles
+            with cls._render_lock:
+                cls._stylesheets = {}
+                cls._font_config = None
+                cls._render_pid = os.getpid()
+        if cls._font_config is None and HTML is not None:
+            with cls._render_lock:
+                if cls._font_config is None:
+                    cls._font_config = FontConfiguration() if FontConfiguration else False
+        return cls._font_config or None
+    
+    @classmethod
+    def stylesheet(cls, options: Dict = None) -> Any:
+        """
+        Compiled WeasyPrint stylesheet for the given page options.
+        
+        The stylesheet is parsed once per page size, orientation and
+        stylesheet version and reused by every later render in the process.
+        """
+        if CSS is None:
+            return None
+        options = options or {}
+        key = (options.get('page_size', 'A4'), options.get('orientation', 'portrait'),
+               cls.stylesheet_version(options))
+        font_config = cls.font_configuration()
+        compiled = cls._stylesheets.get(key)
+        if compiled is None:
+            with cls._render_lock:
+                compiled = cls._stylesheets.get(key)
+                if compiled is None:
+                    compiled = CSS(string=cls.stylesheet_source(options), font_config=font_config)
+                    cls._stylesheets[key] = compiled
+        return compiled
+    
+    @classmethod
+    def template(cls, options: Dict = None, embed_css: bool = True) -> HTMLTemplate:
+        """
+        Compiled message template for the given page options and theme.
+        
+        The stylesheet is substituted at compile time, so each later message
+        only fills in its own header fields and body.
+        """
+        options = options or {}
+        key = (options.get('page_size', 'A4'), options.get('orientation', 'portrait'),
+               cls.stylesheet_version(options), embed_css)
+        compiled = cls._templates.get(key)
+        if compiled is None:
+            style = f"<style>{cls.stylesheet_source(options)}</style>" if embed_css else ''
+            compiled = HTMLTemplate(HTML_TEMPLATE, {'style': style}, raw=('body',))
+            with cls._render_lock:
+                compiled = cls._templates.setdefault(key, compiled)
+        return compiled
+    
+    @classmethod
+    def clear_stylesheets(cls) -> None:
+        """Drop compiled stylesheets and templates, e.g. after the styling config changed."""
+        with cls._render_lock:
+            cls._stylesheets.clear()
+            cls._templates.clear()
+    
+    @staticmethod
+    def url_fetcher(email_msg: EmailMessage, options: Dict = None) -> ResourceFetcher:
+        """WeasyPrint URL fetcher for ``email_msg`` under the remote-resource policy of ``options``."""
+        return ResourceFetcher(email_msg, options)
+    
+    @staticmethod
+    def generate(email_msg: EmailMessage, output_path: Path, options: Dict = None) -> bool:
+        """
+        Generate PDF from email message.
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return PDFGenerator.render(email_msg, output_path, options).ok
+    
+    @staticmethod
+    def render(email_msg: EmailMessage, output_path: Path, options: Dict = None) -> RenderResult:
+        """
+        Render an email to PDF in the current process.
+        
+        RenderCostModel picks the engine: the native text engine for plain
+        text and for HTML that carries no layout or is predicted to blow the
+        budget, WeasyPrint otherwise. ``options['engine']`` ('auto', 'html'
+        or 'text') overrides the choice. When WeasyPrint fails, runs out of memory or
+        exceeds ``options['render_timeout']`` (default: weasyprint_timeout)
+        the message is laid out by the text engine instead and the result
+        is marked ``degraded``.
+        
+        Returns:
+            RenderResult with the engine used; 'memory' if even the text
+            layout ran out of memory, 'error' for any other failure
+        """
+        options = options or {}
+        started = time.perf_counter()
+        result = RenderResult(status='error', output=str(output_path))
+        engine = options.get('engine', 'auto')
+        features = None
+        if engine == 'auto':
+            features = RenderCostModel.features(email_msg)
+            engine, result.predicted, result.decision = RenderCostModel.choose(features)
+            result.features = features
+        use_html = engine == 'html'
+        try:
+            # HTML goes through WeasyPrint, with the shared stylesheet and fonts
+            if HTML is not None and use_html:
+                budget = options.get('render_timeout', PERFORMANCE_CONFIG['weasyprint_timeout'])
+                try:
+                    html_content = PDFGenerator._create_html(email_msg, options, embed_css=False)
+                    with PDFGenerator._time_budget(budget):
+                        PDFGenerator._write_html(html_content, email_msg, output_path, options, result)
+                    result.status, result.engine = 'success', 'weasyprint'
+                except RenderTimeout:
+                    result.degraded = 'timeout'
+                    PDFGenerator.logger.warning(f"WeasyPrint exceeded {budget}s on {output_path}, degrading to text")
+                except MemoryError:
+                    # Drop the half-built document before laying out text
+                    html_content = ''
+                    result.degraded = 'memory'
+                    PDFGenerator.logger.warning(f"WeasyPrint ran out of memory on {output_path}, degrading to text")
+                except Exception as e:
+                    result.degraded = 'error'
+                    PDFGenerator.logger.warning(f"WeasyPrint failed: {e}, trying fallback")
+                
+                if result.ok:
+                    # Attachment trouble must not cost the layout already done
+                    if PDFGenerator.embeddable(email_msg, options) or PDFGenerator.appendable(email_msg, options):
+                        try:
+                            PDFGenerator._attach_into(output_path, email_msg, options, result)
+                        except Exception as e:
+                            result.appended, result.embedded = [], []
+                            PDFGenerator.logger.warning(f"Attachments not added to {output_path}: {e}")
+                    PDFGenerator.logger.info(f"PDF generated: {output_path}")
+            
+            if not result.ok:
+                # Plain text, or the fallback when WeasyPrint is unusable
+                if use_html and not result.degraded:
+                    PDFGenerator.logger.warning("WeasyPrint not available, using text-based fallback")
+                PDFGenerator._generate_text_pdf(email_msg, output_path, options, result)
+                result.status, result.engine = 'success', 'text'
+                if result.degraded:
+                    PDFGenerator._count(degraded=1)
+        
+        except MemoryError:
+            PDFGenerator.logger.error(f"PDF generation ran out of memory for {output_path}")
+            result.status, result.error = 'memory', 'Memory limit exceeded'
+        except Exception as e:
+            PDFGenerator.logger.error(f"PDF generation failed for {output_path}: {e}")
+            result.error = str(e)
+        
+        PDFGenerator._count(renders=1)
+        result.elapsed = time.perf_counter() - started
+        if (features is not None and result.ok and not result.degraded
+                and RenderCostModel.engine_of(result) == engine):
+            RenderCostModel.record(features, result)
+        return result
+    
+    @staticmethod
+    def _write_html(html_content: str, email_msg: EmailMessage, output_path: Path, options: Dict,
+                    result: RenderResult) -> None:
+        """
+        Lay out ``html_content`` with WeasyPrint within the PDF size budget.
+        
+        A PDF larger than ``options['max_pdf_size']`` (default:
+        PERFORMANCE_CONFIG) is rendered again at each lower image setting of
+        PDF_CONFIG['size_fallbacks'] until it fits.
+        """
+        max_size = options.get('max_pdf_size', PERFORMANCE_CONFIG['max_pdf_size'])
+        dpi = int(options.get('image_dpi', PDF_CONFIG['quality']))
+        steps = [(dpi, int(options.get('jpeg_quality', PDF_CONFIG['jpeg_quality'])))]
+        steps += [step for step in PDF_CONFIG['size_fallbacks'] if step[0] < dpi]
+        
+        for attempt, (image_dpi, jpeg_quality) in enumerate(steps):
+            attempt_options = dict(options, image_dpi=image_dpi, jpeg_quality=jpeg_quality)
+            fetcher = PDFGenerator.url_fetcher(email_msg, attempt_options)
+            try:
+                HTML(string=html_content, url_fetcher=fetcher).write_pdf(
+                    str(output_path),
+                    stylesheets=[PDFGenerator.stylesheet(options)],
+                    font_config=PDFGenerator.font_configuration(),
+                    dpi=image_dpi,
+                    jpeg_quality=jpeg_quality,
+                    optimize_images=True,
+                    uncompressed_pdf=not PDF_CONFIG.get('compression', True)
+                )
+            finally:
+                for key, amount in fetcher.stats.items():
+                    result.resources[key] = result.resources.get(key, 0) + amount
+            size = Path(output_path).stat().st_size
+            if attempt:
+                result.image_dpi = image_dpi
+            if size <= max_size:
+                return
+            PDFGenerator.logger.info(f"{output_path} is {size} bytes at {image_dpi} DPI, over the {max_size} budget")
+        result.oversize = True
+        PDFGenerator.logger.warning(f"{output_path} exceeds max_pdf_size even at {steps[-1][0]} DPI")
+    
+    @staticmethod
+    def embeddable(email_msg: EmailMessage, options: Dict = None) -> List[int]:
+        """
+        Attachments of ``email_msg`` to embed, by index.
+        
+        Chosen from their estimated sizes, without decoding: attachments are
+        taken in order while the total stays within ``embed_max_bytes``
+        (default: PDF_CONFIG), so larger ones never pay the decode cost.
+        """
+        options = options or {}
+        if not options.get('embed_attachments', PDF_CONFIG['embed_attachments']):
+            return []
+        budget = options.get('embed_max_bytes', PDF_CONFIG['embed_max_bytes'])
+        chosen = []
+        for index, attachment in enumerate((email_msg.attachments or [])[:len(email_msg.attachment_parts)]):
+            size = attachment.get('size') or 0
+            if size <= budget:
+                chosen.append(index)
+                budget -= size
+        return chosen
+    
+    @staticmethod
+    def embed_attachments(writer: PDFStreamWriter, email_msg: EmailMessage, options: Dict = None) -> List[str]:
+        """
+        Stream the embeddable attachments of ``email_msg`` into ``writer``.
+        
+        Returns:
+            Names of the embedded files
+        """
+        indexes = PDFGenerator.embeddable(email_msg, options)
+        embedded = []
+        for index in indexes:
+            attachment = email_msg.attachments[index]
+            name = str(attachment.get('filename') or f"attachment_{index + 1}")
+            # Decoded in full before anything reaches the PDF, so a bad
+            # payload is skipped without leaving a partial object behind
+            with tempfile.SpooledTemporaryFile(max_size=AttachmentStore.CHUNK_SIZE * 16) as decoded:
+                try:
+                    for chunk in AttachmentStore.decoded_chunks(email_msg.attachment_parts[index]):
+                        decoded.write(chunk)
+                except Exception as e:
+                    PDFGenerator.logger.warning(f"Attachment {name} of '{email_msg.subject}' not embedded: {e}")
+                    continue
+                decoded.seek(0)
+                embedded.append(writer.embed_file(
+                    name, iter(lambda: decoded.read(AttachmentStore.CHUNK_SIZE), b''),
+                    attachment.get('content_type') or 'application/octet-stream',
+                    description=str(email_msg.subject)))
+        skipped = len(email_msg.attachments or []) - len(indexes)
+        if skipped and (options or {}).get('embed_attachments', PDF_CONFIG['embed_attachments']):
+            PDFGenerator.logger.info(f"{skipped} attachment(s) of '{email_msg.subject}' left out: "
+                                     f"over the embedding cap")
+        return embedded
+    
+    @staticmethod
+    def appendable(email_msg: EmailMessage, options: Dict = None) -> List[int]:
+        """Image and PDF attachments of ``email_msg`` to append as pages, by index."""
+        options = options or {}
+        if not options.get('append_attachments', PDF_CONFIG['append_attachments']):
+            return []
+        chosen = []
+        for index, attachment in enumerate((email_msg.attachments or [])[:len(email_msg.attachment_parts)]):
+            kind = PDFGenerator._page_kind(attachment)
+            if (kind == 'pdf' and pypdf is not None) or (kind == 'image' and Image is not None):
+                chosen.append(index)
+        return chosen
+    
+    @staticmethod
+    def append_attachment_pages(writer: PDFStreamWriter, email_msg: EmailMessage, options: Dict = None) -> List[str]:
+        """
+        Append the image and PDF attachments of ``email_msg`` as pages of ``writer``.
+        
+        PDF pages are copied object for object, never laid out or
+        rasterised again; images get a page each. Every attachment gets an
+        outline entry; those that cannot be read are logged and skipped.
+        
+        Returns:
+            Names of the appended attachments
+        """
+        options = options or {}
+        appended = []
+        for index in PDFGenerator.appendable(email_msg, options):
+            attachment = email_msg.attachments[index]
+            part = email_msg.attachment_parts[index]
+            name = str(attachment.get('filename') or f"attachment_{index + 1}")
+            try:
+                if PDFGenerator._page_kind(attachment) == 'pdf':
+                    pages = PDFGenerator._append_pdf(writer, part)
+                else:
+                    pages = [PDFGenerator._append_image(writer, part, attachment, options)]
+            except Exception as e:
+                PDFGenerator.logger.warning(f"Attachment {name} of '{email_msg.subject}' not appended: {e}")
+                continue
+            if pages:
+                writer.add_outline(name, pages[0])
+            appended.append(name)
+        return appended
+    
+    @staticmethod
+    def _page_kind(attachment: Dict[str, Any]) -> Optional[str]:
+        """'pdf' or 'image' for attachments that can become pages, None otherwise."""
+        content_type = str(attachment.get('content_type') or '').lower()
+        if content_type == 'application/pdf' or str(attachment.get('filename') or '').lower().endswith('.pdf'):
+            return 'pdf'
+        if content_type.startswith('image/'):
+            return 'image'
+        return None
+    
+    @staticmethod
+    def _append_pdf(writer: PDFStreamWriter, part: email.message.Message) -> List[int]:
+        """Stream a PDF attachment to a temporary file and copy its pages."""
+        fd, temp_name = tempfile.mkstemp(suffix='.pdf', prefix='.m2p-attachment-', dir=str(writer.path.parent))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in AttachmentStore.decoded_chunks(part):
+                    f.write(chunk)
+            return writer.import_pdf(temp_name)
+        finally:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+    
+    @staticmethod
+    def _append_image(writer: PDFStreamWriter, part: email.message.Message, attachment: Dict[str, Any],
+                      options: Dict) -> int:
+        """Add a page showing an image attachment, downsampled like inline images."""
+        content = b''.join(AttachmentStore.decoded_chunks(part))
+        content, mime_type = ImageOptimizer.optimize(content, str(attachment.get('content_type')), options)
+        decode = ''
+        smask = None
+        with Image.open(io.BytesIO(content)) as image:
+            if mime_type == 'image/jpeg' and image.format == 'JPEG' and image.mode in ('L', 'RGB', 'CMYK'):
+                # JPEG data goes in as is
+                data, filter_name = content, 'DCTDecode'
+                color_space = {'L': 'DeviceGray', 'RGB': 'DeviceRGB', 'CMYK': 'DeviceCMYK'}[image.mode]
+                if image.mode == 'CMYK' and 'adobe' in image.info:
+                    decode = ' /Decode [1 0 1 0 1 0 1 0]'
+            else:
+                image = ImageOps.exif_transpose(image)
+                if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                    image = image.convert('RGBA')
+                    smask = zlib.compress(image.getchannel('A').tobytes())
+                gray = image.mode in ('1', 'L', 'LA', 'I', 'I;16')
+                image = image.convert('L' if gray else 'RGB')
+                data, filter_name = zlib.compress(image.tobytes()), 'FlateDecode'
+                color_space = 'DeviceGray' if gray else 'DeviceRGB'
+            pixel_size = image.size
+        return writer.add_image_page(data, pixel_size, color_space, filter_name,
+                                     TextPDFRenderer.page_size(options), ImageOptimizer.PAGE_MARGIN,
+                                     decode=decode, smask=smask)
+    
+    @staticmethod
+    def _finish_document(writer: PDFStreamWriter, email_msg: EmailMessage, options: Dict,
+                         result: RenderResult) -> None:
+        """Append and embed the attachments of a single-message document."""
+        if writer.pages and not writer.outline and PDFGenerator.appendable(email_msg, options):
+            writer.add_outline(str(email_msg.subject or '(No Subject)'), writer.pages[0])
+        result.appended = PDFGenerator.append_attachment_pages(writer, email_msg, options)
+        result.embedded = PDFGenerator.embed_attachments(writer, email_msg, options)
+    
+    @staticmethod
+    def _attach_into(output_path: Path, email_msg: EmailMessage, options: Dict, result: RenderResult) -> None:
+        """Rewrite a rendered PDF with the attachments of ``email_msg`` appended and embedded."""
+        if pypdf is None:
+            PDFGenerator.logger.warning("pypdf module required to add attachments to HTML renders")
+            return
+        output_path = Path(output_path)
+        rendered = output_path.with_name(f".{output_path.name}.{os.getpid()}.rendered")
+        os.replace(output_path, rendered)
+        writer = PDFStreamWriter(output_path)
+        try:
+            writer.import_pdf(rendered, navigation=True)
+            PDFGenerator._finish_document(writer, email_msg, options, result)
+            writer.close({'Title': str(email_msg.subject), 'Author': str(email_msg.sender)})
+        except BaseException:
+            writer.abort()
+            os.replace(rendered, output_path)
+            raise
+        os.unlink(rendered)
+    
+    @staticmethod
+    def render_batch(messages: Iterable[Union[EmailMessage, Exception]], output_path: Path,
+                     options: Dict = None, title: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Render many messages into one PDF, each from a new page with its own
+        outline entry.
+        
+        The document is streamed: text-engine messages are laid out straight
+        into it and HTML messages are rendered to a temporary PDF whose pages
+        are copied in (with pypdf; without it they use the text engine).
+        Memory follows the largest message, not the batch.
+        
+        Args:
+            messages: EmailMessages in document order; Exceptions stand for
+                messages that failed to parse and are reported, not rendered
+            output_path: Merged PDF to write
+            options: Render options, as for render()
+            title: Document title (default: first subject)
+            
+        Returns:
+            Dictionary with 'output', 'status', 'pages', 'elapsed' and the
+            per-message 'messages' results (index, subject, engine, pages,
+            status, error)
+        """
+        options = options or {}
+        started = time.perf_counter()
+        output_path = Path(output_path)
+        writer = PDFStreamWriter(output_path)
+        results: List[Dict[str, Any]] = []
+        
+        try:
+            for index, email_msg in enumerate(messages):
+                entry: Dict[str, Any] = {'index': index, 'subject': None, 'engine': None,
+                                         'pages': 0, 'status': 'error'}
+                results.append(entry)
+                if isinstance(email_msg, Exception):
+                    entry['error'] = f"Parse failed: {email_msg}"
+                    continue
+                
+                entry['subject'] = str(email_msg.subject)
+                title = title or entry['subject']
+                engine = options.get('engine', 'auto')
+                if engine == 'auto':
+                    engine = RenderCostModel.choose(RenderCostModel.features(email_msg))[0]
+                if engine == 'html' and pypdf is None:
+                    engine = 'text'
+                
+                try:
+                    if engine == 'html':
+                        pages, rendered = PDFGenerator._import_rendered(writer, email_msg, output_path.parent, options)
+                        entry['engine'], entry['degraded'] = rendered.engine, rendered.degraded
+                    else:
+                        pages = TextPDFRenderer.add_message(writer, email_msg, options)
+                        entry['engine'] = 'text'
+                except RenderError as e:
+                    entry['status'], entry['error'] = e.status, str(e)
+                    continue
+                except Exception as e:
+                    entry['error'] = str(e)
+                    PDFGenerator.logger.warning(f"Batch message {index} of {output_path}: {e}")
+                    continue
+                
+                if pages:
+                    writer.add_outline(entry['subject'] or '(No Subject)', pages[0])
+                page_count = len(writer.pages)
+                entry['appended'] = PDFGenerator.append_attachment_pages(writer, email_msg, options)
+                entry['embedded'] = PDFGenerator.embed_attachments(writer, email_msg, options)
+                entry['pages'] = len(pages) + len(writer.pages) - page_count
+                entry['status'] = 'success'
+            
+            if not writer.pages:
+                raise ValueError("No message could be rendered")
+            writer.close({'Title': title or output_path.stem})
+        except Exception as e:
+            writer.abort()
+            PDFGenerator.logger.error(f"Batch PDF generation failed for {output_path}: {e}")
+            return {'output': None, 'status': 'error', 'error': str(e), 'pages': 0,
+                    'elapsed': time.perf_counter() - started, 'messages': results}
+        
+        PDFGenerator.logger.info(f"Batch PDF generated: {output_path} ({len(writer.pages)} page(s), "
+                                 f"{sum(1 for r in results if r['status'] == 'success')}/{len(results)} messages)")
+        return {'output': str(output_path), 'status': 'success', 'pages': len(writer.pages),
+                'elapsed': time.perf_counter() - started, 'messages': results}
+    
+    @staticmethod
+    def _import_rendered(writer: PDFStreamWriter, email_msg: EmailMessage, work_dir: Path,
+                         options: Dict) -> Tuple[List[int], RenderResult]:
+        """Render one message with the HTML engine and copy its pages into ``writer``."""
+        fd, temp_name = tempfile.mkstemp(suffix='.pdf', prefix='.m2p-batch-', dir=str(work_dir))
+        os.close(fd)
+        try:
+            rendered = PDFGenerator.render(email_msg, Path(temp_name),
+                                           dict(options, engine='html', embed_attachments=False,
+                                                append_attachments=False))
+            if not rendered.ok:
+                raise RenderError(rendered.status, rendered.error or 'PDF generation failed')
+            return writer.import_pdf(temp_name), rendered
+        finally:
+            try:
+                os.unlink(temp_name)
+            except OSError:
+                pass
+    
+    @staticmethod
+    @contextlib.contextmanager
+    def _time_budget(seconds: Optional[float]) -> Iterator[None]:
+        """
+        Raise RenderTimeout in the block once ``seconds`` have elapsed.
+        
+        Uses SIGALRM, so the budget only applies on the main thread of a
+        POSIX process (CLI runs, pool workers); elsewhere the block runs
+        unbounded and RenderPool's hard timeout is the only limit.
+        """
+        if (not seconds or not hasattr(signal, 'setitimer')
+                or threading.current_thread() is not threading.main_thread()):
+            yield
+            return
+        
+        expired = []
+        
+        def expire(signum, frame):
+            expired.append(signum)
+            raise RenderTimeout(f"Rendering exceeded {seconds}s")
+        
+        previous = signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            yield
+            if expired:
+                # The alarm is one-shot: a block that swallowed it is still over budget
+                raise RenderTimeout(f"Rendering exceeded {seconds}s")
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    
+    @classmethod
+    def get_stats(cls) -> Dict[str, int]:
+        """Renders and degraded renders done in this process."""
+        with cls._stats_lock:
+            return dict(cls._stats)
+    
+    @classmethod
+    def _count(cls, **amounts: int) -> None:
+        with cls._stats_lock:
+            for key, amount in amounts.items():
+                cls._stats[key] += amount
+    
+    @staticmethod
+    def _create_html(email_msg: EmailMessage, options: Dict = None, embed_css: bool = True) -> str:
+        """
+        Create HTML representation of email for PDF.
+        
+        Args:
+            email_msg: Parsed email
+            options: Page options and ``style`` theme overrides
+            embed_css: Inline the stylesheet in a <style> block. Renders pass
+                False and supply the compiled stylesheet() instead.
+        """
+        options = options or {}
+        template = PDFGenerator.template(options, embed_css)
+        if email_msg.html_body:
+            body = email_msg.html_body
+            if options.get('strip_tracking_pixels', REMOTE_RESOURCE_CONFIG['strip_tracking_pixels']):
+                body = ResourceFetcher.strip_tracking_pixels(body)
+        else:
+            body = f"<pre>{html.escape(email_msg.body or '')}</pre>"
+        
+        return template.render({
+            'subject': email_msg.subject,
+            'sender': email_msg.sender,
+            'recipients': ', '.join(email_msg.recipients) if email_msg.recipients else 'No recipients',
+            'cc': ', '.join(email_msg.cc) if email_msg.cc else 'None',
+            'date': email_msg.date,
+            'attachments': len(email_msg.attachments or []),
+            'body': body
+        })
+    
+    @staticmethod
+    def _generate_text_pdf(email_msg: EmailMessage, output_path: Path, options: Dict = None,
+                           result: Optional[RenderResult] = None) -> None:
+        """Render with the native text engine, attachments appended and embedded as requested."""
+        result = result or RenderResult(status='success')
+        writer = PDFStreamWriter(output_path)
+        try:
+            TextPDFRenderer.add_message(writer, email_msg, options)
+            PDFGenerator._finish_document(writer, email_msg, options or {}, result)
+            writer.close({'Title': str(email_msg.subject), 'Author': str(email_msg.sender)})
+        except BaseException:
+            writer.abort()
+            raise
+        PDFGenerator.logger.info(f"Text PDF generated: {output_path} ({len(writer.pages)} page(s))")
+
+
+# ============================================================================
+# RENDER COST MODEL
+# ============================================================================
+
+class RenderCostModel:
+    """
+    Pick the render engine of a message from its predicted cost.
+    
+    Messages are described by cheap features of their body (HTML present,
+    size, images, table nesting, CSS volume). Messages whose HTML carries
+    no layout, or whose predicted WeasyPrint time exceeds the budget, go to
+    the text engine. The RENDER_COST_CONFIG coefficients are rescaled per
+    engine from every measured render, and each decision is kept with its
+    predicted and actual time.
+    """
+    
+    logger = logging.getLogger('mail2pdf.cost')
+    
+    _IMAGE = re.compile(r'<img\b', re.IGNORECASE)
+    _TABLE = re.compile(r'<(/?)table\b', re.IGNORECASE)
+    _STYLE_BLOCK = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.IGNORECASE | re.DOTALL)
+    _STYLE_ATTR = re.compile(r'\bstyle\s*=\s*(?:"[^"]*"|\'[^\']*\')', re.IGNORECASE)
+    
+    # Model engine of each RenderResult.engine
+    ENGINES = {'weasyprint': 'html', 'text': 'text'}
+    
+    # Measured / predicted time per engine, applied to every prediction
+    _scale: Dict[str, float] = {'html': 1.0, 'text': 1.0}
+    _history: 'collections.deque[Tuple[str, Optional[str], float, float]]' = collections.deque(
+        maxlen=RENDER_COST_CONFIG['history_size'])
+    _lock = threading.Lock()
+    
+    @classmethod
+    def features(cls, email_msg: EmailMessage) -> Dict[str, float]:
+        """Describe the rendering workload of a message."""
+        html_body = email_msg.html_body or ''
+        features = {
+            'html': 1.0 if html_body else 0.0,
+            'body_kb': len(html_body or email_msg.body or '') / 1024,
+            'images': 0.0,
+            'table_depth': 0.0,
+            'css_kb': 0.0
+        }
+        if not html_body:
+            return features
+        
+        depth = deepest = 0
+        for match in cls._TABLE.finditer(html_body):
+            depth = max(0, depth - 1) if match.group(1) else depth + 1
+            deepest = max(deepest, depth)
+        css = sum(len(m.group(1)) for m in cls._STYLE_BLOCK.finditer(html_body))
+        css += sum(len(m.group(0)) for m in cls._STYLE_ATTR.finditer(html_body))
+        features.update(images=float(len(cls._IMAGE.findall(html_body))),
+                        table_depth=float(deepest), css_kb=css / 1024)
+        return features
+    
+    @classmethod
+    def predict(cls, features: Dict[str, float], engine: str) -> float:
+        """Predicted render time in seconds of ``engine`` for ``features``."""
+        return cls._raw_prediction(features, engine) * cls._scale[engine]
+    
+    @classmethod
+    def choose(cls, features: Dict[str, float]) -> Tuple[str, float, str]:
+        """
+        Pick the engine for a message.
+        
+        Returns:
+            Engine ('html' or 'text'), its predicted seconds and the reason
+        """
+        text_cost = cls.predict(features, 'text')
+        if not features['html']:
+            return 'text', text_cost, 'plain'
+        if HTML is None:
+            return 'text', text_cost, 'no_html_engine'
+        
+        html_cost = cls.predict(features, 'html')
+        if (RENDER_COST_CONFIG['simple_html_to_text'] and not features['images']
+                and not features['table_depth'] and not features['css_kb']):
+            return 'text', text_cost, 'simple_html'
+        if html_cost > RENDER_COST_CONFIG['html_budget']:
+            return 'text', text_cost, 'over_budget'
+        return 'html', html_cost, 'layout'
+    
+    @classmethod
+    def record(cls, features: Dict[str, float], result: RenderResult) -> None:
+        """Rescale the engine's coefficients from a measured render and keep it."""
+        engine = cls.engine_of(result)
+        if engine is None:
+            return
+        raw = cls._raw_prediction(features, engine)
+        if raw > 0 and result.elapsed > 0:
+            weight = RENDER_COST_CONFIG['calibration_weight']
+            with cls._lock:
+                cls._scale[engine] = (1 - weight) * cls._scale[engine] + weight * result.elapsed / raw
+        cls.observe(result)
+    
+    @classmethod
+    def observe(cls, result: RenderResult) -> None:
+        """Keep the decision, predicted and actual time of a render."""
+        engine = cls.engine_of(result)
+        if result.predicted is None or engine is None:
+            return
+        cls.logger.debug(f"{engine} render ({result.decision}): predicted "
+                         f"{result.predicted:.3f}s, took {result.elapsed:.3f}s")
+        with cls._lock:
+            cls._history.append((engine, result.decision, result.predicted, result.elapsed))
+    
+    @classmethod
+    def engine_of(cls, result: RenderResult) -> Optional[str]:
+        """Model engine ('html' or 'text') that produced ``result``, None if unknown."""
+        return cls.ENGINES.get(result.engine or '')
+    
+    @classmethod
+    def get_stats(cls) -> Dict[str, Any]:
+        """Per engine: renders, mean predicted and actual seconds, mean error."""
+        with cls._lock:
+            history = list(cls._history)
+            scale = dict(cls._scale)
+        
+        stats: Dict[str, Any] = {'decisions': dict(collections.Counter(d for _, d, _, _ in history))}
+        for engine in ('html', 'text'):
+            runs = [(p, a) for e, _, p, a in history if e == engine]
+            stats[engine] = {
+                'renders': len(runs),
+                'predicted_seconds': sum(p for p, _ in runs) / len(runs) if runs else 0.0,
+                'actual_seconds': sum(a for _, a in runs) / len(runs) if runs else 0.0,
+                'mean_abs_error': sum(abs(p - a) for p, a in runs) / len(runs) if runs else 0.0,
+                'scale': scale[engine]
+            }
+        return stats
+    
+    @classmethod
+    def reset(cls) -> None:
+        """Forget measurements and return to the configured coefficients."""
+        with cls._lock:
+            cls._scale = {'html': 1.0, 'text': 1.0}
+            cls._history.clear()
+    
+    @staticmethod
+    def _raw_prediction(features: Dict[str, float], engine: str) -> float:
+        coefficients = RENDER_COST_CONFIG[engine]
+        cost = coefficients['base'] + coefficients['per_kb'] * features['body_kb']
+        if engine == 'html':
+            cost += (coefficients['per_image'] * features['images']
+                     + coefficients['per_css_kb'] * features['css_kb']
+                     + coefficients['per_table_level'] * features['table_depth'] ** 2)
+        return cost
+
+
+# ============================================================================
+# RENDER WORKER POOL
+# ============================================================================
+
+class RenderPool:
+    """
+    Long-lived worker processes that render PDFs in isolation.
+    
+    Every render is bounded by a wall-clock timeout and every worker by an
+    address-space ceiling. A worker that times out, runs out of memory or
+    dies is killed and replaced, so one pathological message cannot pin
+    or bloat the calling process; the message itself is then rendered
+    with the text layout and marked degraded.
+    """
+    
+    logger = logging.getLogger('mail2pdf.render')
+    
+    # Hard per-render limit, as a multiple of the timeout workers enforce themselves
+    HARD_TIMEOUT_FACTOR = 1.5
+    
+    _shared: Optional['RenderPool'] = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, workers: Optional[int] = None, timeout: Optional[float] = None,
+                 memory_limit: Optional[int] = None):
+        """
+        Args:
+            workers: Number of worker processes (started on demand)
+            timeout: Seconds one render may take
+            memory_limit: Address-space ceiling per worker in bytes (0 = none)
+        """
+        self.workers = max(1, int(workers or PERFORMANCE_CONFIG['render_workers']))
+        self.timeout = float(timeout or PERFORMANCE_CONFIG['weasyprint_timeout'])
+        self.memory_limit = int(PERFORMANCE_CONFIG['render_memory_limit']
+                                if memory_limit is None else memory_limit)
+        self.stats = {'renders': 0, 'timeout': 0, 'memory': 0, 'crashed': 0, 'replaced': 0,
+                      'degraded': 0}
+        self._idle: 'queue.Queue[Tuple[multiprocessing.Process, Any]]' = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._closed = False
+    
+    @classmethod
+    def shared(cls) -> 'RenderPool':
+        """Process-wide pool built from PERFORMANCE_CONFIG."""
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared._closed:
+                cls._shared = cls()
+                atexit.register(cls._shared.close)
+            return cls._shared
+    
+    def render(self, email_msg: EmailMessage, output_path: Path, options: Dict = None) -> RenderResult:
+        """Render in a worker process, enforcing the timeout."""
+        started = time.perf_counter()
+        worker = self._acquire()
+        process, conn = worker
+        # Any failure to get a well-formed result leaves the worker suspect
+        healthy = False
+        
+        try:
+            try:
+                # The worker degrades itself at ``timeout``; the hard limit only
+                # catches renders stuck where the alarm cannot interrupt them
+                conn.send((email_msg, str(output_path), dict(options or {}, render_timeout=self.timeout)))
+                if conn.poll(self.timeout * self.HARD_TIMEOUT_FACTOR):
+                    result = conn.recv()
+                else:
+                    result = RenderResult(status='timeout', output=str(output_path),
+                                          error=f"Rendering exceeded {self.timeout * self.HARD_TIMEOUT_FACTOR:g}s")
+            except (EOFError, OSError) as e:
+                process.join(1)
+                result = RenderResult(status='crashed', output=str(output_path),
+                                      error=f"Render worker died (exit code {process.exitcode}): {e}")
+            
+            with self._lock:
+                self.stats['renders'] += 1
+                if result.status in ('timeout', 'memory', 'crashed'):
+                    self.stats[result.status] += 1
+            # Resources were fetched in the worker: count them here
+            ResourceFetcher.add_stats(result.resources)
+            # After a memory or timeout fallback the worker survived on the
+            # text layout, but its heap or interrupted engine state is suspect
+            healthy = (result.status not in ('timeout', 'memory', 'crashed')
+                       and result.degraded not in ('memory', 'timeout'))
+        finally:
+            if healthy:
+                self._idle.put(worker)
+            else:
+                self._replace(worker)
+        
+        if result.status in ('timeout', 'memory', 'crashed'):
+            self.logger.warning(f"Render {result.status} for {output_path}: {result.error}")
+            result = self._degrade(email_msg, output_path, options, result)
+        
+        if result.degraded:
+            with self._lock:
+                self.stats['degraded'] += 1
+        if result.ok and not result.degraded:
+            # The worker calibrated its own copy of the model: do the same here
+            if result.features is not None:
+                RenderCostModel.record(result.features, result)
+            else:
+                RenderCostModel.observe(result)
+        result.elapsed = time.perf_counter() - started
+        return result
+    
+    def _degrade(self, email_msg: EmailMessage, output_path: Path, options: Optional[Dict],
+                 failed: RenderResult) -> RenderResult:
+        """Retry a message that blew its budget with the text layout only."""
+        worker = self._acquire()
+        process, conn = worker
+        healthy = False
+        try:
+            conn.send((email_msg, str(output_path), dict(options or {}, engine='text')))
+            if not conn.poll(self.timeout * self.HARD_TIMEOUT_FACTOR):
+                return failed
+            result = conn.recv()
+            healthy = isinstance(result, RenderResult)
+            if healthy:
+                ResourceFetcher.add_stats(result.resources)
+        except (EOFError, OSError):
+            return failed
+        finally:
+            if healthy:
+                self._idle.put(worker)
+            else:
+                self._replace(worker)
+        
+        if not healthy or not result.ok:
+            return failed
+        self.logger.info(f"Rendered {output_path} as text after {failed.status}")
+        result.degraded = failed.status
+        return result
+    
+    def close(self) -> None:
+        """Stop all idle workers."""
+        self._closed = True
+        while True:
+            try:
+                process, conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+            conn.close()
+    
+    def _acquire(self) -> Tuple[multiprocessing.Process, Any]:
+        """Take an idle worker, starting one while below the pool size."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            spawn = self._started < self.workers
+            if spawn:
+                self._started += 1
+        return self._spawn() if spawn else self._idle.get()
+    
+    def _spawn(self) -> Tuple[multiprocessing.Process, Any]:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_render_worker, args=(child_conn, self.memory_limit),
+                                          name='mail2pdf-render', daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+    
+    def _replace(self, worker: Tuple[multiprocessing.Process, Any]) -> None:
+        """Kill a runaway worker and put a fresh one in its place."""
+        process, conn = worker
+        if process.is_alive():
+            process.kill()
+        process.join(5)
+        conn.close()
+        with self._lock:
+            self.stats['replaced'] += 1
+        try:
+            fresh = self._spawn()
+        except BaseException:
+            # Free the slot: _acquire starts a worker when one is next needed
+            with self._lock:
+                self._started -= 1
+            raise
+        self._idle.put(fresh)
+
+
+def _render_worker(conn: Any, memory_limit: int) -> None:
+    """Render requests from ``conn`` until told to stop (runs in a worker)."""
+    if memory_limit and resource is not None:
+        try:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            if hard != resource.RLIM_INFINITY:
+                memory_limit = min(memory_limit, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+        except (ValueError, OSError) as e:
+            RenderPool.logger.warning(f"Could not set render memory limit: {e}")
+    
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        email_msg, output_path, options = task
+        result = PDFGenerator.render(email_msg, Path(output_path), options)
+        conn.send(result)
+        if result.status == 'memory' or result.degraded in ('memory', 'timeout'):
+            # The heap may be left fragmented or half-freed, or WeasyPrint
+            # interrupted mid-layout: start afresh
+            return
+
+
+# ============================================================================
+# CONVERSION CACHE
+# ============================================================================
+
+class ConversionCache:
+    """
+    Content-addressed on-disk cache of generated PDFs.
+    
+    Entries are keyed on the input file hash, the render options and the
+    stylesheet version, so identical uploads are rendered once. The least
+    recently used entries are evicted beyond ``max_entries`` or ``max_bytes``.
+    """
+    
+    # Options that do not change the rendered PDF
+    NON_RENDER_OPTIONS = {'use_cache', 'jobs', 'incremental', 'queue_size', 'shard_threshold',
+                          'shards_per_job', 'extract_attachments'}
+    
+    logger = logging.getLogger('mail2pdf.cache')
+    
+    def __init__(self, cache_dir: Optional[Union[str, Path]] = None,
+                 max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir or PERFORMANCE_CONFIG['cache_dir'])
+        self.max_entries = max_entries or PERFORMANCE_CONFIG['cache_size']
+        self.max_bytes = max_bytes or PERFORMANCE_CONFIG['cache_max_bytes']
+        self.hits = 0
+        self.misses = 0
+        self._entries: Optional[int] = None
+        self._bytes = 0
+    
+    def key(self, input_file: Path, options: Optional[Dict] = None) -> str:
+        """Build the cache key of an input file rendered with ``options``."""
+        render_options = {k: v for k, v in (options or {}).items() if k not in self.NON_RENDER_OPTIONS}
+        source = '\n'.join([
+            get_file_hash(input_file),
+            json.dumps(render_options, sort_keys=True, default=str),
+            PDFGenerator.stylesheet_version(options)
+        ])
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+    
+    def fetch(self, key: str, output_path: Path) -> bool:
+        """Copy a cached PDF to ``output_path``; return False on a miss."""
+        entry = self._path(key)
+        try:
+            shutil.copyfile(entry, output_path)
+            os.utime(entry)  # mark as recently used
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+    
+    def store(self, key: str, pdf_path: Path) -> None:
+        """Add a freshly rendered PDF to the cache."""
+        entry = self._path(key)
+        tmp_path = entry.with_name(entry.name + f".{os.getpid()}.tmp")
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(pdf_path, tmp_path)
+            os.replace(tmp_path, entry)
+        except OSError as e:
+            self.logger.warning(f"Could not cache {pdf_path}: {e}")
+            return
+        
+        if self._entries is None:
+            self._scan()
+        else:
+            self._entries += 1
+            self._bytes += entry.stat().st_size
+        if self._entries > self.max_entries or self._bytes > self.max_bytes:
+            self._evict()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of this cache instance."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+    
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pdf"
+    
+    def _scan(self) -> List[Tuple[float, int, Path]]:
+        entries = []
+        for path in self.cache_dir.glob('*/*.pdf'):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        self._entries = len(entries)
+        self._bytes = sum(size for _, size, _ in entries)
+        return entries
+    
+    def _evict(self) -> None:
+        """Drop least recently used entries down to 90% of the limits."""
+        entries = sorted(self._scan())
+        target_entries = int(self.max_entries * 0.9)
+        target_bytes = int(self.max_bytes * 0.9)
+        
+        for _mtime, size, path in entries:
+            if self._entries <= target_entries and self._bytes <= target_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            self._entries -= 1
+            self._bytes -= size
+
+
+# ============================================================================
+# ATTACHMENT EXTRACTION
+# ============================================================================
+
+class AttachmentStore:
+    """
+    Content-addressed attachment extraction for one output directory.
+    
+    Each attachment is decoded from its MIME part in chunks and hashed; its
+    content is written once, under ``.attachments/`` of the output
+    directory, however many messages carry it. The per-message folder gets
+    a hard link to the stored copy under the attachment's own name (or the
+    stored path itself where links are unsupported).
+    """
+    
+    logger = logging.getLogger('mail2pdf.attachments')
+    
+    STORE_DIR = '.attachments'
+    CHUNK_SIZE = 64 * 1024
+    
+    _UNSAFE_NAME = re.compile(r'[\\/:*?"<>|\x00-\x1f\x7f]')
+    _BASE64_JUNK = re.compile(r'[^A-Za-z0-9+/=]')
+    
+    def __init__(self, output_dir: Union[str, Path]):
+        self.root = Path(output_dir) / self.STORE_DIR
+    
+    def extract(self, email_msg: EmailMessage, target_dir: Path) -> List[str]:
+        """
+        Extract every attachment of ``email_msg`` into ``target_dir``.
+        
+        Returns:
+            Paths of the extracted files, in attachment order; attachments
+            that fail to extract are logged and left out
+        """
+        paths: List[str] = []
+        names: set = set()
+        for number, (attachment, part) in enumerate(zip(email_msg.attachments or [],
+                                                         email_msg.attachment_parts), 1):
+            name = self._unique_name(attachment.get('filename'), number, names)
+            try:
+                stored = self.store(part)
+                paths.append(str(self._link(stored, target_dir / name)))
+            except (OSError, ValueError, binascii.Error) as e:
+                self.logger.warning(f"Could not extract attachment {name}: {e}")
+        return paths
+    
+    def store(self, part: email.message.Message) -> Path:
+        """Decoded content of ``part`` in the store, written only if new."""
+        digest = hashlib.sha256()
+        for chunk in self.decoded_chunks(part):
+            digest.update(chunk)
+        key = digest.hexdigest()
+        stored = self.root / key[:2] / key
+        if stored.exists():
+            return stored
+        
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = stored.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in self.decoded_chunks(part):
+                    f.write(chunk)
+            os.replace(tmp_path, stored)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        return stored
+    
+    @classmethod
+    def decoded_chunks(cls, part: email.message.Message) -> Iterator[bytes]:
+        """
+        Content of ``part`` decoded from its transfer encoding, chunk by chunk.
+        
+        base64 and quoted-printable are decoded a slice at a time, so the
+        decoded attachment is never held whole.
+        """
+        if part.is_multipart():
+            # Attached message (message/rfc822) or multipart: save it as parsed
+            inner = part.get_payload(0) if part.get_content_type() == 'message/rfc822' else part
+            yield inner.as_bytes()
+            return
+        payload = part.get_payload()
+        if not isinstance(payload, str):
+            yield part.get_payload(decode=True) or b''
+            return
+        
+        encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        size = cls.CHUNK_SIZE
+        if encoding == 'base64':
+            pending = ''
+            for start in range(0, len(payload), size):
+                # Whitespace and stray characters are skipped, as decode=True does
+                pending += cls._BASE64_JUNK.sub('', payload[start:start + size])
+                usable = len(pending) - len(pending) % 4
+                if usable:
+                    yield binascii.a2b_base64(pending[:usable])
+                    pending = pending[usable:]
+            pending = pending.rstrip('=')
+            if len(pending) % 4 > 1:  # a single leftover character carries no byte
+                yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+        elif encoding == 'quoted-printable':
+            start = 0
+            while start < len(payload):
+                # Slices end on a line break: soft breaks never straddle them
+                end = payload.find('\n', start + size)
+                end = len(payload) if end < 0 else end + 1
+                yield binascii.a2b_qp(cls._raw_bytes(payload[start:end]))
+                start = end
+        elif encoding in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+            yield part.get_payload(decode=True) or b''
+        else:
+            for start in range(0, len(payload), size):
+                yield cls._raw_bytes(payload[start:start + size])
+    
+    @staticmethod
+    def _raw_bytes(text: str) -> bytes:
+        """Bytes behind a parsed payload, as email.message does for decode=True."""
+        try:
+            return text.encode('ascii', 'surrogateescape')
+        except UnicodeEncodeError:
+            return text.encode('raw-unicode-escape')
+    
+    @classmethod
+    def _unique_name(cls, filename: Optional[str], number: int, taken: set) -> str:
+        """File-system safe ``filename``, unique within one message."""
+        name = cls._UNSAFE_NAME.sub('_', Path(str(filename or '')).name).strip().lstrip('.')
+        name = name or f"attachment_{number}"
+        stem, suffix = os.path.splitext(name)
+        candidate, copy = name, 1
+        while candidate.lower() in taken:
+            copy += 1
+            candidate = f"{stem} ({copy}){suffix}"
+        taken.add(candidate.lower())
+        return candidate
+    
+    def _link(self, stored: Path, target: Path) -> Path:
+        """Hard link ``target`` to ``stored``; ``stored`` itself if linking fails."""
+        try:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if target.exists():
+                if os.path.samefile(target, stored):
+                    return target
+                target.unlink()
+            os.link(stored, target)
+            return target
+        except OSError as e:
+            self.logger.debug(f"Hard link {target} failed ({e}), using {stored}")
+            return stored
+
+
+# ============================================================================
+# EMAIL CONVERTER - MAIN CLASS
+# ============================================================================
+
+class EmailConverter:
+    """Main email to PDF converter with multi-format support."""
+    
+    # MBOX files smaller than this are not worth sharding across processes
+    SHARD_THRESHOLD = 256 * 1024 * 1024
+    
+    def __init__(self, config: Dict = None):
+        """
+        Initialize converter with optional configuration.
+        
+        Args:
+            config: Optional configuration dictionary
+        """
+        self.config = config or {}
+        self.logger = logging.getLogger('mail2pdf.converter')
+        self.detector = EmailTypeDetector()
+        self.cache = ConversionCache(self.config.get('cache_dir'))
+    
+    def convert_email(self, input_path: str, output_dir: str = './output', options: Optional[Dict] = None) -> Optional[str]:
+        """
+        Convert single email file to PDF.
+        
+        Args:
+            input_path: Path to email file
+            output_dir: Output directory for PDF
+            options: Optional conversion options
+            
+        Returns:
+            Path to generated PDF or None on failure
+        """
+        result = self._convert_email(input_path, output_dir, options)
+        return result.output if result.ok else None
+    
+    def _render(self, email_msg: EmailMessage, pdf_path: Path, options: Dict) -> RenderResult:
+        """Render in the shared RenderPool when isolation is on, else in-process."""
+        if self.config.get('isolate_render', PERFORMANCE_CONFIG['render_isolation']):
+            return RenderPool.shared().render(email_msg, pdf_path, options)
+        return PDFGenerator.render(email_msg, pdf_path, options)
+    
+    def _convert_email(self, input_path: str, output_dir: str, options: Optional[Dict]) -> RenderResult:
+        """convert_email() reporting how the conversion failed."""
+        options = options or {}
+        input_file = Path(input_path)
+        output_dir_path = Path(output_dir)
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+        
+        if not input_file.exists():
+            self.logger.error(f"Input file not found: {input_path}")
+            return RenderResult(status='error', error='Input file not found')
+        
+        # Detect format
+        format_type = self.detector.detect_format(input_file)
+        self.logger.info(f"Detected format: {format_type}")
+        
+        pdf_path = output_dir_path / (input_file.stem + '.pdf')
+        
+        # Identical inputs rendered with the same options come from the cache
+        cache_key = None
+        use_cache = options.get('use_cache', PERFORMANCE_CONFIG['use_cache'])
+        if use_cache and format_type != 'mbox' and not options.get('extract_attachments'):
+            try:
+                cache_key = self.cache.key(input_file, options)
+                if self.cache.fetch(cache_key, pdf_path):
+                    self.logger.info(f"Served from cache: {input_path} -> {pdf_path}")
+                    return RenderResult(status='success', output=str(pdf_path), engine='cache')
+            except OSError as e:
+                self.logger.warning(f"Conversion cache unavailable: {e}")
+                cache_key = None
+        
+        try:
+            # Parse email
+            if format_type == 'msg':
                 email_msg = MSGParser.parse(input_file)
             elif format_type == 'mbox':
-                messages = MBOXParser.parse(input_file)
-                if not messages:
+                # Every message gets its own PDF; report the first one
+                results = self.convert_mbox(str(input_file), str(output_dir_path), options)
+                if not results:
                     self.logger.error("No messages found in MBOX file")
-                    return None
-                email_msg = messages[0]
+                    return RenderResult(status='error', error='No messages found')
+                first = next((r for r in results if r['status'] == 'success'), results[0])
+                return RenderResult(status=first['status'], output=first['output'], error=first.get('error'))
             else:  # eml, zip, or unknown
                 email_msg = EMLParser.parse(input_file)
             
-            # Handle attachments extraction if requested
+            # Attachments are written once per output tree, linked per message
+            attachments = []
             if options.get('extract_attachments') and email_msg.attachments:
-                attach_dir = output_dir_path / f"{input_file.stem}_attachments"
-                attach_dir.mkdir(exist_ok=True)
-                
-                for attachment in (email_msg.attachments or []):
-                    # In a real implementation, we would save the content here
-                    # But our current EmailMessage only stores metadata in 'attachments' list?
-                    # Let's check EmailMessage definition.
-                    pass
+                attachments = AttachmentStore(output_dir_path).extract(
+                    email_msg, output_dir_path / f"{input_file.stem}_attachments")
             
             # Generate PDF
-            pdf_name = input_file.stem + '.pdf'
-            pdf_path = output_dir_path / pdf_name
-            
-            if PDFGenerator.generate(email_msg, pdf_path, options):
+            result = self._render(email_msg, pdf_path, options)
+            result.attachments = attachments
+            if result.ok:
                 self.logger.info(f"Successfully converted: {input_path} -> {pdf_path}")
-                return str(pdf_path)
-            else:
-                return None
+                if cache_key and not result.degraded:
+                    self.cache.store(cache_key, pdf_path)
+            return result
         
         except Exception as e:
             self.logger.error(f"Conversion failed: {e}")
-            return None
+            return RenderResult(status='error', error=str(e))
+    
+    def convert_mbox(self, input_path: str, output_dir: str = './output',
+                     options: Optional[Dict] = None) -> List[Dict[str, Any]]:
+        """
+        Convert every message of an MBOX file to its own PDF.
+        
+        Parsing runs in a background thread feeding a bounded queue, so
+        the renderer always has the next message ready without the whole
+        mailbox being held in memory.
+        
+        Args:
+            input_path: Path to MBOX file
+            output_dir: Output directory for PDFs
+            options: Optional conversion options
+            
+        Returns:
+            One result dictionary per message, in mailbox order
+        """
+        options = options or {}
+        input_file = Path(input_path)
+        output_dir_path = Path(output_dir)
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+        
+        if not input_file.exists():
+            self.logger.error(f"Input file not found: {input_path}")
+            return []
+        
+        if options.get('merge'):
+            return self.convert_mbox_merged(input_path, output_dir, options)
+        
+        # Large mailboxes are sharded across processes when several jobs are allowed
+        jobs = options.get('jobs') or 1
+        threshold = options.get('shard_threshold', self.SHARD_THRESHOLD)
+        if jobs > 1 and not options.get('incremental') and input_file.stat().st_size >= threshold:
+            return self.convert_mbox_parallel(input_path, output_dir, options)
+        
+        # Incremental runs seek straight to messages appended since last time
+        mbox_index = None
+        if options.get('incremental'):
+            mbox_index = MBOXParser.load_index(input_file)
+            first = mbox_index.converted
+            entries = ((n, mbox_index.read_raw(n)) for n in range(first, len(mbox_index)))
+            self.logger.info(f"MBOX {input_file.name}: {len(mbox_index) - first} new message(s) since last run")
+        else:
+            entries = enumerate(view for _, view in MBOXParser.iter_entry_views(input_file))
+        
+        pending: queue.Queue = queue.Queue(maxsize=options.get('queue_size', 8))
+        done = object()
+        # Set when the consumer gives up, so the producer never blocks on a full queue
+        stop = threading.Event()
+        
+        def offer(item: Any) -> bool:
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def produce() -> None:
+            try:
+                for index, raw in entries:
+                    try:
+                        item = (index, EMLParser._extract_message(MBOXParser.parse_raw(raw)))
+                    except Exception as e:
+                        item = (index, e)
+                    if not offer(item):
+                        return
+            except Exception as e:
+                self.logger.error(f"Error reading MBOX {input_file}: {e}")
+            finally:
+                offer(done)
+        
+        producer = threading.Thread(target=produce, name='mbox-parser', daemon=True)
+        producer.start()
+        
+        results = []
+        try:
+            while True:
+                item = pending.get()
+                if item is done:
+                    break
+                index, parsed = item
+                results.append(self._convert_mbox_entry(input_file, output_dir_path, index, parsed, options))
+        finally:
+            stop.set()
+            producer.join()
+        if mbox_index is not None:
+            # Only the successes before the first failure count as done, so
+            # the next incremental run retries from the failed message on
+            converted = first
+            for result in results:
+                if result['status'] != 'success':
+                    break
+                converted = result['index'] + 1
+            mbox_index.mark_converted(converted)
+        success = sum(1 for r in results if r['status'] == 'success')
+        self.logger.info(f"MBOX {input_file.name}: {success}/{len(results)} messages converted")
+        return results
+    
+    def convert_mbox_parallel(self, input_path: str, output_dir: str = './output',
+                              options: Optional[Dict] = None) -> List[Dict[str, Any]]:
+        """
+        Convert a large MBOX across worker processes by byte-range sharding.
+        
+        The mailbox is cut into ranges aligned on From_ lines. A first pass
+        counts the messages of each range so every worker knows the global
+        index of its first message; output names and result order are
+        therefore the same as convert_mbox whatever the worker count.
+        
+        Args:
+            input_path: Path to MBOX file
+            output_dir: Output directory for PDFs
+            options: Optional conversion options ('jobs', 'shards_per_job')
+            
+        Returns:
+            One result dictionary per message, in mailbox order
+        """
+        options = options or {}
+        input_file = Path(input_path)
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        
+        if not input_file.exists():
+            self.logger.error(f"Input file not found: {input_path}")
+            return []
+        
+        jobs = max(1, int(options.get('jobs') or os.cpu_count() or 1))
+        shards = MBOXParser.shard_ranges(input_file, jobs * options.get('shards_per_job', 4))
+        self.logger.info(f"MBOX {input_file.name}: {len(shards)} shard(s) across {jobs} worker(s)")
+        
+        worker_options = {k: v for k, v in options.items() if k != 'jobs'}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            counts = list(pool.map(_count_mbox_range, [(str(input_file), a, b) for a, b in shards]))
+        
+        tasks = []
+        base = 0
+        for (start, end), count in zip(shards, counts):
+            tasks.append((self.config, str(input_file), str(output_dir), worker_options, start, end, base))
+            base += count
+        
+        # A shard whose worker crashes is re-run message by message, so only
+        # the message that kills its worker is lost
+        results: List[Dict[str, Any]] = []
+        for task, shard_results in _ordered_map(_convert_mbox_range, tasks, jobs, jobs * 2):
+            if isinstance(shard_results, Exception):
+                self.logger.warning(f"MBOX {input_file.name}: shard at byte {task[4]} failed ({shard_results}), "
+                                    f"retrying its messages one by one")
+                shard_results = self._convert_mbox_messages(task, jobs)
+            results.extend(shard_results)
+        
+        success = sum(1 for r in results if r['status'] == 'success')
+        self.logger.info(f"MBOX {input_file.name}: {success}/{len(results)} messages converted")
+        return results
+    
+    def _convert_mbox_messages(self, shard: Tuple[Dict, str, str, Dict, int, int, int],
+                               jobs: int) -> List[Dict[str, Any]]:
+        """Convert the messages of a failed shard as one task each."""
+        config, path, output_dir, options, start, end, base = shard
+        spans = [(offset, offset + len(view)) for offset, view in MBOXParser.iter_entry_views(Path(path), start, end)]
+        tasks = [(config, path, output_dir, options, a, b, base + n) for n, (a, b) in enumerate(spans)]
+        
+        results: List[Dict[str, Any]] = []
+        for task, outcome in _ordered_map(_convert_mbox_range, tasks, jobs, jobs * 2):
+            if isinstance(outcome, Exception):
+                index = task[6]
+                self.logger.error(f"MBOX message {index} of {Path(path).name} failed its worker: {outcome}")
+                outcome = [{
+                    'input': Path(path).name,
+                    'index': index,
+                    'message_id': None,
+                    'subject': None,
+                    'output': None,
+                    'status': 'crashed' if isinstance(outcome, concurrent.futures.process.BrokenProcessPool)
+                              else 'error',
+                    'error': f"Conversion worker failed: {outcome}"
+                }]
+            results.extend(outcome)
+        return results
+    
+    def convert_mbox_merged(self, input_path: str, output_dir: str = './output',
+                            options: Optional[Dict] = None) -> List[Dict[str, Any]]:
+        """
+        Convert an MBOX file to one PDF per mailbox or per thread.
+        
+        ``options['merge']`` selects 'mailbox' (one document) or 'thread'
+        (one document per conversation). Each message starts a new page and
+        gets an outline entry; documents are streamed to disk as they are
+        rendered.
+        
+        Returns:
+            One result dictionary per message, in document order, whose
+            'output' is the merged PDF holding it
+        """
+        options = options or {}
+        input_file = Path(input_path)
+        output_dir_path = Path(output_dir)
+        output_dir_path.mkdir(parents=True, exist_ok=True)
+        
+        if options.get('merge') == 'thread':
+            groups = MBOXParser.thread_groups(input_file)
+        else:
+            groups = [[(index, offset, len(view)) for index, (offset, view)
+                       in enumerate(MBOXParser.iter_entry_views(input_file))]]
+        
+        results: List[Dict[str, Any]] = []
+        for number, spans in enumerate(groups, 1):
+            if not spans:
+                continue
+            if options.get('merge') == 'thread':
+                pdf_path = output_dir_path / f"{input_file.stem}_thread_{number:04d}.pdf"
+            else:
+                pdf_path = output_dir_path / f"{input_file.stem}.pdf"
+            
+            parsed = {}
+            attachments: Dict[int, List[str]] = {}
+            
+            def messages() -> Iterator[Union[EmailMessage, Exception]]:
+                for index, email_msg in MBOXParser.iter_spans(input_file, spans):
+                    if not isinstance(email_msg, Exception):
+                        parsed[index] = (email_msg.headers or {}).get('Message-ID')
+                        if options.get('extract_attachments') and email_msg.attachments:
+                            stem = Path(self._message_pdf_name(input_file.stem, index, email_msg)).stem
+                            attachments[index] = AttachmentStore(output_dir_path).extract(
+                                email_msg, output_dir_path / f"{stem}_attachments")
+                    yield email_msg
+            
+            batch = PDFGenerator.render_batch(messages(), pdf_path, options)
+            for (index, _, _), message in zip(spans, batch['messages']):
+                results.append({
+                    'input': input_file.name,
+                    'index': index,
+                    'message_id': parsed.get(index),
+                    'subject': message['subject'],
+                    'output': batch['output'] if message['status'] == 'success' else None,
+                    'status': message['status'] if batch['output'] else 'error',
+                    'engine': message['engine'],
+                    'error': message.get('error') or batch.get('error'),
+                    'attachments': attachments.get(index, [])
+                })
+        
+        documents = len({r['output'] for r in results if r['output']})
+        self.logger.info(f"MBOX {input_file.name}: {sum(1 for r in results if r['output'])}/{len(results)} "
+                         f"messages merged into {documents} PDF(s)")
+        return results
+    
+    def _convert_mbox_entry(self, input_file: Path, output_dir: Path, index: int,
+                            parsed: Union[EmailMessage, Exception], options: Dict) -> Dict[str, Any]:
+        """Render one parsed MBOX message and describe the outcome."""
+        result: Dict[str, Any] = {
+            'input': input_file.name,
+            'index': index,
+            'message_id': None,
+            'subject': None,
+            'output': None,
+            'status': 'error'
+        }
+        
+        if isinstance(parsed, Exception):
+            result['error'] = f"Parse failed: {parsed}"
+            self.logger.warning(f"MBOX message {index} of {input_file.name}: {parsed}")
+            return result
+        
+        result['message_id'] = (parsed.headers or {}).get('Message-ID')
+        result['subject'] = str(parsed.subject)
+        pdf_path = output_dir / self._message_pdf_name(input_file.stem, index, parsed)
+        if options.get('extract_attachments') and parsed.attachments:
+            result['attachments'] = AttachmentStore(output_dir).extract(
+                parsed, output_dir / f"{pdf_path.stem}_attachments")
+        rendered = self._render(parsed, pdf_path, options)
+        result['status'] = rendered.status
+        result['engine'] = rendered.engine
+        result['degraded'] = rendered.degraded
+        if rendered.ok:
+            result['output'] = str(pdf_path)
+        else:
+            result['error'] = rendered.error or 'PDF generation failed'
+        return result
+    
+    @staticmethod
+    def _message_pdf_name(stem: str, index: int, email_msg: EmailMessage) -> str:
+        """Build a stable PDF name from the mailbox position and Message-ID."""
+        name = f"{stem}_{index + 1:05d}"
+        message_id = (email_msg.headers or {}).get('Message-ID')
+        if message_id:
+            digest = hashlib.sha1(str(message_id).strip().encode('utf-8', 'replace')).hexdigest()
+            name += f"_{digest[:8]}"
+        return name + '.pdf'
     
-    def get_preview_html(self, input_path: str) -> Optional[str]:
+    def get_preview_html(self, input_path: str, message_index: int = 0, options: Dict = None) -> Optional[str]:
         """
         Get HTML preview of an email file.
         
         Args:
             input_path: Path to email file
+            message_index: Message to preview when the file is an MBOX
+            options: Page options and ``style`` theme overrides
             
         Returns:
             HTML string or None on failure
@@ -720,29 +4074,42 @@ class EmailConverter:
             if format_type == 'msg':
                 email_msg = MSGParser.parse(input_file)
             elif format_type == 'mbox':
-                messages = MBOXParser.parse(input_file)
-                if not messages:
-                    return None
-                email_msg = messages[0]
+                if message_index:
+                    index = MBOXParser.load_index(input_file)
+                    if message_index >= len(index):
+                        return None
+                    email_msg = index.message(message_index)
+                else:
+                    email_msg = next(MBOXParser.iter_messages(input_file), None)
+                    if email_msg is None:
+                        return None
             else:  # eml, zip, or unknown
                 email_msg = EMLParser.parse(input_file)
             
             # Generate HTML
-            return PDFGenerator._create_html(email_msg)
+            return PDFGenerator._create_html(email_msg, options)
         
         except Exception as e:
             self.logger.error(f"Preview failed: {e}")
             return None
 
     def convert_directory(self, input_dir: str, output_dir: str = './output',
-                         recursive: bool = False) -> List[str]:
+                         recursive: bool = False, jobs: Optional[int] = None,
+                         options: Optional[Dict] = None) -> List[str]:
         """
         Convert all emails in directory to PDFs.
         
+        Files are converted in a process pool (WeasyPrint is CPU-bound and
+        holds the GIL) sized from ``jobs`` or PERFORMANCE_CONFIG['thread_count'].
+        At most ``batch_size`` files per worker are in flight, results are
+        reported in input order and a failing file never stops the batch.
+        
         Args:
             input_dir: Input directory containing email files
             output_dir: Output directory for PDFs
             recursive: Whether to scan subdirectories
+            jobs: Worker processes (1 converts inline)
+            options: Optional conversion options
             
         Returns:
             List of successfully converted PDF paths
@@ -765,21 +4132,87 @@ class EmailConverter:
         for ext in email_extensions:
             files.extend(input_path.glob(pattern + ext))
         
-        self.logger.info(f"Found {len(files)} email files to process")
+        jobs = max(1, int(jobs or self.config.get('jobs') or PERFORMANCE_CONFIG['thread_count']))
+        window = jobs * max(1, int(PERFORMANCE_CONFIG['batch_size']))
+        self.logger.info(f"Found {len(files)} email files to process with {jobs} worker(s)")
+        
+        tasks = [(self.config, str(file_path), str(output_path), options or {}) for file_path in files]
+        outcomes = _ordered_map(_convert_file_task, tasks, jobs, window)
         
-        for idx, file_path in enumerate(files, 1):
-            self.logger.info(f"Processing {idx}/{len(files)}: {file_path}")
+        elapsed = encoding_seconds = 0.0
+        cache_hits = degraded = 0
+        for idx, (task, outcome) in enumerate(outcomes, 1):
+            file_path = task[1]
+            if isinstance(outcome, Exception):
+                outcome = {'input': file_path, 'outputs': [], 'status': 'error', 'error': str(outcome)}
             
-            pdf_path = self.convert_email(str(file_path), str(output_path))
-            if pdf_path:
+            self.logger.info(f"Processed {idx}/{len(files)}: {file_path}")
+            elapsed += outcome.get('elapsed', 0.0)
+            encoding_seconds += outcome.get('encoding_seconds', 0.0)
+            cache_hits += outcome.get('cache_hits', 0)
+            degraded += outcome.get('degraded', 0)
+            for pdf_path in outcome['outputs']:
                 print(f"Converted: {pdf_path}")
                 results.append(pdf_path)
-            else:
-                print(f"Conversion failed for {file_path}")
+            for message in outcome.get('messages', []):
+                if message['status'] != 'success':
+                    print(f"Conversion failed for {file_path} message {message['index'] + 1}: {message.get('error')}")
+            if outcome['status'] != 'success':
+                print(f"Conversion failed for {file_path}: {outcome.get('error')}")
         
-        self.logger.info(f"Conversion complete: {len(results)}/{len(files)} successful")
+        self.logger.info(f"Conversion complete: {len(results)} PDF(s) from {len(files)} file(s)")
+        if degraded:
+            self.logger.warning(f"{degraded} PDF(s) degraded to the text layout")
+        if (options or {}).get('use_cache', PERFORMANCE_CONFIG['use_cache']) and files:
+            self.logger.info(f"Conversion cache: {cache_hits}/{len(files)} file(s) served from cache "
+                             f"({100 * cache_hits / len(files):.1f}%)")
+        if elapsed:
+            self.logger.info(f"Charset decoding: {encoding_seconds:.2f}s of {elapsed:.2f}s "
+                             f"conversion time ({100 * encoding_seconds / elapsed:.1f}%)")
         return results
     
+    def convert_file(self, input_path: str, output_dir: str = './output',
+                     options: Optional[Dict] = None) -> Dict[str, Any]:
+        """
+        Convert one input file, fanning MBOX files out to one PDF per message.
+        
+        Returns:
+            Dictionary with 'input', 'outputs', 'status', 'error', the
+            number of 'degraded' (text layout) outputs, the extracted
+            'attachments' and, for MBOX files, the per-message 'messages'
+            results
+        """
+        result: Dict[str, Any] = {'input': str(input_path), 'outputs': [], 'status': 'error'}
+        started = time.perf_counter()
+        decoding_before = EncodingManager.get_stats()['decode_seconds']
+        hits_before = self.cache.hits
+        
+        if Path(input_path).exists() and self.detector.detect_format(Path(input_path)) == 'mbox':
+            messages = self.convert_mbox(input_path, output_dir, options)
+            result['messages'] = messages
+            result['outputs'] = list(dict.fromkeys(m['output'] for m in messages if m['status'] == 'success'))
+            result['degraded'] = sum(1 for m in messages if m.get('degraded'))
+            result['attachments'] = [path for m in messages for path in m.get('attachments', [])]
+            failed = sum(1 for m in messages if m['status'] != 'success')
+            if messages and not failed:
+                result['status'] = 'success'
+            else:
+                result['error'] = f"{failed}/{len(messages)} message(s) failed" if messages else 'No messages found'
+        else:
+            rendered = self._convert_email(input_path, output_dir, options)
+            result['status'] = rendered.status
+            result['degraded'] = 1 if rendered.degraded else 0
+            result['attachments'] = rendered.attachments
+            if rendered.ok:
+                result['outputs'] = [rendered.output]
+            else:
+                result['error'] = rendered.error or 'PDF generation failed'
+        
+        result['cache_hits'] = self.cache.hits - hits_before
+        result['elapsed'] = time.perf_counter() - started
+        result['encoding_seconds'] = EncodingManager.get_stats()['decode_seconds'] - decoding_before
+        return result
+    
     def validate(self, input_path: str) -> Dict[str, Any]:
         """
         Validate email file without conversion.
@@ -805,20 +4238,180 @@ class EmailConverter:
         results['size'] = input_file.stat().st_size
         results['format'] = self.detector.detect_format(input_file)
         
+        # Only headers are parsed: validating needs no payload decoding
         try:
             if results['format'] == 'msg':
                 MSGParser.parse(input_file)
             elif results['format'] == 'mbox':
-                messages = MBOXParser.parse(input_file)
-                results['messages'] = len(messages)
-            else:
-                EMLParser.parse(input_file)
+                results['messages'] = MBOXParser.count_messages(input_file)
+            elif not EMLParser.parse_headers(input_file).headers:
+                raise ValueError("No email headers found")
             
             results['parseable'] = True
         except Exception as e:
             results['errors'].append(str(e))
         
         return results
+    
+    def get_metadata(self, input_path: str, skeleton: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Describe an email file from its headers, without decoding any body.
+        
+        Args:
+            input_path: Path to email file
+            skeleton: Also walk the MIME structure to list attachments
+            
+        Returns:
+            Dictionary of header metadata or None on failure
+        """
+        input_file = Path(input_path)
+        if not input_file.exists():
+            return None
+        
+        format_type = self.detector.detect_format(input_file)
+        metadata: Dict[str, Any] = {'file': input_file.name, 'format': format_type,
+                                    'size': input_file.stat().st_size}
+        
+        try:
+            if format_type == 'mbox':
+                metadata['messages'] = MBOXParser.count_messages(input_file)
+                return metadata
+            if format_type == 'msg':
+                email_msg = MSGParser.parse(input_file)
+            else:
+                email_msg = EMLParser.parse_headers(input_file, skeleton=skeleton)
+        except Exception as e:
+            self.logger.error(f"Metadata failed: {e}")
+            return None
+        
+        metadata.update({
+            'subject': str(email_msg.subject),
+            'sender': str(email_msg.sender),
+            'recipients': email_msg.recipients,
+            'date': str(email_msg.date),
+            'message_id': (email_msg.headers or {}).get('Message-ID')
+        })
+        if skeleton or format_type == 'msg':
+            metadata['attachments'] = email_msg.attachments
+        return metadata
+
+
+# ============================================================================
+# WORKER PROCESS ENTRY POINTS
+# ============================================================================
+
+def _ordered_map(fn, tasks: List[Any], jobs: int, window: int) -> Iterator[Tuple[Any, Any]]:
+    """
+    Run ``fn`` over ``tasks`` in a process pool, yielding (task, result) in order.
+    
+    No more than ``window`` tasks are in flight. Exceptions are yielded as
+    results. If a worker dies, the pool is rebuilt and the in-flight tasks
+    are re-run one at a time, so a crashing file only fails itself.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            try:
+                yield task, fn(task)
+            except Exception as e:
+                yield task, e
+        return
+    
+    todo = iter(tasks)
+    # (task, future, run alone) in task order
+    in_flight: collections.deque = collections.deque()
+    # Tasks caught in a broken pool, with their future if it had already
+    # succeeded; re-run one at a time so the one that crashes is known
+    suspects: collections.deque = collections.deque()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    completed = False
+    
+    def submit(task: Any) -> concurrent.futures.Future:
+        # A pool may break before the failed future reaches the head of the
+        # queue: later tasks then join the suspects like those in flight
+        try:
+            return pool.submit(fn, task)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            future.set_exception(e)
+            return future
+    
+    try:
+        while True:
+            if suspects:
+                if not in_flight:
+                    task, future = suspects.popleft()
+                    in_flight.append((task, future or submit(task), True))
+            else:
+                while len(in_flight) < window:
+                    task = next(todo, None)
+                    if task is None:
+                        break
+                    in_flight.append((task, submit(task), False))
+            if not in_flight:
+                completed = True
+                return
+            
+            task, future, alone = in_flight.popleft()
+            try:
+                yield task, future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # The pool is unusable: rebuild it
+                pool.shutdown(wait=False)
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+                if alone:
+                    yield task, e
+                    continue
+                suspects.append((task, None))
+                for t, f, _ in in_flight:
+                    succeeded = f.done() and not f.cancelled() and f.exception() is None
+                    suspects.append((t, f if succeeded else None))
+                in_flight.clear()
+            except Exception as e:
+                yield task, e
+    finally:
+        if completed:
+            pool.shutdown(wait=True)
+        else:
+            for _, future, _ in in_flight:
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _worker_config(config: Dict) -> Dict:
+    """Converter config for a pool worker, which renders in its own process."""
+    return dict(config, isolate_render=False)
+
+
+def _convert_file_task(args: Tuple[Dict, str, str, Dict]) -> Dict[str, Any]:
+    """Convert one file of a directory batch (runs in a worker)."""
+    config, path, output_dir, options = args
+    try:
+        return EmailConverter(_worker_config(config)).convert_file(path, output_dir, options)
+    except Exception as e:
+        return {'input': path, 'outputs': [], 'status': 'error', 'error': str(e)}
+
+
+def _count_mbox_range(args: Tuple[str, int, int]) -> int:
+    """Count the messages of one MBOX byte range (runs in a worker)."""
+    path, start, end = args
+    return MBOXParser.count_messages(Path(path), start, end)
+
+
+def _convert_mbox_range(args: Tuple[Dict, str, str, Dict, int, int, int]) -> List[Dict[str, Any]]:
+    """Convert the messages of one MBOX byte range (runs in a worker)."""
+    config, path, output_dir, options, start, end, base = args
+    converter = EmailConverter(_worker_config(config))
+    input_file = Path(path)
+    results = []
+    
+    for offset, (_, view) in enumerate(MBOXParser.iter_entry_views(input_file, start, end)):
+        try:
+            parsed: Union[EmailMessage, Exception] = EMLParser._extract_message(MBOXParser.parse_raw(view))
+        except Exception as e:
+            parsed = e
+        results.append(converter._convert_mbox_entry(input_file, Path(output_dir), base + offset, parsed, options))
+    
+    return results
 
 
 # ============================================================================
@@ -835,8 +4428,11 @@ def create_argument_parser() -> argparse.ArgumentParser:
 Examples:
   python main.py -i email.eml -o ./pdfs
   python main.py -i ./emails -o ./pdfs -r -v
+  python main.py -i ./emails -o ./pdfs -r --jobs 8
   python main.py -i email.msg --validate
   python main.py -i test.mbox -o ./out --config custom.py
+  python main.py -i export.mbox -o ./out --merge thread
+  python main.py -i ./emails -o ./pdfs --remote allow --allow-host ville-fontaine.fr
         """
     )
     
@@ -864,6 +4460,62 @@ Examples:
         '--config',
         help='Optional configuration file'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help='Worker processes for directories and large MBOX files '
+             '(default: PERFORMANCE_CONFIG thread_count)'
+    )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Reuse PDFs of identical inputs from the conversion cache'
+    )
+    parser.add_argument(
+        '--attachments',
+        action='store_true',
+        help='Extract attachments next to each PDF (identical files stored once)'
+    )
+    parser.add_argument(
+        '--embed-attachments',
+        action='store_true',
+        help='Carry the original attachments inside each PDF, up to embed_max_bytes per message'
+    )
+    parser.add_argument(
+        '--append-attachments',
+        action='store_true',
+        help='Add image and PDF attachments as pages after each message'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['auto', 'html', 'text'],
+        default='auto',
+        help='Renderer: text engine for plain-text messages, WeasyPrint for HTML '
+             '(auto, default), or force one for every message'
+    )
+    parser.add_argument(
+        '--merge',
+        choices=['mailbox', 'thread'],
+        help='Render an MBOX as one PDF per mailbox or per thread, '
+             'with a bookmark per message'
+    )
+    parser.add_argument(
+        '--remote',
+        choices=list(ResourceFetcher.POLICIES),
+        help='Remote images, fonts and stylesheets: block, allow (only --allow-host '
+             'hosts) or fetch (default from REMOTE_RESOURCE_CONFIG)'
+    )
+    parser.add_argument(
+        '--allow-host',
+        action='append',
+        metavar='HOST',
+        help='Host (subdomains included) fetched under --remote allow; repeatable'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only convert MBOX messages appended since the last run'
+    )
     parser.add_argument(
         '--validate',
         action='store_true',
@@ -906,10 +4558,40 @@ def main():
                     logger.info(f"Validation: {file_path.name} - {result}")
     else:
         # Conversion mode
-        if input_path.is_file():
-            converter.convert_email(str(input_path), args.output)
+        options: Dict[str, Any] = {}
+        if args.cache:
+            options['use_cache'] = True
+        if args.attachments:
+            options['extract_attachments'] = True
+        if args.embed_attachments:
+            options['embed_attachments'] = True
+        if args.append_attachments:
+            options['append_attachments'] = True
+        if args.engine != 'auto':
+            options['engine'] = args.engine
+        if args.merge:
+            options['merge'] = args.merge
+        if args.remote:
+            options['remote_policy'] = args.remote
+        if args.allow_host:
+            options['remote_allow_hosts'] = args.allow_host
+        
+        if input_path.is_file() and converter.detector.detect_format(input_path) == 'mbox':
+            mbox_options = dict(options,
+                                incremental=args.incremental,
+                                jobs=args.jobs or PERFORMANCE_CONFIG['thread_count'])
+            for result in converter.convert_mbox(str(input_path), args.output, mbox_options):
+                if result['status'] == 'success':
+                    print(f"Converted message {result['index'] + 1}: {result['output']}")
+                else:
+                    print(f"Conversion failed for message {result['index'] + 1}: {result.get('error')}")
+        elif input_path.is_file():
+            converter.convert_email(str(input_path), args.output, options)
+            if options.get('use_cache'):
+                logger.info(f"Conversion cache: {converter.cache.stats()}")
         else:
-            converter.convert_directory(str(input_path), args.output, args.recursive)
+            converter.convert_directory(str(input_path), args.output, args.recursive,
+                                        jobs=args.jobs, options=options)
     
     logger.info("Mail2PDF NextGen - Complete")
 
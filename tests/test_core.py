@@ -1,9 +1,12 @@
+import io
 import os
 from pathlib import Path
 import tempfile
+import email
+import email.message
 import pytest
 
-from main import EmailTypeDetector, EncodingManager, EMLParser, EmailConverter
+from main import EmailTypeDetector, EncodingManager, EMLParser, EmailConverter, RenderResult, TextPDFRenderer
 
 
 def test_detect_format_eml(tmp_path):
@@ -30,3 +33,994 @@ def test_convert_email_no_input(tmp_path):
     conv = EmailConverter()
     result = conv.convert_email(str(tmp_path / "nope.eml"), str(tmp_path))
     assert result is None
+
+
+MBOX_SAMPLE = (
+    b"From alice@example.com Mon Jan  1 00:00:00 2024\n"
+    b"From: alice@example.com\nSubject: First\n\nHello\nSent From my phone\n"
+    b"\n"
+    b"From bob@example.com Mon Jan  1 00:00:01 2024\n"
+    b"From: bob@example.com\nSubject: Second\n"
+    b"Content-Type: text/plain; charset=iso-8859-1\n\nCaf\xe9\n"
+    b"\n"
+    b"From carol@example.com Mon Jan  1 00:00:02 2024\n"
+    b"From: carol@example.com\nSubject: Third\n\nBye\n"
+)
+
+
+def test_mbox_iter_messages_streams_each_message(tmp_path):
+    from main import MBOXParser
+    f = tmp_path / "box.mbox"
+    f.write_bytes(MBOX_SAMPLE)
+    it = MBOXParser.iter_messages(f)
+    first = next(it)
+    assert first.subject == 'First'
+    assert 'Sent From my phone' in first.body
+    rest = list(it)
+    assert [m.subject for m in rest] == ['Second', 'Third']
+    assert 'Café' in rest[0].body
+
+
+def test_convert_mbox_renders_every_message(tmp_path, monkeypatch):
+    from main import PDFGenerator
+    rendered = []
+
+    def fake_render(email_msg, output_path, options=None):
+        rendered.append(email_msg.subject)
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    f = tmp_path / "box.mbox"
+    f.write_bytes(MBOX_SAMPLE)
+    results = EmailConverter().convert_mbox(str(f), str(tmp_path / "out"))
+    assert [r['index'] for r in results] == [0, 1, 2]
+    assert rendered == ['First', 'Second', 'Third']
+    assert all(r['status'] == 'success' for r in results)
+    assert Path(results[0]['output']).name == 'box_00001.pdf'
+
+
+def test_mbox_index_appends_and_invalidates(tmp_path):
+    from main import MBOXParser, MBOXIndex
+    f = tmp_path / "box.mbox"
+    f.write_bytes(MBOX_SAMPLE)
+    index = MBOXParser.load_index(f)
+    assert len(index) == 3
+    assert (tmp_path / ("box.mbox" + MBOXIndex.SUFFIX)).exists()
+    assert index.message(2).subject == 'Third'
+    index.mark_converted(3)
+
+    with open(f, 'ab') as fh:
+        fh.write(b"\nFrom dave@example.com Mon Jan  1 00:00:03 2024\n"
+                 b"From: dave@example.com\nSubject: Fourth\n\nNew\n")
+    index = MBOXIndex(f)
+    assert index.refresh() == 1
+    assert index.converted == 3
+    assert MBOXParser.read_message(f, 3).subject == 'Fourth'
+
+    f.write_bytes(MBOX_SAMPLE.replace(b'First', b'Rewritten'))
+    index = MBOXParser.load_index(f)
+    assert index.converted == 0
+    assert index.message(0).subject == 'Rewritten'
+
+
+def test_mbox_shard_ranges_align_on_from_lines(tmp_path):
+    from main import MBOXParser
+    f = tmp_path / "box.mbox"
+    f.write_bytes(MBOX_SAMPLE * 5)
+    ranges = MBOXParser.shard_ranges(f, 4)
+    assert ranges[0][0] == 0 and ranges[-1][1] == f.stat().st_size
+    data = f.read_bytes()
+    for start, _end in ranges:
+        assert data[start:start + 5] == b'From '
+    counts = [sum(1 for _ in MBOXParser.iter_raw_entries(f, a, b)) for a, b in ranges]
+    assert sum(counts) == 15
+
+
+def test_convert_mbox_parallel_matches_serial_order(tmp_path):
+    f = tmp_path / "box.mbox"
+    f.write_bytes(MBOX_SAMPLE * 4)
+    conv = EmailConverter()
+    serial = conv.convert_mbox(str(f), str(tmp_path / "serial"))
+    parallel = conv.convert_mbox(str(f), str(tmp_path / "parallel"),
+                                 {'jobs': 2, 'shard_threshold': 0})
+    assert [r['index'] for r in parallel] == list(range(12))
+    assert [r['subject'] for r in parallel] == [r['subject'] for r in serial]
+    assert [r['status'] for r in parallel] == [r['status'] for r in serial]
+
+
+def test_convert_mbox_parallel_blames_only_the_crashing_message(tmp_path, monkeypatch):
+    from main import PDFGenerator
+
+    def fake_render(email_msg, output_path, options=None):
+        if email_msg.subject == 'Crash':
+            os._exit(1)
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    f = tmp_path / "box.mbox"
+    messages = [b"From a@example.com Mon Jan  1 00:00:00 2024\nFrom: a@example.com\nSubject: "
+                + (b"Crash" if n == 7 else b"Message %d" % n) + b"\n\nBody\n\n" for n in range(20)]
+    f.write_bytes(b''.join(messages))
+    results = EmailConverter({'isolate_render': False}).convert_mbox(
+        str(f), str(tmp_path / "out"), {'jobs': 2, 'shard_threshold': 0})
+    assert [r['index'] for r in results] == list(range(20))
+    assert [r['index'] for r in results if r['status'] != 'success'] == [7]
+    assert results[7]['status'] == 'crashed'
+
+
+def test_mbox_entry_views_are_zero_copy_and_unescape_from(tmp_path):
+    from main import MBOXParser
+    f = tmp_path / "box.mbox"
+    f.write_bytes(b"From a@example.com Mon Jan  1 00:00:00 2024\n"
+                  b"Subject: Escaped\n\n>From here on\n>>From quoted\n\n" + MBOX_SAMPLE)
+    entries = list(MBOXParser.iter_entry_views(f))
+    assert len(entries) == 4
+    assert all(isinstance(view, memoryview) for _, view in entries)
+    assert MBOXParser.count_messages(f) == 4
+    body = MBOXParser.parse_raw(entries[0][1]).get_payload()
+    assert body.splitlines() == ['From here on', '>From quoted']
+
+
+def test_ordered_map_keeps_order_and_isolates_failures():
+    from main import _ordered_map
+    tasks = ['1', '22', 'x', '4444', '5']
+    outcomes = list(_ordered_map(int, tasks, jobs=2, window=2))
+    assert [t for t, _ in outcomes] == tasks
+    assert [r for _, r in outcomes if not isinstance(r, Exception)] == [1, 22, 4444, 5]
+    assert isinstance(outcomes[2][1], ValueError)
+
+
+def _crash_on_x(task):
+    if task == 'x':
+        os._exit(1)
+    if task == 'slow':
+        import time
+        time.sleep(0.5)
+    return len(task)
+
+
+def test_ordered_map_blames_only_the_crashing_task():
+    from concurrent.futures.process import BrokenProcessPool
+    from main import _ordered_map
+    tasks = ['slow', 'x', 'ab', 'abc']
+    outcomes = list(_ordered_map(_crash_on_x, tasks, jobs=2, window=3))
+    assert [t for t, _ in outcomes] == tasks
+    assert isinstance(outcomes[1][1], BrokenProcessPool)
+    assert [r for _, r in outcomes if not isinstance(r, Exception)] == [4, 2, 3]
+
+    # Tasks submitted after the pool broke are retried too
+    tasks = ['x'] + ['a' * n for n in range(1, 12)]
+    outcomes = list(_ordered_map(_crash_on_x, tasks, jobs=2, window=12))
+    assert [t for t, _ in outcomes] == tasks
+    assert [r for _, r in outcomes if not isinstance(r, Exception)] == list(range(1, 12))
+
+
+def test_convert_directory_parallel(tmp_path, monkeypatch):
+    from main import PDFGenerator
+
+    def fake_render(email_msg, output_path, options=None):
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    src = tmp_path / "in"
+    src.mkdir()
+    for name in ('a', 'b', 'c'):
+        (src / f"{name}.eml").write_bytes(b"From: a@b.com\nSubject: " + name.encode() + b"\n\nBody")
+    (src / "box.mbox").write_bytes(MBOX_SAMPLE)
+    results = EmailConverter().convert_directory(str(src), str(tmp_path / "out"), jobs=2)
+    assert sorted(Path(r).name for r in results) == [
+        'a.pdf', 'b.pdf', 'box_00001.pdf', 'box_00002.pdf', 'box_00003.pdf', 'c.pdf']
+
+
+def test_mbox_producer_stops_when_conversion_raises(tmp_path, monkeypatch):
+    import threading
+
+    def explode(self, *args):
+        raise RuntimeError('renderer crashed')
+
+    monkeypatch.setattr(EmailConverter, '_convert_mbox_entry', explode)
+    box = tmp_path / "box.mbox"
+    box.write_bytes(MBOX_SAMPLE * 20)
+    errors = []
+
+    def run():
+        try:
+            EmailConverter().convert_mbox(str(box), str(tmp_path / "out"), {'queue_size': 1})
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive() and errors
+    assert not any(t.name == 'mbox-parser' and t.is_alive() for t in threading.enumerate())
+
+
+def test_incremental_mbox_retries_failed_messages(tmp_path, monkeypatch):
+    from main import MBOXParser, PDFGenerator
+    failing = {'Second'}
+    rendered = []
+
+    def fake_render(email_msg, output_path, options=None):
+        rendered.append(email_msg.subject)
+        if email_msg.subject in failing:
+            return RenderResult(status='error', error='boom')
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    box = tmp_path / "box.mbox"
+    box.write_bytes(MBOX_SAMPLE)
+    converter = EmailConverter({'isolate_render': False})
+    converter.convert_mbox(str(box), str(tmp_path / "out"), {'incremental': True})
+    assert MBOXParser.load_index(box).converted == 1
+
+    failing.clear()
+    rendered.clear()
+    converter.convert_mbox(str(box), str(tmp_path / "out"), {'incremental': True})
+    assert rendered == ['Second', 'Third']
+    assert MBOXParser.load_index(box).converted == 3
+
+
+def test_extract_message_estimates_attachment_size_without_decoding(tmp_path, monkeypatch):
+    import base64
+    import email.message as em
+    content = bytes(range(256)) * 40
+    f = tmp_path / "att.eml"
+    f.write_bytes(
+        b"From: a@b.com\nSubject: Att\nMIME-Version: 1.0\n"
+        b"Content-Type: multipart/mixed; boundary=XX\n\n"
+        b"--XX\nContent-Type: text/plain\n\nSee attached\n"
+        b"--XX\nContent-Type: application/octet-stream\n"
+        b"Content-Disposition: attachment; filename=data.bin\n"
+        b"Content-Transfer-Encoding: base64\n\n"
+        + base64.encodebytes(content) + b"--XX--\n")
+
+    decoded = []
+    original = em.Message.get_payload
+
+    def spy(self, i=None, decode=False):
+        if decode and self.get_filename():
+            decoded.append(self.get_filename())
+        return original(self, i, decode)
+
+    monkeypatch.setattr(em.Message, 'get_payload', spy)
+    msg = EMLParser.parse(f)
+    assert msg.body.strip() == 'See attached'
+    assert msg.attachments[0]['size'] == len(content)
+    assert decoded == []
+    assert msg.get_attachment_payload(0) == content
+    assert decoded == ['data.bin']
+
+
+def test_encoding_fast_path_and_stats():
+    EncodingManager.reset_stats()
+    assert EncodingManager.detect_and_decode(b'plain ascii') == 'plain ascii'
+    assert EncodingManager.detect_and_decode('Café'.encode('utf-8')) == 'Café'
+    assert EncodingManager.detect_and_decode(b'\xff\xfe broken', 'not-a-codec')
+    stats = EncodingManager.get_stats()
+    assert stats['calls'] == 3
+    assert stats['fast_path'] == 2
+    assert stats['decode_seconds'] >= stats['detect_seconds'] >= 0
+
+
+def test_encoding_decision_cache_remembers_mislabelled_sender():
+    EncodingManager.clear_decisions()
+    EncodingManager.reset_stats()
+    data = 'Réunion à 14h'.encode('cp1252')
+    context = ('list.example.org', 'mailer 1.0')
+    first = EncodingManager.detect_and_decode(data, 'utf-8', context)
+    second = EncodingManager.detect_and_decode(data, 'utf-8', context)
+    assert first == second
+    stats = EncodingManager.get_stats()
+    assert stats['cache_misses'] == 1
+    assert stats['cache_hits'] == 1
+
+
+def test_encoding_decision_cache_does_not_override_utf8():
+    EncodingManager.clear_decisions()
+    context = ('mairie.example.org', 'mailer 2.0')
+    latin = EncodingManager.detect_and_decode('Réunion à 14h, café offert'.encode('latin-1'), 'us-ascii', context)
+    assert latin == 'Réunion à 14h, café offert'
+    utf8 = EncodingManager.detect_and_decode('Réunion à 14h café'.encode('utf-8'), 'us-ascii', context)
+    assert utf8 == 'Réunion à 14h café'
+    again = EncodingManager.detect_and_decode('Café fermé'.encode('latin-1'), 'us-ascii', context)
+    assert again == 'Café fermé'
+
+
+def test_conversion_cache_serves_identical_input(tmp_path, monkeypatch):
+    from main import PDFGenerator
+    calls = []
+
+    def fake_render(email_msg, output_path, options=None):
+        calls.append(output_path)
+        Path(output_path).write_bytes(b'%PDF-1.4 rendered')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    conv = EmailConverter({'cache_dir': str(tmp_path / "cache")})
+    for name in ('first.eml', 'copy.eml'):
+        (tmp_path / name).write_bytes(b"From: a@b.com\nSubject: News\n\nSame newsletter")
+    options = {'use_cache': True}
+    assert conv.convert_email(str(tmp_path / "first.eml"), str(tmp_path / "out"), options)
+    out = conv.convert_email(str(tmp_path / "copy.eml"), str(tmp_path / "out"), options)
+    assert Path(out).read_bytes() == b'%PDF-1.4 rendered'
+    assert len(calls) == 1
+    assert conv.cache.stats() == {'hits': 1, 'misses': 1, 'hit_ratio': 0.5}
+    conv.convert_email(str(tmp_path / "copy.eml"), str(tmp_path / "out"),
+                       dict(options, page_size='Letter'))
+    assert len(calls) == 2
+
+
+def test_header_only_metadata_skips_payload_decoding(tmp_path, monkeypatch):
+    eml = tmp_path / "big.eml"
+    eml.write_bytes(
+        b"From: a@b.com\nTo: c@d.com, e@f.com\nSubject: Report\nMessage-ID: <r1@b.com>\n"
+        b"MIME-Version: 1.0\nContent-Type: multipart/mixed; boundary=XX\n\n"
+        b"--XX\nContent-Type: text/plain\n\nSee attached\n"
+        b"--XX\nContent-Type: application/pdf\nContent-Disposition: attachment; filename=r.pdf\n"
+        b"Content-Transfer-Encoding: base64\n\n" + b"QUJD" * 1000 + b"\n--XX--\n")
+    get_payload = email.message.Message.get_payload
+
+    def no_decode(self, i=None, decode=False):
+        assert not decode, "payload decoded"
+        return get_payload(self, i)
+
+    monkeypatch.setattr(email.message.Message, 'get_payload', no_decode)
+    headers = EMLParser.parse_headers(eml)
+    assert headers.subject == 'Report'
+    assert headers.recipients == ['c@d.com', 'e@f.com']
+    assert headers.body == '' and headers.attachments == []
+    conv = EmailConverter()
+    meta = conv.get_metadata(str(eml), skeleton=True)
+    assert meta['message_id'] == '<r1@b.com>'
+    assert meta['attachments'] == [{'filename': 'r.pdf', 'content_type': 'application/pdf',
+                                    'size': 3000}]
+    assert conv.validate(str(eml))['parseable']
+    (tmp_path / "junk.eml").write_bytes(b"not an email at all")
+    assert not conv.validate(str(tmp_path / "junk.eml"))['parseable']
+
+
+def test_stylesheet_compiled_once_per_page_setup(monkeypatch):
+    import main
+    from main import PDFGenerator
+    compiled = []
+
+    class FakeCSS:
+        def __init__(self, string, font_config=None):
+            compiled.append(string)
+
+    monkeypatch.setattr(main, 'CSS', FakeCSS)
+    PDFGenerator.clear_stylesheets()
+    first = PDFGenerator.stylesheet({'page_size': 'A4'})
+    assert PDFGenerator.stylesheet({'page_size': 'A4'}) is first
+    PDFGenerator.stylesheet({'page_size': 'Letter', 'orientation': 'landscape'})
+    assert len(compiled) == 2
+    assert 'size: Letter landscape' in compiled[1]
+    PDFGenerator.clear_stylesheets()
+    email_msg = EMLParser._extract_message(email.message_from_string("Subject: Hi\n\nBody"))
+    assert '<style>' not in PDFGenerator._create_html(email_msg, embed_css=False)
+    assert 'size: A4 portrait' in PDFGenerator._create_html(email_msg)
+
+
+def test_render_pool_times_out_and_replaces_worker(tmp_path, monkeypatch):
+    import time
+    from main import PDFGenerator, RenderPool
+
+    def fake_render(email_msg, output_path, options=None):
+        if email_msg.subject == 'Slow' and options.get('engine') != 'text':
+            time.sleep(30)
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path), engine=options.get('engine'))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    pool = RenderPool(workers=1, timeout=0.5, memory_limit=0)
+    try:
+        slow = EMLParser._extract_message(email.message_from_string("Subject: Slow\n\nBody"))
+        fast = EMLParser._extract_message(email.message_from_string("Subject: Fast\n\nBody"))
+        result = pool.render(slow, tmp_path / "slow.pdf")
+        assert result.elapsed < 10
+        assert result.ok and result.engine == 'text' and result.degraded == 'timeout'
+        assert pool.render(fast, tmp_path / "fast.pdf").ok
+        assert (tmp_path / "fast.pdf").exists()
+        assert pool.stats['timeout'] == 1 and pool.stats['replaced'] == 1
+        assert pool.stats['degraded'] == 1
+    finally:
+        pool.close()
+
+
+def test_render_pool_recycles_worker_after_interrupted_render(tmp_path, monkeypatch):
+    from main import PDFGenerator, RenderPool
+
+    def fake_render(email_msg, output_path, options=None):
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path), engine='text',
+                            degraded='timeout' if email_msg.subject == 'Alarm' else None)
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    pool = RenderPool(workers=1, timeout=5, memory_limit=0)
+    try:
+        alarm = EMLParser._extract_message(email.message_from_string("Subject: Alarm\n\nBody"))
+        assert pool.render(alarm, tmp_path / "alarm.pdf").degraded == 'timeout'
+        assert pool.render(alarm, tmp_path / "again.pdf").ok
+        assert pool.stats['replaced'] == 2
+    finally:
+        pool.close()
+
+
+def test_render_pool_reports_worker_resource_counters(tmp_path, monkeypatch):
+    from main import PDFGenerator, RenderPool, ResourceFetcher
+
+    def fake_render(email_msg, output_path, options=None):
+        fetcher = ResourceFetcher(options={'remote_policy': 'block'})
+        with pytest.raises(ValueError):
+            fetcher('https://tracker.example/pixel.gif')
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path), resources=fetcher.stats)
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    before = ResourceFetcher.get_stats()['blocked']
+    pool = RenderPool(workers=1, timeout=5, memory_limit=0)
+    try:
+        email_msg = EMLParser._extract_message(email.message_from_string("Subject: Hi\n\nBody"))
+        assert pool.render(email_msg, tmp_path / "hi.pdf").resources == {'blocked': 1}
+        assert ResourceFetcher.get_stats()['blocked'] == before + 1
+    finally:
+        pool.close()
+
+
+def test_render_pool_replaces_worker_after_unexpected_reply(tmp_path, monkeypatch):
+    import threading
+    from main import PDFGenerator, RenderPool
+
+    def fake_render(email_msg, output_path, options=None):
+        if email_msg.subject == 'Odd':
+            return 'not a result'
+        Path(output_path).write_bytes(b'%PDF-1.4')
+        return RenderResult(status='success', output=str(output_path))
+
+    monkeypatch.setattr(PDFGenerator, 'render', staticmethod(fake_render))
+    pool = RenderPool(workers=1, timeout=5, memory_limit=0)
+    odd = EMLParser._extract_message(email.message_from_string("Subject: Odd\n\nBody"))
+    fast = EMLParser._extract_message(email.message_from_string("Subject: Fast\n\nBody"))
+    outcomes = []
+
+    def run():
+        for _ in range(2):
+            with pytest.raises(AttributeError):
+                pool.render(odd, tmp_path / "odd.pdf")
+        outcomes.append(pool.render(fast, tmp_path / "fast.pdf"))
+
+    try:
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(15)
+        assert outcomes and outcomes[0].ok  # no worker was lost
+        assert pool.stats['replaced'] == 2
+    finally:
+        pool.close()
+
+
+def test_render_degrades_to_text_when_html_engine_blows_budget(tmp_path, monkeypatch):
+    import time
+    import main
+    from main import PDFGenerator
+
+    class SlowHTML:
+        def __init__(self, string, url_fetcher=None):
+            pass
+
+        def write_pdf(self, target, **kwargs):
+            time.sleep(5)
+
+    monkeypatch.setattr(main, 'HTML', SlowHTML)
+    monkeypatch.setattr(PDFGenerator, 'stylesheet', classmethod(lambda cls, options=None: None))
+    before = PDFGenerator.get_stats()['degraded']
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        "Subject: Huge\nContent-Type: text/html\n\n<p>Body</p>"))
+    started = time.perf_counter()
+    result = PDFGenerator.render(email_msg, tmp_path / "huge.pdf", {'render_timeout': 0.2, 'engine': 'html'})
+    assert time.perf_counter() - started < 3
+    assert result.ok and result.engine == 'text' and result.degraded == 'timeout'
+    assert (tmp_path / "huge.pdf").read_bytes().startswith(b'%PDF-')
+    assert PDFGenerator.get_stats()['degraded'] == before + 1
+
+
+def test_text_engine_wraps_and_paginates_without_truncating(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    from main import EmailMessage, PDFGenerator
+    long_line = ' '.join(f"w{i:03d}" for i in range(300))
+    body = '\n'.join(f"Ligne {n} : café Ω" for n in range(1, 201)) + '\n' + long_line
+    email_msg = EmailMessage(subject='Procès-verbal', sender='a@b.com', recipients=['c@d.com'],
+                             cc=[], bcc=[], date='Mon, 5 Oct 2026', content_type='text/plain', body=body)
+    result = PDFGenerator.render(email_msg, tmp_path / "plain.pdf")
+    assert result.ok and result.engine == 'text' and not result.degraded
+    reader = pypdf.PdfReader(str(tmp_path / "plain.pdf"))
+    assert len(reader.pages) > 2
+    text = '\n'.join(page.extract_text() for page in reader.pages)
+    assert 'Procès-verbal' in text and 'Ligne 200' in text and 'w299' in text
+    if TextPDFRenderer.font().embedded:
+        assert 'café Ω' in text
+    assert max(len(line) for line in text.splitlines()) < 120
+
+
+def test_render_timeout_survives_loaders_that_swallow_errors(tmp_path, monkeypatch):
+    import time
+    import main
+    from main import PDFGenerator
+
+    class LenientHTML:
+        def __init__(self, string, url_fetcher=None):
+            pass
+
+        def write_pdf(self, target, **kwargs):
+            for _ in range(20):
+                try:  # like WeasyPrint's image loader
+                    time.sleep(0.1)
+                except Exception:
+                    pass
+
+    monkeypatch.setattr(main, 'HTML', LenientHTML)
+    monkeypatch.setattr(PDFGenerator, 'stylesheet', classmethod(lambda cls, options=None: None))
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        "Subject: Remote\nContent-Type: text/html\n\n<p>Body</p>"))
+    started = time.perf_counter()
+    result = PDFGenerator.render(email_msg, tmp_path / "remote.pdf", {'render_timeout': 0.2, 'engine': 'html'})
+    assert time.perf_counter() - started < 1
+    assert result.ok and result.engine == 'text' and result.degraded == 'timeout'
+
+
+def test_cost_model_picks_engine_and_records_predictions(tmp_path, monkeypatch):
+    import main
+    from main import EmailMessage, PDFGenerator, RenderCostModel
+
+    def message(html_body):
+        return EmailMessage(subject='S', sender='a@b.com', recipients=[], cc=[], bcc=[], date='',
+                            content_type='text/html', body='', html_body=html_body)
+
+    monkeypatch.setattr(main, 'HTML', object)
+    choose = lambda html_body: RenderCostModel.choose(RenderCostModel.features(message(html_body)))
+    assert choose(None)[2] == 'plain'
+    assert choose('<p>Hello <b>you</b></p>')[0:3:2] == ('text', 'simple_html')
+    layout = '<table><tr><td><table><tr><td><img src="x.png"></td></tr></table></td></tr></table>'
+    features = RenderCostModel.features(message(layout))
+    assert features['table_depth'] == 2 and features['images'] == 1
+    assert choose(layout)[0:3:2] == ('html', 'layout')
+    huge = '<table>' * 40 + '<td>cell</td>' + '</table>' * 40
+    assert choose(huge)[0:3:2] == ('text', 'over_budget')
+
+    monkeypatch.setattr(main, 'HTML', None)
+    RenderCostModel.reset()
+    result = PDFGenerator.render(message(None), tmp_path / "plain.pdf")
+    assert result.decision == 'plain' and result.predicted > 0
+    stats = RenderCostModel.get_stats()
+    assert stats['text']['renders'] == 1 and stats['decisions'] == {'plain': 1}
+    assert stats['text']['scale'] != 1.0
+
+    # HTML renders calibrate the 'html' engine
+    monkeypatch.setattr(main, 'HTML', object)
+    monkeypatch.setattr(PDFGenerator, '_write_html', staticmethod(
+        lambda html_content, email_msg, output_path, options, result: Path(output_path).write_bytes(b'%PDF-1.4')))
+    for n in range(3):
+        result = PDFGenerator.render(message(layout), tmp_path / f"layout{n}.pdf")
+        assert result.ok and result.engine == 'weasyprint' and result.decision == 'layout'
+    stats = RenderCostModel.get_stats()
+    assert stats['html']['renders'] == 3 and stats['decisions'] == {'plain': 1, 'layout': 3}
+    assert stats['html']['scale'] != 1.0
+
+
+def test_merged_mbox_renders_one_document_per_thread(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    f = tmp_path / "export.mbox"
+    f.write_bytes(
+        b"From a@x.org Mon Jan  1 00:00:00 2024\nFrom: a@x.org\nSubject: Budget\nMessage-ID: <1@x>\n\nDraft\n\n"
+        b"From b@x.org Mon Jan  1 00:00:01 2024\nFrom: b@x.org\nSubject: Picnic\nMessage-ID: <2@x>\n\nSaturday?\n\n"
+        b"From c@x.org Mon Jan  1 00:00:02 2024\nFrom: c@x.org\nSubject: Re: Budget\nMessage-ID: <3@x>\n"
+        b"In-Reply-To: <1@x>\n\nOK\n\n"
+        b"From a@x.org Mon Jan  1 00:00:03 2024\nFrom: a@x.org\nSubject: Re: Budget\nMessage-ID: <4@x>\n"
+        b"References: <1@x> <3@x>\n\nThanks\n")
+    conv = EmailConverter()
+    results = conv.convert_mbox(str(f), str(tmp_path / "threads"), {'merge': 'thread'})
+    assert [r['index'] for r in results] == [0, 2, 3, 1]
+    assert all(r['status'] == 'success' for r in results)
+    budget = pypdf.PdfReader(results[0]['output'])
+    assert len(budget.pages) == 3
+    assert [o.title for o in budget.outline] == ['Budget', 'Re: Budget', 'Re: Budget']
+    assert results[3]['output'] != results[0]['output']
+
+    # HTML-engine pages are copied in from their own rendered PDF
+    merged = conv.convert_mbox(str(f), str(tmp_path / "mailbox"), {'merge': 'mailbox', 'engine': 'html'})
+    assert len({r['output'] for r in merged}) == 1
+    reader = pypdf.PdfReader(merged[0]['output'])
+    assert len(reader.pages) == 4
+    assert [reader.get_destination_page_number(o) for o in reader.outline] == [0, 1, 2, 3]
+    assert 'Saturday?' in reader.pages[1].extract_text()
+    assert not list((tmp_path / "mailbox").glob('.m2p-batch-*'))
+
+
+def test_html_template_escapes_fields_and_follows_theme():
+    from main import PDFGenerator
+    from config import theme_style
+    PDFGenerator.clear_stylesheets()
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        "Subject: <script>alert(1)</script> & co\nFrom: Eve <eve@x.org>\n\n1 < 2 and $cost"))
+    page = PDFGenerator._create_html(email_msg)
+    assert '&lt;script&gt;alert(1)&lt;/script&gt; &amp; co' in page
+    assert 'Eve &lt;eve@x.org&gt;' in page
+    assert '<pre>1 &lt; 2 and $cost</pre>' in page
+
+    options = {'style': theme_style({'primary': '#AA0000', 'background': '#000000'})}
+    themed = PDFGenerator._create_html(email_msg, options)
+    assert '#AA0000' in themed and 'background-color: #000000' in themed
+    assert PDFGenerator.template(options) is PDFGenerator.template(options)
+    assert PDFGenerator.template(options) is not PDFGenerator.template()
+    assert PDFGenerator.stylesheet_version(options) != PDFGenerator.stylesheet_version()
+
+
+def test_cid_references_served_from_parsed_parts():
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.image import MIMEImage
+    from main import PDFGenerator
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+    related = MIMEMultipart('related')
+    related['Subject'] = 'Logo'
+    related.attach(MIMEText('<p><img src="cid:logo%40ville"></p>', 'html'))
+    image = MIMEImage(png, 'png')
+    image['Content-ID'] = '<logo@ville>'
+    image.add_header('Content-Disposition', 'inline')
+    related.attach(image)
+
+    email_msg = EMLParser._extract_message(email.message_from_bytes(related.as_bytes()))
+    assert list(email_msg.related_parts) == ['logo@ville']
+    fetched = PDFGenerator.url_fetcher(email_msg)('cid:logo%40ville')
+    assert fetched['string'] == png and fetched['mime_type'] == 'image/png'
+    with pytest.raises(ValueError):
+        PDFGenerator.url_fetcher(email_msg)('cid:missing@ville')
+
+
+def test_remote_resources_follow_policy_cache_and_deadline(tmp_path, monkeypatch):
+    import threading
+    import time
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    import main
+    from main import ResourceFetcher, PDFGenerator
+    monkeypatch.setitem(main.REMOTE_RESOURCE_CONFIG, 'cache_dir', str(tmp_path / 'resources'))
+    hits = []
+
+    class Stub(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            if self.path == '/slow.png':
+                time.sleep(2)
+            if self.path.startswith('/redirect'):
+                self.send_response(302)
+                self.send_header('Location', f"http://localhost:{self.server.server_address[1]}/internal.png")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.end_headers()
+            self.wfile.write(b'PNGDATA')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Stub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        fetcher = ResourceFetcher(options={'remote_policy': 'fetch'})
+        assert fetcher(f"{base}/logo.png")['string'] == b'PNGDATA'
+        assert ResourceFetcher(options={'remote_policy': 'fetch'})(f"{base}/logo.png")['mime_type'] == 'image/png'
+        assert hits == ['/logo.png']  # second render served from the disk cache
+
+        for options in ({'remote_policy': 'block'},
+                        {'remote_policy': 'allow', 'remote_allow_hosts': ['ville-fontaine.fr']}):
+            with pytest.raises(ValueError):
+                ResourceFetcher(options=options)(f"{base}/other.png")
+        with pytest.raises(ValueError):
+            ResourceFetcher()('file:///etc/passwd')
+        assert ResourceFetcher(options={'remote_policy': 'block'})('data:text/plain,hi')['string'] == b'hi'
+        with pytest.raises(OSError):
+            ResourceFetcher(options={'remote_policy': 'allow', 'remote_allow_hosts': ['127.0.0.1']})(
+                f"{base}/redirect.png")
+        assert '/internal.png' not in hits
+
+        monkeypatch.setitem(main.REMOTE_RESOURCE_CONFIG, 'cache_max_bytes', 20)
+        for name in ('a', 'b', 'c', 'd'):
+            ResourceFetcher(options={'remote_policy': 'fetch'})(f"{base}/{name}.png")
+        cached = [path for path in (tmp_path / 'resources').glob('*/*') if not path.suffix]
+        assert sum(path.stat().st_size for path in cached) <= 20
+
+        started = time.monotonic()
+        with pytest.raises(OSError):
+            ResourceFetcher(options={'remote_deadline': 0.3})(f"{base}/slow.png")
+        assert time.monotonic() - started < 1.5
+    finally:
+        server.shutdown()
+
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        'Content-Type: text/html\n\n<p>Hi<img src="https://t.example/o.gif" width="1" height="1">'
+        '<img src="https://cdn.example/banner.png" width="600" height="1">'
+        '<img src="https://cdn.example/wide.png" style="width:300px;height:80px;max-width:1px;max-height:1px">'
+        '</p>'))
+    page = PDFGenerator._create_html(email_msg)
+    assert 'o.gif' not in page and 'banner.png' in page and 'wide.png' in page
+
+
+def test_text_engine_falls_back_by_script_and_shares_subsets(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    from main import EmailMessage, FontChain, TextFont, TextPDFRenderer
+    mono = Path('/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf')
+    sans = Path('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+    if TextPDFRenderer.font().path is None or not (mono.is_file() and sans.is_file()):
+        pytest.skip('DejaVu fonts not installed')
+    primary, fallback = TextFont(mono), TextFont(sans)
+    chain = FontChain([primary, fallback])
+    assert [font.path for font, _ in chain.runs('Bonjour שלום!')] == [mono, sans, mono]
+    assert FontChain.script('ש') == 'HEBREW' and chain._scripts['HEBREW'] == 1
+
+    email_msg = EmailMessage(subject='Réunion', sender='a@b.com', recipients=[], cc=[], bcc=[], date='',
+                             content_type='text/plain', body='Ordre du jour: budget 2027 — שלום')
+    TextPDFRenderer._chains[''] = chain
+    try:
+        for n in range(3):
+            TextPDFRenderer.render(email_msg, tmp_path / f"{n}.pdf")
+    finally:
+        TextPDFRenderer._chains.pop('')
+    assert primary.subset_stats == {'hits': 2, 'misses': 1}
+    page = pypdf.PdfReader(str(tmp_path / "2.pdf")).pages[0]
+    assert len(page['/Resources']['/Font']) == 2
+    assert 'budget 2027' in page.extract_text()
+
+
+def test_images_downsampled_and_pdf_size_budget_enforced(tmp_path, monkeypatch):
+    import io
+    PIL = pytest.importorskip('PIL.Image')
+    import main
+    from main import ImageOptimizer, PDFGenerator
+
+    photo = io.BytesIO()
+    PIL.new('RGB', (4000, 3000), (200, 120, 40)).save(photo, 'JPEG', quality=95)
+    content, mime_type = ImageOptimizer.optimize(photo.getvalue(), 'image/jpeg')
+    assert mime_type == 'image/jpeg' and len(content) < len(photo.getvalue())
+    width, height = PIL.open(io.BytesIO(content)).size
+    assert width == ImageOptimizer.pixel_box()[0] and height < 3000
+    small, _ = ImageOptimizer.optimize(photo.getvalue(), 'image/jpeg', {'image_dpi': 96})
+    assert PIL.open(io.BytesIO(small)).size[0] < width
+    assert ImageOptimizer.optimize(b'GIF89a', 'image/gif') == (b'GIF89a', 'image/gif')
+
+    calls = []
+
+    class SizedHTML:
+        """Writes a PDF whose size follows the image DPI it is given."""
+        def __init__(self, string, url_fetcher=None):
+            pass
+
+        def write_pdf(self, target, dpi=None, jpeg_quality=None, **kwargs):
+            calls.append((dpi, jpeg_quality))
+            Path(target).write_bytes(b'%PDF' + b'0' * dpi * 1000)
+
+    monkeypatch.setattr(main, 'HTML', SizedHTML)
+    monkeypatch.setattr(main, 'CSS', None)
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        'Content-Type: text/html\n\n<p><img src="cid:photo"></p>'))
+    result = PDFGenerator.render(email_msg, tmp_path / "photo.pdf", {'engine': 'html', 'max_pdf_size': 160_000})
+    assert result.ok and result.engine == 'weasyprint'
+    assert calls == [(300, 85), (150, 75)] and result.image_dpi == 150 and not result.oversize
+
+    calls.clear()
+    result = PDFGenerator.render(email_msg, tmp_path / "photo.pdf", {'engine': 'html', 'max_pdf_size': 1000})
+    assert result.ok and result.oversize and len(calls) == 1 + len(main.PDF_CONFIG['size_fallbacks'])
+
+
+def test_attachments_streamed_and_stored_once(tmp_path, monkeypatch):
+    from email.encoders import encode_quopri
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from main import AttachmentStore
+    report = bytes(range(256)) * 1000
+    monkeypatch.setattr(AttachmentStore, 'CHUNK_SIZE', 1000)
+
+    def message(n):
+        msg = MIMEMultipart()
+        msg['Subject'] = f'Fwd: rapport {n}'
+        msg['Message-ID'] = f'<{n}@ville>'
+        msg.attach(MIMEText('Voir pièce jointe'))
+        for name in ('rapport.pdf', '../rapport.pdf'):
+            part = MIMEApplication(report, 'pdf')
+            part.add_header('Content-Disposition', 'attachment', filename=name)
+            msg.attach(part)
+        return msg.as_bytes()
+
+    for n in range(3):
+        (tmp_path / f"{n}.eml").write_bytes(message(n))
+    box = tmp_path / "fwd.mbox"
+    box.write_bytes(b''.join(b"From a@x Mon Jan  1 00:00:00 2024\n" + message(n) + b"\n" for n in range(3, 6)))
+
+    conv = EmailConverter()
+    out = tmp_path / "out"
+    paths = []
+    for n in range(3):
+        result = conv.convert_file(str(tmp_path / f"{n}.eml"), str(out), {'extract_attachments': True})
+        paths += result['attachments']
+    result = conv.convert_file(str(box), str(out), {'extract_attachments': True})
+    paths += result['attachments']
+
+    assert len(paths) == 12
+    assert [Path(p).name for p in paths[:2]] == ['rapport.pdf', 'rapport (2).pdf']
+    assert Path(paths[0]).parent == out / '0_attachments'
+    assert all(Path(p).read_bytes() == report for p in paths)
+    stored = [p for p in (out / AttachmentStore.STORE_DIR).rglob('*') if p.is_file()]
+    assert len(stored) == 1
+
+    csv = email.message_from_bytes(MIMEApplication(
+        'Commune;Population\nFontaine;22 000\n'.encode('latin-1') * 200, 'csv',
+        _encoder=encode_quopri).as_bytes())
+    assert b''.join(AttachmentStore.decoded_chunks(csv)) == csv.get_payload(decode=True)
+
+
+def test_attachment_chunks_tolerate_dirty_base64():
+    import base64
+    from main import AttachmentStore
+    content = bytes(range(256)) * 700
+    encoded = base64.encodebytes(content).decode('ascii')
+    dirty = encoded[:1000] + '*\x00' + encoded[1000:90_000] + '!.' + encoded[90_000:] + '~'
+    part = email.message_from_string(
+        'Content-Type: application/octet-stream\nContent-Transfer-Encoding: base64\n\n' + dirty)
+    assert part.get_payload(decode=True) == content
+    assert b''.join(AttachmentStore.decoded_chunks(part)) == content
+
+
+def test_attachments_embedded_within_cap_without_decoding_the_rest(tmp_path, monkeypatch):
+    pypdf = pytest.importorskip('pypdf')
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from main import AttachmentStore, PDFGenerator
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Délibération'
+    msg.attach(MIMEText('Ci-joint.'))
+    for name, content in (('délib.csv', b'a;b\n1;2\n' * 50), ('scan.tif', b'\x00' * 200_000),
+                          ('notes.txt', b'ok')):
+        part = MIMEApplication(content)
+        part.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(part)
+    email_msg = EMLParser._extract_message(email.message_from_bytes(msg.as_bytes()))
+
+    decoded = []
+    original = AttachmentStore.decoded_chunks.__func__
+    monkeypatch.setattr(AttachmentStore, 'decoded_chunks',
+                        classmethod(lambda cls, part: decoded.append(part.get_filename()) or original(cls, part)))
+    result = PDFGenerator.render(email_msg, tmp_path / "delib.pdf",
+                                 {'engine': 'text', 'embed_attachments': True, 'embed_max_bytes': 10_000})
+    assert result.ok and result.embedded == ['délib.csv', 'notes.txt']
+    assert decoded == ['délib.csv', 'notes.txt']
+    files = pypdf.PdfReader(str(tmp_path / "delib.pdf")).attachments
+    assert files == {'délib.csv': [b'a;b\n1;2\n' * 50], 'notes.txt': [b'ok']}
+
+    assert not PDFGenerator.render(email_msg, tmp_path / "plain.pdf", {'engine': 'text'}).embedded
+
+
+def test_attachment_embedding_skips_bad_parts_and_keeps_navigation(tmp_path, monkeypatch):
+    pypdf = pytest.importorskip('pypdf')
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from main import AttachmentStore, PDFGenerator
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Rapport'
+    for name in ('broken.bin', 'rapport.csv'):
+        part = MIMEApplication(b'x;y\n' * 100)
+        part.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(part)
+    email_msg = EMLParser._extract_message(email.message_from_bytes(msg.as_bytes()))
+
+    original = AttachmentStore.decoded_chunks.__func__
+
+    def decoded_chunks(cls, part):
+        chunks = original(cls, part)
+        if part.get_filename() == 'broken.bin':
+            yield next(chunks)
+            raise ValueError('undecodable payload')
+        yield from chunks
+
+    monkeypatch.setattr(AttachmentStore, 'decoded_chunks', classmethod(decoded_chunks))
+
+    # Stand-in for a WeasyPrint render: nested bookmarks and a named destination
+    source = pypdf.PdfWriter()
+    for _ in range(2):
+        source.add_blank_page(595, 842)
+    heading = source.add_outline_item('Rapport', 0)
+    source.add_outline_item('Annexe', 1, parent=heading)
+    source.add_named_destination('annexe', 1)
+    output = tmp_path / "rapport.pdf"
+    source.write(str(output))
+
+    result = RenderResult(status='success')
+    PDFGenerator._attach_into(output, email_msg, {'embed_attachments': True}, result)
+    assert result.embedded == ['rapport.csv']
+    reader = pypdf.PdfReader(str(output), strict=True)
+    assert reader.attachments == {'rapport.csv': [b'x;y\n' * 100]}
+    assert reader.outline[0].title == 'Rapport' and reader.outline[1][0].title == 'Annexe'
+    assert reader.get_destination_page_number(reader.named_destinations['annexe']) == 1
+
+
+def test_attachment_failure_keeps_the_html_render(tmp_path, monkeypatch):
+    pypdf = pytest.importorskip('pypdf')
+    import main
+    from main import PDFGenerator
+
+    class FakeHTML:
+        def __init__(self, string, url_fetcher=None):
+            pass
+
+        def write_pdf(self, target, **kwargs):
+            document = pypdf.PdfWriter()
+            document.add_blank_page(595, 842)
+            document.write(target)
+
+    def broken(output_path, email_msg, options, result):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(main, 'HTML', FakeHTML)
+    monkeypatch.setattr(PDFGenerator, 'stylesheet', classmethod(lambda cls, options=None: None))
+    monkeypatch.setattr(PDFGenerator, '_attach_into', staticmethod(broken))
+    email_msg = EMLParser._extract_message(email.message_from_string(
+        "Subject: Styled\nContent-Type: multipart/mixed; boundary=b\n\n--b\nContent-Type: text/html\n\n"
+        "<p>Body</p>\n--b\nContent-Type: text/plain\nContent-Disposition: attachment; filename=a.txt\n\n"
+        "ok\n--b--\n"))
+    result = PDFGenerator.render(email_msg, tmp_path / "styled.pdf", {'engine': 'html', 'embed_attachments': True})
+    assert result.ok and result.engine == 'weasyprint' and not result.degraded
+    assert len(pypdf.PdfReader(str(tmp_path / "styled.pdf")).pages) == 1
+
+
+def test_image_and_pdf_attachments_appended_as_pages(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    Image = pytest.importorskip('PIL.Image')
+    from email.mime.application import MIMEApplication
+    from email.mime.image import MIMEImage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from main import PDFGenerator, PDFStreamWriter
+    annex = tmp_path / "annexe.pdf"
+    writer = PDFStreamWriter(annex)
+    for text in (b'one', b'two', b'three'):
+        writer.add_page(b"BT /F1 12 Tf 72 720 Td (" + text + b") Tj ET",
+                        "<< /Font << /F1 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica >> >> >>", 595, 842)
+    writer.close()
+
+    images = {}
+    for name, mode, fmt in (('photo.jpg', 'RGB', 'JPEG'), ('logo.png', 'RGBA', 'PNG')):
+        buffer = io.BytesIO()
+        Image.new(mode, (120, 80), (200, 30, 30, 128)[:len(mode)]).save(buffer, fmt)
+        images[name] = buffer.getvalue()
+
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Permis de construire'
+    msg.attach(MIMEText('Pièces jointes.'))
+    for name, content in images.items():
+        part = MIMEImage(content)
+        part.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(part)
+    for name, content in (('annexe.pdf', annex.read_bytes()), ('notes.txt', b'ok')):
+        part = MIMEApplication(content, 'pdf' if name.endswith('.pdf') else 'octet-stream')
+        part.add_header('Content-Disposition', 'attachment', filename=name)
+        msg.attach(part)
+    email_msg = EMLParser._extract_message(email.message_from_bytes(msg.as_bytes()))
+
+    result = PDFGenerator.render(email_msg, tmp_path / "permis.pdf",
+                                 {'engine': 'text', 'append_attachments': True})
+    assert result.ok and result.appended == ['photo.jpg', 'logo.png', 'annexe.pdf']
+    reader = pypdf.PdfReader(str(tmp_path / "permis.pdf"), strict=True)
+    assert len(reader.pages) == 1 + 2 + 3
+    assert [item.title for item in reader.outline] == ['Permis de construire', 'photo.jpg', 'logo.png', 'annexe.pdf']
+    assert 'three' in reader.pages[5].extract_text()
+    photo = next(iter(reader.pages[1].images))
+    assert photo.image.size == (120, 80)
+    assert '/SMask' in reader.pages[2]['/Resources']['/XObject']['/Im1']